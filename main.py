@@ -1,15 +1,30 @@
-from time import sleep
 from serial import Serial, SerialTimeoutException, SerialException, PARITY_EVEN
-from stm_tools.serialflasher.SerialFlasher import SerialTool
+from stm_tools.serialflasher.serialtool import SerialTool
 from stm_tools.serialflasher.devices import OptionBytes
+from stm_tools.serialflasher.discovery import discoverDevices
+from stm_tools.serialflasher.constants import (
+    STM_RESET_READOUT_UNPROTECT,
+    STM_RESET_WRITE_UNPROTECT,
+    STM_RECONNECT_MASS_ERASE_TIMEOUT_S,
+)
 from struct import unpack
 import sys
 
 
 def main():
     fmt = ">H"
+    if len(sys.argv) > 1:
+        port = sys.argv[1]
+    else:
+        devices = discoverDevices()
+        if not devices:
+            print("No bootloader found, pass the port to use")
+            sys.exit(1)
+        port = devices[0].port
+        print(f"Using {port}")
+
     serial = Serial(
-        "/dev/ttyUSB0",
+        port,
         57600,
         timeout=1.0,
         write_timeout=1.0,
@@ -40,10 +55,9 @@ def main():
         print("Failed to cmd Read Unprotect")
         sys.exit(0)
 
-    sleep(2)
     print("Reconnecting...")
 
-    sf.connect()
+    sf.reconnect(STM_RESET_READOUT_UNPROTECT, STM_RECONNECT_MASS_ERASE_TIMEOUT_S)
 
     success = sf.cmdWriteUnprotect()
 
@@ -53,10 +67,9 @@ def main():
         print("Failed to cmd Write Unprotect")
         sys.exit(0)
 
-    sleep(2)
     print("Reconnecting...")
 
-    sf.connect()
+    sf.reconnect(STM_RESET_WRITE_UNPROTECT)
 
     success, rx = sf.cmdGetVersionProt()
 
@@ -131,8 +144,6 @@ def main():
     success = sf.cmdEraseFlashMemoryPages(bytearray([0, 1, 2]))
     print(f"State: {success}")
 
-    sleep(3)
-
     success, rx = sf.cmdReadFromMemoryAddress(0x08000000, 4)
     print(f"State: {success} Data: {rx}")
 
@@ -141,9 +152,10 @@ def main():
 
     success = sf.cmdReadoutUnprotect()
 
-    sleep(1)
     print("Reconnecting")
-    success = sf.connect()
+    success = sf.reconnect(
+        STM_RESET_READOUT_UNPROTECT, STM_RECONNECT_MASS_ERASE_TIMEOUT_S
+    )
     if not success:
         print("unable to reconnect")
 
@@ -178,6 +190,8 @@ def main():
 
     sf.reset()
 
+    print(f"Reset timings: {sf.getResetTimings()}")
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,411 @@
+"""
+ file  benchmark.py
+ Description: Microbenchmarks of the pure-Python hot paths: checksums,
+ framing, option byte decoding, device construction and read buffer
+ accumulation. Commands go to a NullSerial so only host overhead is
+ measured. Each case records the time per operation and the tracemalloc
+ peak of one operation, and results are compared against a recorded
+ baseline to catch regressions before they multiply across many ports on
+ one host.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import platform
+import timeit
+import tracemalloc
+from dataclasses import asdict, dataclass
+from time import monotonic, perf_counter
+from serial import Serial
+from .constants import *
+from .devices import DeviceType, OptionBytes
+from .faults import FaultySerial, LinkProfile
+from .serialtool import SerialTool
+from .simulator import NullSerial, SimulatedPty, SimulatedSerial
+from .stmdevice import STMInterface
+from .transport import FdTransport
+from .verify import findMismatches
+
+# baselines depend on the host, so they are kept in the working directory
+# unless the environment variable names another file
+BENCH_BASELINE_NAME = "benchmark_baseline.json"
+BENCH_BASELINE_ENV = "STM_TOOLS_BENCH_BASELINE"
+BENCH_REPEAT = 5
+# a case regresses when it is this many times slower than its baseline
+BENCH_TIME_TOLERANCE = 1.5
+# or when its peak grows by this factor plus the slack, which absorbs
+# allocator noise on the small cases
+BENCH_MEMORY_TOLERANCE = 1.1
+BENCH_MEMORY_SLACK = 1024
+BENCH_READ_LENGTH = 64 * 1024
+BENCH_LINK_LENGTH = 16 * 1024
+BENCH_LINK_RETRIES = 3
+BENCH_TRANSPORT_COMMANDS = 500
+
+
+@dataclass(frozen=True)
+class BenchmarkCase:
+    """a benchmarked operation, func is called with no arguments"""
+
+    name: str
+    func: object
+    number: int
+
+
+@dataclass(frozen=True)
+class BenchmarkResult:
+    """time per operation in nanoseconds and the peak traced allocation of
+    one operation in bytes"""
+
+    name: str
+    ns_per_op: float
+    peak_bytes: int
+
+
+def hostPathCases() -> list:
+    """build the benchmark cases. Commands run over a NullSerial
+
+    Returns:
+        list: BenchmarkCase for each hot path
+    """
+    tool = SerialTool(serial=NullSerial())
+    stm = STMInterface(tool)
+    frame = bytearray(257)
+    data = bytes(range(256))
+    image = bytes(range(256)) * 1024
+    readback = bytearray(image)
+    readback[100000] ^= 1
+    raw_option_bytes = OptionBytes.FromAttributes().toBytes()
+    option_bytes = OptionBytes.FromBytes(raw_option_bytes)
+
+    return [
+        # appendChecksum extends its argument, so each call gets a copy
+        BenchmarkCase(
+            "appendChecksum", lambda: SerialTool.appendChecksum(frame[:]), 20000
+        ),
+        BenchmarkCase(
+            "addressToBytes", lambda: SerialTool.addressToBytes(0x08001234), 200000
+        ),
+        BenchmarkCase(
+            "frameAddress", lambda: SerialTool.frameAddress(0x08001234), 100000
+        ),
+        BenchmarkCase("frameWriteData", lambda: SerialTool.frameWriteData(data), 20000),
+        BenchmarkCase(
+            "cmdWriteToMemoryAddress",
+            lambda: tool.cmdWriteToMemoryAddress(0x08000000, data),
+            10000,
+        ),
+        BenchmarkCase(
+            "cmdReadFromMemoryAddress",
+            lambda: tool.cmdReadFromMemoryAddress(0x08000000, 256),
+            10000,
+        ),
+        BenchmarkCase(
+            "OptionBytes.FromBytes",
+            lambda: OptionBytes.FromBytes(raw_option_bytes),
+            50000,
+        ),
+        BenchmarkCase("OptionBytes.toBytes", option_bytes.toBytes, 50000),
+        BenchmarkCase("DeviceType", lambda: DeviceType(0x0410, 2.2), 20000),
+        BenchmarkCase(
+            "_readFromMem",
+            lambda: stm._readFromMem(0x08000000, BENCH_READ_LENGTH),
+            20,
+        ),
+        # a 256KB part's readback with one flipped bit
+        BenchmarkCase("findMismatches", lambda: findMismatches(image, readback), 50),
+    ]
+
+
+def measure(case: BenchmarkCase, repeat: int = BENCH_REPEAT, scale: float = 1.0):
+    """time a case and trace the peak allocation of one call. Timing runs
+    with tracing off, the best of the repeats is kept
+
+    Args:
+        case (BenchmarkCase): the case
+        repeat (int, optional): timing repeats. Defaults to BENCH_REPEAT.
+        scale (float, optional): multiplier for the case's call count. Defaults to 1.0.
+
+    Returns:
+        BenchmarkResult: the result
+    """
+    number = max(1, int(case.number * scale))
+    # warm up caches and lazily created objects before either measurement
+    case.func()
+    best = min(timeit.Timer(case.func).repeat(repeat, number))
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.stop()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        case.func()
+        peak = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+        if tracing:
+            tracemalloc.start()
+
+    return BenchmarkResult(case.name, best / number * 1e9, peak)
+
+
+def runBenchmarks(
+    cases: list = None, repeat: int = BENCH_REPEAT, scale: float = 1.0
+) -> list:
+    """measure every case
+
+    Args:
+        cases (list, optional): cases to run. Defaults to hostPathCases().
+        repeat (int, optional): timing repeats. Defaults to BENCH_REPEAT.
+        scale (float, optional): multiplier for call counts, lower is quicker
+            and noisier. Defaults to 1.0.
+
+    Returns:
+        list: BenchmarkResult for each case
+    """
+    cases = hostPathCases() if cases is None else cases
+    return [measure(case, repeat, scale) for case in cases]
+
+
+def defaultBaselinePath() -> str:
+    """the baseline file named by BENCH_BASELINE_ENV, otherwise
+    BENCH_BASELINE_NAME in the working directory"""
+    path = os.environ.get(BENCH_BASELINE_ENV)
+    return path if path else os.path.join(os.getcwd(), BENCH_BASELINE_NAME)
+
+
+def saveBaseline(results: list, path: str = None) -> None:
+    """record results as the baseline, with the host they were taken on
+
+    Args:
+        results (list): BenchmarkResults
+        path (str, optional): baseline file. Defaults to defaultBaselinePath().
+    """
+    path = defaultBaselinePath() if path is None else path
+    baseline = {
+        "host": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+        },
+        "results": {r.name: asdict(r) for r in results},
+    }
+    with open(path, "w") as fp:
+        json.dump(baseline, fp, indent=2)
+        fp.write("\n")
+
+
+def loadBaseline(path: str = None) -> dict:
+    """load recorded results
+
+    Args:
+        path (str, optional): baseline file. Defaults to defaultBaselinePath().
+
+    Returns:
+        dict: case name -> BenchmarkResult, empty if there is no baseline
+    """
+    path = defaultBaselinePath() if path is None else path
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fp:
+        baseline = json.load(fp)
+    return {
+        name: BenchmarkResult(**result)
+        for name, result in baseline.get("results", {}).items()
+    }
+
+
+def findRegressions(
+    results: list,
+    baseline: dict,
+    timeTolerance: float = BENCH_TIME_TOLERANCE,
+    memoryTolerance: float = BENCH_MEMORY_TOLERANCE,
+) -> list:
+    """compare results with a baseline. Cases missing from the baseline
+    are not compared
+
+    Args:
+        results (list): BenchmarkResults
+        baseline (dict): case name -> BenchmarkResult, see loadBaseline
+        timeTolerance (float, optional): allowed slowdown factor. Defaults to
+            BENCH_TIME_TOLERANCE.
+        memoryTolerance (float, optional): allowed peak growth factor. Defaults to
+            BENCH_MEMORY_TOLERANCE.
+
+    Returns:
+        list: a message for each regression
+    """
+    regressions = []
+    for result in results:
+        base = baseline.get(result.name)
+        if base is None:
+            continue
+        if result.ns_per_op > base.ns_per_op * timeTolerance:
+            regressions.append(
+                f"{result.name}: {result.ns_per_op:.0f} ns/op, "
+                f"baseline {base.ns_per_op:.0f} ns/op"
+            )
+        if result.peak_bytes > base.peak_bytes * memoryTolerance + BENCH_MEMORY_SLACK:
+            regressions.append(
+                f"{result.name}: peak {result.peak_bytes} bytes, "
+                f"baseline {base.peak_bytes} bytes"
+            )
+    return regressions
+
+
+def resetAndReconnect(tool: SerialTool) -> bool:
+    """default link recovery: reset the device with DTR and handshake again"""
+    tool.serial.setDTR(True)
+    tool.serial.setDTR(False)
+    return tool.reconnect(STM_RESET_DTR)
+
+
+def measureLinkThroughput(
+    profile: LinkProfile,
+    seed: int = 0,
+    length: int = BENCH_LINK_LENGTH,
+    retries: int = BENCH_LINK_RETRIES,
+    recover=resetAndReconnect,
+    timeout: float = 0.05,
+) -> dict:
+    """read from a simulated device over a faulty link and report the
+    throughput. Each failed read is retried after calling recover, so
+    recovery strategies can be compared on the same seeded faults
+
+    Args:
+        profile (LinkProfile): faults to inject
+        seed (int, optional): fault RNG seed. Defaults to 0.
+        length (int, optional): bytes to read. Defaults to BENCH_LINK_LENGTH.
+        retries (int, optional): attempts per 256-byte read after the first. Defaults to
+            BENCH_LINK_RETRIES.
+        recover (callable, optional): recover(tool) after a failed read. Defaults to
+            resetAndReconnect.
+        timeout (float, optional): port timeout in seconds. Defaults to 0.05.
+
+    Returns:
+        dict: bytes_per_s, bytes read intact, retries, failed reads and the
+            link's fault stats
+    """
+    simulated = SimulatedSerial()
+    expected = bytes(range(256)) * (length // 256 + 1)
+    simulated.bootloader.flash[:length] = expected[:length]
+    link = FaultySerial(simulated, profile, seed=seed)
+    tool = SerialTool(serial=link)
+    link.timeout = timeout
+    tool.reconnect(STM_RESET_DTR)
+
+    intact = retried = failed = 0
+    start = monotonic()
+    for offset in range(0, length, 256):
+        count = min(256, length - offset)
+        for attempt in range(retries + 1):
+            try:
+                success, rx = tool.cmdReadFromMemoryAddress(
+                    STM_F10X_FLASH_START + offset, count
+                )
+            except Exception:
+                success = False
+            # without a checksum on read data, a flipped bit is only caught here
+            if success and rx == expected[offset : offset + count]:
+                intact += count
+                break
+            if attempt < retries:
+                retried += 1
+                recover(tool)
+        else:
+            failed += 1
+    elapsed = monotonic() - start
+
+    return {
+        "bytes_per_s": intact / elapsed if elapsed else 0.0,
+        "bytes": intact,
+        "retries": retried,
+        "failed": failed,
+        "stats": dict(link.stats),
+    }
+
+
+class _PtySerial(Serial):
+    """pyserial on a SimulatedPty. Some kernels refuse line settings and
+    modem line changes on a pseudo terminal, which pyserial reports as
+    errors. The pty is already raw, so they are ignored"""
+
+    def _reconfigure_port(self, force_update=False):
+        try:
+            super()._reconfigure_port(force_update)
+        except Exception:
+            pass
+
+    def _update_dtr_state(self):
+        try:
+            super()._update_dtr_state()
+        except OSError:
+            pass
+
+    def _update_rts_state(self):
+        try:
+            super()._update_rts_state()
+        except OSError:
+            pass
+
+
+def compareTransports(count: int = BENCH_TRANSPORT_COMMANDS) -> dict:
+    """time commands through pyserial and through FdTransport on the same
+    simulated link, a pseudo terminal to the simulator. The link adds no
+    line time, so the difference is the host overhead of each driver.
+    Adaptor latency timers are not modelled
+
+    Args:
+        count (int, optional): commands of each kind timed. Defaults to
+            BENCH_TRANSPORT_COMMANDS.
+
+    Returns:
+        dict: driver name -> {"get_id_us", "read_256_us"} mean microseconds per
+            GET ID command (three short reads) and per 256-byte read command
+    """
+    openers = {
+        "pyserial": lambda port: _PtySerial(port, 57600, timeout=1.0),
+        "fd": lambda port: FdTransport(port, 57600, timeout=1.0),
+    }
+    results = {}
+    for name, opener in openers.items():
+        pty = SimulatedPty()
+        transport = opener(pty.port)
+        try:
+            tool = SerialTool(serial=transport)
+            tool.connect()
+            timings = {}
+            for key, command in (
+                ("get_id_us", tool.cmdGetId),
+                (
+                    "read_256_us",
+                    lambda: tool.cmdReadFromMemoryAddress(STM_F10X_FLASH_START, 256),
+                ),
+            ):
+                command()
+                start = perf_counter()
+                for _ in range(count):
+                    command()
+                timings[key] = (perf_counter() - start) / count * 1e6
+            results[name] = timings
+        finally:
+            transport.close()
+            pty.close()
+    return results
+
+
+def formatResults(results: list, baseline: dict = None) -> str:
+    """a table of results, with the change from the baseline if given"""
+    baseline = {} if baseline is None else baseline
+    lines = [f"{'case':<26}{'ns/op':>12}{'peak bytes':>12}{'vs baseline':>13}"]
+    for result in results:
+        base = baseline.get(result.name)
+        change = f"{result.ns_per_op / base.ns_per_op:.2f}x" if base else "-"
+        lines.append(
+            f"{result.name:<26}{result.ns_per_op:>12.0f}"
+            f"{result.peak_bytes:>12}{change:>13}"
+        )
+    return "\n".join(lines)
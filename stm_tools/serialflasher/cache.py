@@ -0,0 +1,90 @@
+"""
+ file  cache.py
+ Description: Caches the identity and capabilities read from a device's
+ bootloader, so reconnecting after a reset does not need to repeat the
+ GET ID and GET round trips.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from threading import Lock
+
+
+@dataclass(frozen=True)
+class BootloaderInfo:
+    """identity and capabilities read from a device bootloader"""
+
+    pid: int
+    version: float
+    capabilities: frozenset
+    uid: int = 0
+
+
+class DeviceInfoCache:
+    """BootloaderInfo cache, keyed by serial port and by device UID
+    when the UID has been read. A port's entry is only a hint: boards can
+    be swapped, so STMInterface checks the PID and UID read from the
+    device against it on every new connection and invalidates it if they
+    differ
+    """
+
+    def __init__(self):
+        self._by_port = {}
+        self._by_uid = {}
+        self._lock = Lock()
+
+    def get(self, port: str) -> BootloaderInfo:
+        """get the cached info for a port
+
+        Args:
+            port (str): serial port
+
+        Returns:
+            BootloaderInfo: cached info, or None
+        """
+        with self._lock:
+            return self._by_port.get(port)
+
+    def getByUid(self, uid: int) -> BootloaderInfo:
+        """get the cached info for a device UID
+
+        Args:
+            uid (int): device unique ID
+
+        Returns:
+            BootloaderInfo: cached info, or None
+        """
+        with self._lock:
+            return self._by_uid.get(uid)
+
+    def put(self, port: str, info: BootloaderInfo) -> None:
+        """store info for a port, and for its UID if known
+
+        Args:
+            port (str): serial port
+            info (BootloaderInfo): info to store
+        """
+        with self._lock:
+            self._by_port[port] = info
+            if info.uid:
+                self._by_uid[info.uid] = info
+
+    def invalidate(self, port: str = None) -> None:
+        """drop the entry for a port, or every entry if no port is given
+
+        Args:
+            port (str, optional): serial port. Defaults to None.
+        """
+        with self._lock:
+            if port is None:
+                self._by_port.clear()
+                self._by_uid.clear()
+                return
+            info = self._by_port.pop(port, None)
+            if info is not None and info.uid:
+                self._by_uid.pop(info.uid, None)
+
+
+# shared by every STMInterface unless one is supplied
+deviceInfoCache = DeviceInfoCache()
@@ -0,0 +1,134 @@
+"""
+ file  cli.py
+ Description: Command line entry point for the serial flasher tools.
+"""
+
+import argparse
+import sys
+from .constants import *
+from .discovery import discoverDevices, watchDevices
+from . import benchmark
+
+
+def _formatResult(result) -> str:
+    name = result.name if result.name else "unknown device"
+    uid = f"{result.uid:024x}" if result.uid else "unknown"
+    return (
+        f"{result.port}: {name} (pid {hex(result.pid)}) "
+        f"bootloader v{result.version} uid {uid}"
+    )
+
+
+def discover(args) -> int:
+    probeArgs = {"baud": args.baud, "timeout": args.timeout}
+    if args.watch:
+        try:
+            for event, item in watchDevices(**probeArgs):
+                if event == "added":
+                    print(f"+ {_formatResult(item)}", flush=True)
+                else:
+                    print(f"- {item}", flush=True)
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    results = discoverDevices(args.ports or None, **probeArgs)
+    for result in results:
+        print(_formatResult(result))
+    if not results:
+        print("No bootloaders found", file=sys.stderr)
+        return 1
+    return 0
+
+
+def bench(args) -> int:
+    if args.transports:
+        print(f"{'driver':<12}{'GET ID us':>12}{'256B read us':>14}")
+        for name, timings in benchmark.compareTransports().items():
+            print(
+                f"{name:<12}{timings['get_id_us']:>12.1f}"
+                f"{timings['read_256_us']:>14.1f}"
+            )
+        return 0
+
+    path = args.baseline if args.baseline else benchmark.defaultBaselinePath()
+    results = benchmark.runBenchmarks(repeat=args.repeat, scale=args.scale)
+    if args.record:
+        benchmark.saveBaseline(results, path)
+        print(benchmark.formatResults(results))
+        print(f"Baseline recorded to {path}")
+        return 0
+
+    baseline = benchmark.loadBaseline(path)
+    print(benchmark.formatResults(results, baseline))
+    if not baseline:
+        print("No baseline recorded, run with --record", file=sys.stderr)
+        return 0
+    regressions = benchmark.findRegressions(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+def buildParser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="stm-tools", description="STM32F10x serial bootloader tools"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser(
+        "discover", help="find devices running the bootloader on serial ports"
+    )
+    cmd.add_argument("ports", nargs="*", help="ports to probe, default all")
+    cmd.add_argument("--baud", type=int, default=STM_PROBE_BAUD, help="baud rate")
+    cmd.add_argument(
+        "--timeout",
+        type=float,
+        default=STM_PROBE_TIMEOUT_S,
+        help="per-port handshake timeout in seconds",
+    )
+    cmd.add_argument(
+        "--watch", action="store_true", help="keep watching for new adapters"
+    )
+    cmd.set_defaults(func=discover)
+
+    cmd = commands.add_parser(
+        "bench", help="microbenchmark host-side hot paths against a baseline"
+    )
+    cmd.add_argument(
+        "--baseline",
+        help=f"baseline file to compare with or record to, default "
+        f"${benchmark.BENCH_BASELINE_ENV} or ./{benchmark.BENCH_BASELINE_NAME}",
+    )
+    cmd.add_argument(
+        "--record", action="store_true", help="record the results as the baseline"
+    )
+    cmd.add_argument(
+        "--repeat", type=int, default=benchmark.BENCH_REPEAT, help="timing repeats"
+    )
+    cmd.add_argument(
+        "--scale", type=float, default=1.0, help="multiplier for calls per repeat"
+    )
+    cmd.add_argument(
+        "--tolerance",
+        type=float,
+        default=benchmark.BENCH_TIME_TOLERANCE,
+        help="allowed slowdown factor before a case counts as a regression",
+    )
+    cmd.add_argument(
+        "--transports",
+        action="store_true",
+        help="compare pyserial with the file descriptor transport instead",
+    )
+    cmd.set_defaults(func=bench)
+
+    return parser
+
+
+def main(argv: list = None) -> int:
+    args = buildParser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
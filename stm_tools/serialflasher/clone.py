@@ -0,0 +1,205 @@
+"""
+ file  clone.py
+ Description: Copies a known-good unit's flash and option bytes to any
+ number of target units in one pass. The source flash is read once, a
+ page at a time, and each populated page is handed to every target while
+ the next is read; erased pages are skipped. Each target runs on its own
+ thread behind a short queue, so the targets program concurrently and the
+ source read is only held back by the slowest of them. Nothing is written
+ to disk, and only the queued pages are held in memory. If the source read
+ fails or is cancelled the targets are told to stop, and none of them is
+ verified or given the source's option bytes.
+"""
+
+from __future__ import annotations
+
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from queue import Queue
+from .errors import *
+from .progress import CancellationToken
+
+# pages a target may fall behind the source read before the read waits
+CLONE_QUEUE_PAGES = 16
+
+
+@dataclass
+class CloneResult:
+    """what a clone did to one target: whether its flash was erased, the
+    pages written, any that failed to verify, the option byte settings
+    changed and the error that stopped it, if one did"""
+
+    target: object
+    erased: bool = False
+    pages: list = field(default_factory=list)
+    mismatches: list = field(default_factory=list)
+    option_bytes: dict = field(default_factory=dict)
+    error: Exception = None
+
+    @property
+    def ok(self) -> bool:
+        """the target is a verified copy of the source"""
+        return self.error is None and not self.mismatches
+
+
+class _CloneTarget:
+    """internal class: programs one target from its queue of pages"""
+
+    def __init__(self, target, depth: int):
+        self.result = CloneResult(target)
+        self.queue = Queue(depth)
+        self.crcs = {}
+
+    def run(self, verify: bool, optionBytes, cancel: CancellationToken) -> None:
+        """take pages until None, which marks a complete source read, or
+        the exception which stopped the source read"""
+        target = self.result.target
+        device = target.device
+        # nothing is erased until the source has produced something
+        item = self.queue.get()
+        try:
+            if isinstance(item, Exception):
+                self.result.error = item
+                return
+            if cancel is not None:
+                cancel.check()
+            flash = device.flash_memory
+            success, _ = target.unprotectForWrite([(flash.start, flash.size)])
+            if not success or not target.globalEraseFlash():
+                raise CommandFailedError("Unable to erase target flash")
+            self.result.erased = True
+
+            while item is not None:
+                if isinstance(item, Exception):
+                    # a partial copy is neither verified nor protected
+                    self.result.error = item
+                    return
+                page, data = item
+                address = device.getFlashPageAddress(page)
+                if not target.writeToFlash(address, data, cancel=cancel):
+                    raise CommandFailedError(f"Write failed at {hex(address)}")
+                self.crcs[page] = zlib.crc32(data)
+                self.result.pages.append(page)
+                item = self.queue.get()
+
+            if verify:
+                for page, crc in self.crcs.items():
+                    success, rx = target.readFromFlash(
+                        device.getFlashPageAddress(page),
+                        device.flash_page_size,
+                        cancel=cancel,
+                    )
+                    if not success or zlib.crc32(rx) != crc:
+                        self.result.mismatches.append(page)
+
+            if optionBytes is not None and not self.result.mismatches:
+                success, changes = target.applyOptionBytes(optionBytes)
+                self.result.option_bytes = changes
+                if not success:
+                    raise CommandFailedError("Unable to write target option bytes")
+        except Exception as e:
+            self.result.error = e
+            # keep taking pages so the source read never waits on this target
+            while item is not None and not isinstance(item, Exception):
+                item = self.queue.get()
+
+
+def cloneDevice(
+    source,
+    targets: list,
+    optionBytes: bool = True,
+    verify: bool = True,
+    queuePages: int = CLONE_QUEUE_PAGES,
+    progress=None,
+    cancel: CancellationToken = None,
+) -> list:
+    """copy the source device's flash, and optionally its option bytes, to
+    every target. Each target's flash is mass erased, then the source's
+    populated pages are written to it as they are read. Verification reads
+    back each written page and checks its CRC32, and the option bytes are
+    applied last, once the target's flash has verified, so write protection
+    copied from the source cannot block the writes
+
+    If the source read fails or is cancelled, targets are neither verified
+    nor given option bytes, and each result's error is the source's error.
+    A target is only erased once the source has read its first populated
+    page, and the raised error carries the results as its results
+    attribute, so callers can see which targets were erased
+
+    Args:
+        source (STMInterface): the known-good unit, connected with its device
+            info read
+        targets (list): STMInterface for each unit to program, connected with
+            their device info read
+        optionBytes (bool, optional): copy the option bytes. Defaults to True.
+        verify (bool, optional): read back the pages written. Defaults to True.
+        queuePages (int, optional): pages a target may fall behind the source.
+            Defaults to CLONE_QUEUE_PAGES.
+        progress (callable, optional): called with a ProgressEvent after each
+            frame read from the source. Defaults to None.
+        cancel (CancellationToken, optional): checked before each command on
+            every device, and before each target is erased. Defaults to None.
+
+    Raises:
+        DeviceNotConnectedError: a device is not connected
+        InformationNotRetrieved: a device type is unknown
+        DeviceNotSupportedError: a target is a different part from the source
+        CommandFailedError: the source could not be read
+        OperationCancelledError: cancelled through the token
+
+    Returns:
+        list: CloneResult for each target, in order
+    """
+    for device in [source] + list(targets):
+        if not device.connected:
+            raise DeviceNotConnectedError
+        if device.device is None:
+            raise InformationNotRetrieved
+        if device.device.pid != source.device.pid:
+            raise DeviceNotSupportedError(
+                f"Target is device {hex(device.device.pid)}, source is {hex(source.device.pid)}"
+            )
+
+    source_options = None
+    if optionBytes:
+        source_options = source.getOptionBytes(refresh=True)
+        if source_options is None:
+            raise CommandFailedError(
+                "Unable to read source option bytes, device may be readout protected"
+            )
+
+    flash = source.device.flash_memory
+    page_size = source.device.flash_page_size
+    erased = b"\xff" * page_size
+    workers = [_CloneTarget(target, queuePages) for target in targets]
+    failure = None
+
+    with ThreadPoolExecutor(max_workers=len(workers) or 1) as pool:
+        for worker in workers:
+            pool.submit(worker.run, verify, source_options, cancel)
+        # None only once the whole source has been read
+        end = CommandFailedError("Source read did not complete")
+        try:
+            blocks = source.iterRead(
+                flash.start, flash.size, page_size, progress, cancel
+            )
+            for page, block in enumerate(blocks):
+                if block == erased:
+                    continue
+                data = bytes(block)
+                for worker in workers:
+                    worker.queue.put((page, data))
+            end = None
+        except Exception as e:
+            failure = e
+            end = e
+        finally:
+            for worker in workers:
+                worker.queue.put(end)
+
+    results = [worker.result for worker in workers]
+    if failure is not None:
+        failure.results = results
+        raise failure
+    return results
@@ -19,11 +19,59 @@ STM_CMD_READOUT_PROTECT_DIS = 0x92
 
 STM_GET_RETURN_N = 0x0B
 
+# extended erase special codes
+STM_EXT_ERASE_MASS = 0xFFFF
+STM_EXT_ERASE_BANK1 = 0xFFFE
+STM_EXT_ERASE_BANK2 = 0xFFFD
+
+# max pages in a single erase command. N = 0xFF is the legacy global erase, and
+# 512 pages covers a full selective erase of the largest F1 part
+STM_ERASE_MAX_PAGES = 255
+STM_EXT_ERASE_MAX_PAGES = 512
+# pages erased per batch when erasing just ahead of the write cursor, see
+# STMInterface.programFlash
+STM_ERASE_AHEAD_PAGES = 4
+
 STM_RSP_GET_LEN = 12
 STM_GET_ID_RSP_LEN = 2
 STM_VERS_RSP_LEN = 3
 
+# reconnect polling after a device reset. Handshakes are retried on the
+# backoff schedule (the last delay repeats) until the timeout expires.
+# Readout unprotect mass erases the flash before the bootloader restarts
+STM_RECONNECT_BACKOFF_S = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05)
+STM_RECONNECT_POLL_TIMEOUT_S = 0.01
+STM_RECONNECT_TIMEOUT_S = 2.0
+STM_RECONNECT_MASS_ERASE_TIMEOUT_S = 10.0
+# recent reconnect times kept per reset kind, see SerialTool.getResetTimings
+STM_RESET_TIMING_HISTORY = 16
+
+# reset kinds recorded by SerialTool.reconnect
+STM_RESET_DTR = "dtr"
+STM_RESET_OPTION_BYTES = "option_bytes"
+STM_RESET_READOUT_PROTECT = "readout_protect"
+STM_RESET_READOUT_UNPROTECT = "readout_unprotect"
+STM_RESET_WRITE_PROTECT = "write_protect"
+STM_RESET_WRITE_UNPROTECT = "write_unprotect"
+
 STM_BOOTLOADER_MAX_BAUD = 115200
 STM_BOOTLOADER_MIN_BAUD = 1200
 
 STM_F10X_OPTBYTES_ADDR = 0x1FFFF800
+STM_F10X_UID_ADDR = 0x1FFFF7E8
+STM_F10X_UID_LEN = 12
+STM_F10X_FLASH_START = 0x08000000
+STM_F10X_WRP_SECTOR_SIZE = 4096
+
+# port discovery. A port is given this long to answer the handshake, and
+# all candidate ports are probed at once up to the worker limit
+STM_PROBE_TIMEOUT_S = 0.1
+STM_PROBE_BAUD = 57600
+STM_PROBE_MAX_WORKERS = 32
+STM_PROBE_WATCH_INTERVAL_S = 1.0
+
+# transaction priorities, lower runs first. Health checks go ahead of
+# queued commands, and bulk transfers yield to both between frames
+STM_PRIORITY_HIGH = 0
+STM_PRIORITY_NORMAL = 10
+STM_PRIORITY_BULK = 20
@@ -0,0 +1,606 @@
+"""
+ file  daemon.py
+ Description: A long running provisioning service. It owns the serial
+ ports, keeps a connected and identified bootloader session open on each,
+ and runs flash, verify, read and option byte jobs queued per port. Jobs
+ are submitted and polled through a small JSON API over localhost HTTP or
+ a Unix socket.
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import json
+import os
+import queue
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from socketserver import ThreadingMixIn, UnixStreamServer
+from threading import Event, Lock, Thread
+from time import monotonic, time
+from .constants import *
+from .errors import *
+from .devices import OPTION_BYTE_FIELDS, OptionBytes
+from .serialtool import SerialTool
+from .stmdevice import STMInterface
+from .utilities import unpack16BitInt
+
+JOB_FLASH = "flash"
+JOB_VERIFY = "verify"
+JOB_READ = "read"
+JOB_OPTION_BYTES = "optionbytes"
+JOB_KINDS = (JOB_FLASH, JOB_VERIFY, JOB_READ, JOB_OPTION_BYTES)
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# a job failing with one of these was rejected before it reached the device,
+# so the session is still good
+JOB_INPUT_ERRORS = (
+    KeyError,
+    ValueError,
+    TypeError,
+    InvalidAddressError,
+    InvalidReadLengthError,
+    InvalidWriteLengthError,
+)
+
+DAEMON_DEFAULT_BAUD = 57600
+DAEMON_KEEPALIVE_S = 30.0
+# finished jobs are kept for polling until there are more than this many,
+# or until they are this old, whichever comes first
+DAEMON_KEEP_JOBS = 1000
+DAEMON_JOB_TTL_S = 3600.0
+
+
+@dataclass
+class Job:
+    """a unit of work queued against a port"""
+
+    id: int
+    port: str
+    kind: str
+    params: dict
+    status: str = JOB_QUEUED
+    result: dict = None
+    error: str = None
+    submitted: float = field(default_factory=time)
+    started: float = None
+    finished: float = None
+    done: Event = field(default_factory=Event, repr=False, compare=False)
+
+    def toDict(self) -> dict:
+        """JSON-friendly view of the job"""
+        return {
+            "id": self.id,
+            "port": self.port,
+            "kind": self.kind,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+def openSerialSession(port: str, baud: int = DAEMON_DEFAULT_BAUD) -> STMInterface:
+    """default session factory: an STMInterface on a newly opened serial port"""
+    return STMInterface(SerialTool(port=port, baud=baud))
+
+
+class PortSession:
+    """A bootloader session on one port, with the queue and worker thread
+    which run its jobs in order. The session is opened on the first job and
+    then kept connected; it is only re-established after a job fails in a
+    way which suggests the link or device was lost, or the keepalive finds
+    a different device on the port
+
+    Args:
+        port (str): serial port
+        factory (callable): returns an unconnected STMInterface for a port
+        keepalive (float, optional): seconds idle before the session is probed
+            with GET ID and a UID read, None to disable.
+            Defaults to DAEMON_KEEPALIVE_S.
+    """
+
+    def __init__(self, port: str, factory, keepalive: float = DAEMON_KEEPALIVE_S):
+        self.port = port
+        self.factory = factory
+        self.keepalive = keepalive
+        self.stm = None
+        self.healthy = False
+        # (pid, uid) of the device the session was opened on
+        self.identity = None
+        self.jobs = queue.Queue()
+        self.metrics = {
+            "connects": 0,
+            "connect_time_s": 0.0,
+            "jobs_done": 0,
+            "jobs_failed": 0,
+            "busy_time_s": 0.0,
+            "keepalive_failures": 0,
+            "identity_changes": 0,
+        }
+        self._thread = Thread(target=self._work, name=f"session-{port}", daemon=True)
+        self._thread.start()
+
+    # ============ SESSION ============#
+
+    def _open(self) -> None:
+        """internal method: connect and identify the device, reusing the
+        open port where possible. A reopened port may have a different
+        device on it, so it is always identified afresh"""
+        start = monotonic()
+        if self.stm is None:
+            self.stm = self.factory(self.port)
+            connected = self.stm.connectToDevice()
+            refresh = False
+        else:
+            connected = self.stm.serialTool.reconnect()
+            self.stm.connected = connected
+            refresh = True
+        if not connected:
+            raise NoResponseError(f"No bootloader response on {self.port}")
+        self.stm.readDeviceInfo(refresh)
+        self.identity = (self.stm.device.pid, self.stm.device.uid)
+        self.healthy = True
+        self.metrics["connects"] += 1
+        self.metrics["connect_time_s"] += monotonic() - start
+
+    def _probe(self) -> None:
+        """internal method: check an idle session still answers, and that
+        the device answering is the one it was opened on. If the device has
+        changed its cached info is dropped and the session reopened"""
+        try:
+            identity = self._readIdentity()
+        except Exception:
+            identity = None
+        if identity is None:
+            self.healthy = False
+            self.metrics["keepalive_failures"] += 1
+            return
+        if identity == self.identity:
+            return
+
+        self.metrics["identity_changes"] += 1
+        self.stm.infoCache.invalidate(self.port)
+        self.healthy = False
+        try:
+            self._open()
+        except Exception:
+            # left unhealthy, the next job tries again
+            pass
+
+    def _readIdentity(self) -> tuple:
+        """internal method: read the (pid, uid) of the device on the port,
+        uid 0 if it cannot be read (readout protection). None if GET ID
+        fails"""
+        tool = self.stm.serialTool
+        success, rx = tool.cmdGetId()
+        if not success:
+            return None
+        pid = unpack16BitInt(rx)
+        try:
+            success, uid = tool.cmdReadFromMemoryAddress(
+                STM_F10X_UID_ADDR, STM_F10X_UID_LEN
+            )
+        except (NoResponseError, UnexpectedResponseError):
+            success = False
+        if not success or len(uid) != STM_F10X_UID_LEN:
+            return pid, 0
+        return pid, int.from_bytes(uid, "little")
+
+    def close(self) -> None:
+        """stop the worker once queued jobs are done and release the port"""
+        self.jobs.put(None)
+        self._thread.join()
+        if self.stm is not None and self.stm.serialTool is not None:
+            self.stm.serialTool.disconnect()
+            self.stm.serialTool.serial.close()
+        self.healthy = False
+
+    # ============ JOBS ============#
+
+    def _work(self) -> None:
+        """internal method: worker thread body"""
+        while True:
+            try:
+                job = self.jobs.get(timeout=self.keepalive)
+            except queue.Empty:
+                if self.healthy:
+                    self._probe()
+                continue
+            if job is None:
+                break
+            self._run(job)
+
+    def _run(self, job: Job) -> None:
+        """internal method: run one job, keeping the session if it survives"""
+        job.status = JOB_RUNNING
+        job.started = time()
+        start = monotonic()
+        try:
+            if not self.healthy:
+                self._open()
+            job.result = JOB_HANDLERS[job.kind](self.stm, job.params)
+            job.status = JOB_DONE
+            self.metrics["jobs_done"] += 1
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            job.status = JOB_FAILED
+            self.metrics["jobs_failed"] += 1
+            if not isinstance(e, JOB_INPUT_ERRORS):
+                self.healthy = False
+        job.finished = time()
+        # the payload is not needed once the job has run
+        job.params = None
+        self.metrics["busy_time_s"] += monotonic() - start
+        job.done.set()
+
+    def getMetrics(self) -> dict:
+        """session counters plus the current queue depth and health"""
+        return dict(self.metrics, queued=self.jobs.qsize(), healthy=self.healthy)
+
+
+# ============ JOB HANDLERS ============#
+
+
+def _decode(params: dict, key: str = "data") -> bytearray:
+    return bytearray(base64.b64decode(params[key]))
+
+
+def _padToWord(data: bytearray) -> bytearray:
+    """pad to a whole number of words with erased flash bytes"""
+    return data + bytearray([0xFF] * (-len(data) % 4))
+
+
+def _flashJob(stm: STMInterface, params: dict) -> dict:
+    address = int(params["address"])
+    data = _padToWord(_decode(params))
+    if params.get("unprotect", False):
+        success, changes = stm.unprotectForWrite([(address, len(data))])
+        if not success:
+            raise CommandFailedError("Unprotect failed")
+    if params.get("erase", True):
+        first = stm.device.getFlashPage(address)
+        last = stm.device.getFlashPage(address + len(data) - 1)
+        if not stm.eraseFlashPages(list(range(first, last + 1))):
+            raise CommandFailedError("Erase failed")
+    if not stm.writeToFlash(address, data):
+        raise CommandFailedError("Write failed")
+    result = {"address": address, "length": len(data)}
+    if params.get("verify", False):
+        result.update(_compare(stm, address, data))
+    return result
+
+
+def _compare(stm: STMInterface, address: int, data: bytearray) -> dict:
+    success, rx = stm.readFromFlash(address, len(data))
+    if not success:
+        raise CommandFailedError("Readback failed")
+    mismatch = next((i for i, (a, b) in enumerate(zip(data, rx)) if a != b), None)
+    return {
+        "match": mismatch is None,
+        "first_mismatch": None if mismatch is None else address + mismatch,
+    }
+
+
+def _verifyJob(stm: STMInterface, params: dict) -> dict:
+    return _compare(stm, int(params["address"]), _padToWord(_decode(params)))
+
+
+def _readJob(stm: STMInterface, params: dict) -> dict:
+    address = int(params["address"])
+    success, rx = stm.readFromFlash(address, int(params["length"]))
+    if not success:
+        raise CommandFailedError("Read failed")
+    return {"address": address, "data": base64.b64encode(bytes(rx)).decode()}
+
+
+def _optionBytesToDict(opt: OptionBytes) -> dict:
+    return {name: getattr(opt, name) for name in OPTION_BYTE_FIELDS}
+
+
+def _optionBytesJob(stm: STMInterface, params: dict) -> dict:
+    current = stm.getOptionBytes()
+    if current is None:
+        raise CommandFailedError("Unable to read option bytes")
+    settings = params.get("set")
+    if not settings:
+        return {"option_bytes": _optionBytesToDict(current), "changes": {}}
+
+    target = OptionBytes.FromBytes(bytes(current.rawBytes))
+    for name, value in settings.items():
+        if name not in OPTION_BYTE_FIELDS:
+            raise KeyError(f"Unknown option byte field {name}")
+        setattr(target, name, value)
+    success, changes = stm.applyOptionBytes(target)
+    if not success or not stm.connected:
+        raise CommandFailedError("Option byte write failed")
+    return {
+        "option_bytes": _optionBytesToDict(stm.getOptionBytes()),
+        "changes": {name: list(values) for name, values in changes.items()},
+    }
+
+
+JOB_HANDLERS = {
+    JOB_FLASH: _flashJob,
+    JOB_VERIFY: _verifyJob,
+    JOB_READ: _readJob,
+    JOB_OPTION_BYTES: _optionBytesJob,
+}
+
+
+class SessionPool:
+    """Port -> PortSession map. Sessions are created on first use and live
+    until the pool is closed
+
+    Args:
+        factory (callable, optional): returns an unconnected STMInterface for a
+            port. Defaults to openSerialSession.
+        keepalive (float, optional): see PortSession. Defaults to DAEMON_KEEPALIVE_S.
+    """
+
+    def __init__(self, factory=None, keepalive: float = DAEMON_KEEPALIVE_S):
+        self.factory = openSerialSession if factory is None else factory
+        self.keepalive = keepalive
+        self.sessions = {}
+        self._lock = Lock()
+
+    def get(self, port: str) -> PortSession:
+        """get the session for a port, creating it if needed"""
+        with self._lock:
+            session = self.sessions.get(port)
+            if session is None:
+                session = PortSession(port, self.factory, self.keepalive)
+                self.sessions[port] = session
+            return session
+
+    def close(self) -> None:
+        """close every session"""
+        with self._lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
+
+
+class ProvisioningDaemon:
+    """Accepts jobs, queues them on the session for their port and keeps
+    the results for polling. Finished jobs are forgotten, oldest first, once
+    there are more than keepJobs of them or they are older than jobTtl
+
+    Args:
+        pool (SessionPool, optional): session pool. Defaults to a serial port pool.
+        keepJobs (int, optional): finished jobs kept. Defaults to DAEMON_KEEP_JOBS.
+        jobTtl (float, optional): seconds a finished job is kept, None to keep
+            them until keepJobs is reached. Defaults to DAEMON_JOB_TTL_S.
+    """
+
+    def __init__(
+        self,
+        pool: SessionPool = None,
+        keepJobs: int = DAEMON_KEEP_JOBS,
+        jobTtl: float = DAEMON_JOB_TTL_S,
+    ):
+        self.pool = SessionPool() if pool is None else pool
+        self.keep_jobs = keepJobs
+        self.job_ttl = jobTtl
+        self.jobs = {}
+        self._ids = count(1)
+        self._lock = Lock()
+        self._servers = []
+        self.started = monotonic()
+
+    def submit(self, port: str, kind: str, params: dict = None) -> Job:
+        """queue a job
+
+        Args:
+            port (str): port the target device is on
+            kind (str): one of JOB_KINDS
+            params (dict, optional): job parameters. Defaults to None.
+
+        Raises:
+            ValueError: unknown job kind
+
+        Returns:
+            Job: the queued job
+        """
+        if kind not in JOB_HANDLERS:
+            raise ValueError(f"Unknown job kind {kind}")
+        with self._lock:
+            self._prune()
+            job = Job(next(self._ids), port, kind, params or {})
+            self.jobs[job.id] = job
+        self.pool.get(port).jobs.put(job)
+        return job
+
+    def getJob(self, job_id: int) -> Job:
+        """get a job by id, None if unknown or forgotten"""
+        with self._lock:
+            self._prune()
+            return self.jobs.get(job_id)
+
+    def _prune(self) -> None:
+        """internal method: forget finished jobs past the retention limits.
+        Called with the lock held"""
+        finished = sorted(
+            (job for job in self.jobs.values() if job.finished is not None),
+            key=lambda job: job.finished,
+        )
+        excess = len(finished) - self.keep_jobs
+        cutoff = None if self.job_ttl is None else time() - self.job_ttl
+        for i, job in enumerate(finished):
+            if i < excess or (cutoff is not None and job.finished < cutoff):
+                del self.jobs[job.id]
+
+    def wait(self, job_id: int, timeout: float = None) -> Job:
+        """wait for a job to finish
+
+        Returns:
+            Job: the job, which may still be running if the timeout expired
+        """
+        job = self.getJob(job_id)
+        if job is not None:
+            job.done.wait(timeout)
+        return job
+
+    def getMetrics(self) -> dict:
+        """job counts by status plus per-port session metrics"""
+        with self._lock:
+            self._prune()
+            statuses = [job.status for job in self.jobs.values()]
+        return {
+            "uptime_s": monotonic() - self.started,
+            "jobs": {
+                s: statuses.count(s)
+                for s in (JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED)
+            },
+            "ports": {
+                port: session.getMetrics()
+                for port, session in list(self.pool.sessions.items())
+            },
+        }
+
+    # ============ API ============#
+
+    def serve(self, address) -> object:
+        """start serving the JSON API in a background thread
+
+        Args:
+            address: (host, port) for HTTP on TCP, or a path for HTTP on a Unix socket.
+                Port 0 picks a free port, see server.server_address.
+
+        Returns:
+            the server object
+        """
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.unlink(address)
+            server = _UnixHTTPServer(address, _ApiHandler)
+        else:
+            server = ThreadingHTTPServer(tuple(address), _ApiHandler)
+        server.daemon_threads = True
+        server.provisioner = self
+        Thread(target=server.serve_forever, name="daemon-api", daemon=True).start()
+        self._servers.append(server)
+        return server
+
+    def shutdown(self) -> None:
+        """stop the API servers and close all sessions"""
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+            if isinstance(server, _UnixHTTPServer):
+                os.unlink(server.server_address)
+        self._servers = []
+        self.pool.close()
+
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    pass
+
+
+class _ApiHandler(BaseHTTPRequestHandler):
+    """
+    POST /jobs          {"port", "kind", "params"} -> job
+    GET  /jobs/<id>     job, add ?wait=<seconds> to block until it finishes
+    GET  /metrics       daemon metrics
+    GET  /ports         ports with a session
+    """
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _reply(self, status: int, body) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self) -> None:
+        daemon = self.server.provisioner
+        path, _, query = self.path.partition("?")
+        parts = path.strip("/").split("/")
+
+        if parts == ["metrics"]:
+            self._reply(200, daemon.getMetrics())
+        elif parts == ["ports"]:
+            self._reply(200, sorted(daemon.pool.sessions))
+        elif len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+            args = dict(p.partition("=")[::2] for p in query.split("&") if p)
+            try:
+                timeout = float(args["wait"]) if "wait" in args else 0
+            except ValueError:
+                self._reply(400, {"error": "wait must be a number"})
+                return
+            job = daemon.wait(int(parts[1]), timeout)
+            if job is None:
+                self._reply(404, {"error": "no such job"})
+            else:
+                self._reply(200, job.toDict())
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self) -> None:
+        if self.path.rstrip("/") != "/jobs":
+            self._reply(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            job = self.server.provisioner.submit(
+                request["port"], request["kind"], request.get("params")
+            )
+        except (KeyError, ValueError, TypeError, AttributeError) as e:
+            self._reply(400, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self._reply(202, job.toDict())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="STM32F10x provisioning daemon")
+    parser.add_argument("--host", default="127.0.0.1", help="HTTP listen address")
+    parser.add_argument("--port", type=int, default=8732, help="HTTP listen port")
+    parser.add_argument("--socket", help="serve on this Unix socket instead of HTTP")
+    parser.add_argument(
+        "--baud", type=int, default=DAEMON_DEFAULT_BAUD, help="bootloader baud rate"
+    )
+    parser.add_argument(
+        "--keep-jobs",
+        type=int,
+        default=DAEMON_KEEP_JOBS,
+        help="finished jobs kept for polling",
+    )
+    parser.add_argument(
+        "--job-ttl",
+        type=float,
+        default=DAEMON_JOB_TTL_S,
+        help="seconds a finished job is kept for polling",
+    )
+    args = parser.parse_args()
+
+    pool = SessionPool(lambda port: openSerialSession(port, args.baud))
+    daemon = ProvisioningDaemon(pool, args.keep_jobs, args.job_ttl)
+    daemon.serve(args.socket if args.socket else (args.host, args.port))
+    try:
+        Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,11 +5,21 @@ a fuller description.
 
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from struct import unpack, pack
 from enum import Enum
-from dataclasses import dataclass
 from collections import namedtuple
+from .constants import (
+    STM_F10X_FLASH_START,
+    STM_F10X_OPTBYTES_ADDR,
+    STM_F10X_WRP_SECTOR_SIZE,
+    STM_CMD_EXT_ERASE,
+    STM_EXT_ERASE_MASS,
+    STM_EXT_ERASE_BANK1,
+    STM_EXT_ERASE_BANK2,
+    STM_ERASE_MAX_PAGES,
+    STM_EXT_ERASE_MAX_PAGES,
+)
 from .errors import DeviceNotSupportedError, InvalidAddressError
 from .utilities import getByteComplement, setBit, clearBit
 
@@ -35,8 +45,25 @@ FlashOptionBytes = namedtuple(
     ],
 )
 
+# the option-byte settings compared by OptionBytes.diff
+OPTION_BYTE_FIELDS = (
+    "read_protect",
+    "watchdog_type",
+    "reset_on_stop",
+    "reset_on_standby",
+    "data_byte_0",
+    "data_byte_1",
+    "write_protect_0",
+    "write_protect_1",
+    "write_protect_2",
+    "write_protect_3",
+)
+
+# a single erase command - either a special erase code or a list of pages
+EraseBatch = namedtuple("EraseBatch", ["special", "pages"])
 
-@dataclass
+
+@dataclass(frozen=True)
 class Region:
     """describes a region of memory space on the device"""
 
@@ -178,7 +205,9 @@ class OptionBytes:
         Returns:
             int: assembled user-byte
         """
-        userbyte = 0x00
+        # keep the bits this class doesn't model, so a read-modify-write
+        # of the option bytes leaves them untouched
+        userbyte = self.user & 0xF8
         userbyte = (
             setBit(userbyte, 0) if self.watchdog_type > 0 else clearBit(userbyte, 0)
         )
@@ -429,6 +458,54 @@ class OptionBytes:
         self.write_protect_3 = data & 0xFF
         self.updateRawBytes()
 
+    @property
+    def writeProtectBits(self) -> int:
+        """getter for the 32 write-protect bits, WRP0 in the low byte. A
+        cleared bit means the sector is protected
+
+        Returns:
+            int: write protect bits
+        """
+        return (
+            self.write_protect_0
+            | (self.write_protect_1 << 8)
+            | (self.write_protect_2 << 16)
+            | (self.write_protect_3 << 24)
+        )
+
+    @writeProtectBits.setter
+    def writeProtectBits(self, bits: int) -> None:
+        """setter for the 32 write-protect bits
+
+        Args:
+            bits (int): write protect bits, WRP0 in the low byte
+        """
+        self.write_protect_0 = bits & 0xFF
+        self.write_protect_1 = (bits >> 8) & 0xFF
+        self.write_protect_2 = (bits >> 16) & 0xFF
+        self.write_protect_3 = (bits >> 24) & 0xFF
+        self.updateRawBytes()
+
+    def getWriteProtectedSectors(self) -> list:
+        """get the write-protected sectors
+
+        Returns:
+            list: protected sector indexes (0 - 31)
+        """
+        bits = self.writeProtectBits
+        return [i for i in range(32) if not (bits >> i) & 0b1]
+
+    def setWriteProtectedSectors(self, sectors: list) -> None:
+        """write-protect the listed sectors and unprotect all others
+
+        Args:
+            sectors (list): sector indexes to protect (0 - 31)
+        """
+        bits = 0xFFFFFFFF
+        for sector in sectors:
+            bits &= ~(1 << sector)
+        self.writeProtectBits = bits
+
     def enableWriteProtect(self) -> None:
         self.write_protect_0 = 0
         self.write_protect_1 = 0
@@ -443,6 +520,29 @@ class OptionBytes:
         self.write_protect_3 = 0xFF
         self.updateRawBytes()
 
+    def diff(self, target: OptionBytes) -> dict:
+        """compare settings against a target configuration. Read protect is
+        compared as enabled/disabled, since any value other than 0xA5 enables it
+
+        Args:
+            target (OptionBytes): the desired option bytes
+
+        Returns:
+            dict: field name -> (current value, target value) for each
+            setting which differs
+        """
+        changes = {}
+        for name in OPTION_BYTE_FIELDS:
+            current_value = getattr(self, name)
+            target_value = getattr(target, name)
+            if name == "read_protect":
+                differs = self.readProtect != target.readProtect
+            else:
+                differs = current_value != target_value
+            if differs:
+                changes[name] = (current_value, target_value)
+        return changes
+
     def dumpOptionBytes(self) -> None:
         print(f"nUser [{getByteComplement(self.user)}] user [{self.user}]", end="\t")
         print(f"Wdt type: {'software' if self.watchdog_type else 'hardware'}", end="\t")
@@ -460,33 +560,171 @@ class OptionBytes:
         return output
 
 
-class DeviceType:
+@dataclass(frozen=True)
+class DeviceDescriptor:
+    """immutable description of a device family's memory layout. A single
+    descriptor is shared by every DeviceType with the same product ID, so
+    nothing on it may be modified after registration
+    """
 
+    pid: int
     name: str
     ram: Region
     bootloader_ram: Region
-    pid: int
-    uid: int = 0
     system_memory: Region
-
-    # 512 * 2kb XL density
-    # 256 * 2kb high density
-    # 128 * 1kb medium density
-    # 32 * 1kb low density
-    # 128 * 2kb connectivity density
     flash_page_size: int
     flash_page_num: int
-
-    # 770 * 64bits XL
-    # 2360 Connectivity
-    # 258 rest
     flash_info_blk_size: int
+    flash_bank_num: int = 1
+    flash_memory: Region = field(init=False)
+    flash_pages: tuple = field(init=False, repr=False)
+    wrp_sectors: tuple = field(init=False, repr=False)
+    wrp_page_sector: tuple = field(init=False, repr=False)
+
+    def __post_init__(self):
+        flash_memory = Region(
+            "flash memory",
+            STM_F10X_FLASH_START,
+            STM_F10X_FLASH_START + (self.flash_page_num * self.flash_page_size),
+        )
+        flash_pages = tuple(
+            Region(
+                f"flash_page_{i}",
+                start=flash_memory.start + (i * self.flash_page_size),
+                end=flash_memory.start + ((i + 1) * self.flash_page_size),
+            )
+            for i in range(self.flash_page_num)
+        )
+        # each write-protect bit covers 4kB of flash, except the last bit on
+        # devices with more than 32 sectors, which covers the rest of the flash
+        pages_per_sector = max(1, STM_F10X_WRP_SECTOR_SIZE // self.flash_page_size)
+        sector_num = min(32, -(-self.flash_page_num // pages_per_sector))
+        wrp_sectors = tuple(
+            range(
+                i * pages_per_sector,
+                (
+                    self.flash_page_num
+                    if i == sector_num - 1
+                    else (i + 1) * pages_per_sector
+                ),
+            )
+            for i in range(sector_num)
+        )
+        wrp_page_sector = tuple(
+            sector for sector, pages in enumerate(wrp_sectors) for _ in pages
+        )
+        # frozen dataclass, so bypass __setattr__ for the derived fields
+        object.__setattr__(self, "flash_memory", flash_memory)
+        object.__setattr__(self, "flash_pages", flash_pages)
+        object.__setattr__(self, "wrp_sectors", wrp_sectors)
+        object.__setattr__(self, "wrp_page_sector", wrp_page_sector)
+
+
+# (pid, name, ram start, ram end, bootloader ram end, system memory start,
+#  flash page size, flash page count, flash info block size, flash banks)
+#
+# 512 * 2kb XL density
+# 256 * 2kb high density
+# 128 * 1kb medium density
+# 32 * 1kb low density
+# 770 * 64bits info block XL, 258 the rest
+# fmt: off
+DEVICE_TABLE = (
+    (0x0412, "stm32f10xxxLowDensity", 0x20000200, 0x200027FF, 0x200001FF, 0x1FFFF000, 1024, 32, 258, 1),
+    (0x0410, "stm32f10xxxMedDensity", 0x20000200, 0x20004FFF, 0x200001FF, 0x1FFFF000, 1024, 128, 258, 1),
+    (0x0414, "stm32f10xxxHighDensity", 0x20000200, 0x2000FFFF, 0x200001FF, 0x1FFFF000, 2048, 256, 258, 1),
+    (0x0420, "stm32f10xxxMedDensityValueLine", 0x20000200, 0x20001FFF, 0x200001FF, 0x1FFFF000, 1024, 128, 258, 1),
+    (0x0428, "stm32f10xxxHighDensityValueLine", 0x20000200, 0x20007FFF, 0x200001FF, 0x1FFFF000, 2048, 256, 258, 1),
+    (0x0430, "stm32f10xxxXlDensity", 0x20000800, 0x20017FFF, 0x200007FF, 0x1FFFE000, 2048, 512, 770, 2),
+)
+# fmt: on
+
+_device_registry = {}
+
+
+def registerDevice(descriptor: DeviceDescriptor) -> None:
+    """add a device descriptor to the registry, replacing any existing
+    descriptor with the same product ID
+
+    Args:
+        descriptor (DeviceDescriptor): the device descriptor
+    """
+    _device_registry[descriptor.pid] = descriptor
+
+
+def unregisterDevice(pid: int) -> DeviceDescriptor:
+    """remove a device descriptor from the registry
+
+    Args:
+        pid (int): product ID of the descriptor
+
+    Returns:
+        DeviceDescriptor: the removed descriptor, or None if none was registered
+    """
+    return _device_registry.pop(pid, None)
+
+
+def getDeviceDescriptor(pid: int) -> DeviceDescriptor:
+    """look up the shared descriptor for a product ID
+
+    Args:
+        pid (int): ID read from the device
 
-    # 4kbB * 64bit low density
-    # 16kB * 64bits med
-    # 64kB * 64bits high
-    # 32kB * 64 conn
-    flash_mem_size: int
+    Raises:
+        DeviceNotSupportedError: Device ID is not currently supported
+
+    Returns:
+        DeviceDescriptor: the registered descriptor
+    """
+    try:
+        return _device_registry[pid]
+    except KeyError:
+        raise DeviceNotSupportedError("Either an invalid or unsupported product")
+
+
+def _loadDeviceTable() -> None:
+    for (
+        pid,
+        name,
+        ram_start,
+        ram_end,
+        bootloader_ram_end,
+        system_memory_start,
+        page_size,
+        page_num,
+        info_blk_size,
+        bank_num,
+    ) in DEVICE_TABLE:
+        registerDevice(
+            DeviceDescriptor(
+                pid=pid,
+                name=name,
+                ram=Region("ram", ram_start, ram_end),
+                bootloader_ram=Region("bootloader ram", 0x20000000, bootloader_ram_end),
+                system_memory=Region("system memory", system_memory_start, 0x1FFFF7FF),
+                flash_page_size=page_size,
+                flash_page_num=page_num,
+                flash_info_blk_size=info_blk_size,
+                flash_bank_num=bank_num,
+            )
+        )
+
+
+_loadDeviceTable()
+
+# the flash option bytes should be read in their entirety
+# so use region rather than Register
+FLASH_OPTION_BYTES = Region(
+    "OptionBytes", STM_F10X_OPTBYTES_ADDR, STM_F10X_OPTBYTES_ADDR + 16
+)
+
+
+class DeviceType:
+    """model of the connected device. The memory layout comes from the
+    shared DeviceDescriptor registered for the device's product ID
+    """
+
+    uid: int = 0
 
     def __init__(self, pid: int, bootloaderVersion: float) -> DeviceType:
         """constructor for the DeviceType
@@ -500,78 +738,98 @@ class DeviceType:
             DeviceNotSupportedError: Device ID is not currently supported. See README for
             supported devices
         """
-        # same across most devices, intialise first, overwrite if neccesary
-        self.pid = pid
+        self.descriptor = getDeviceDescriptor(pid)
         self.bootloaderVersion = bootloaderVersion
-        self.bootloader_ram = Region("bootloader ram", 0x20000000, 0x200001FF)
-        self.system_memory = Region("system memory", 0x1FFFF000, 0x1FFFF7FF)
-
-        # select device characteristics from pid
-        if self.pid == 0x0412:
-            self.name = "stm32f10xxxLowDensity"
-            self.ram = Region("ram", 0x20000200, 0x200027FF)
-            self.flash_page_size = 1024
-            self.flash_page_num = 32
-            self.flash_info_blk_size = 258
-        elif self.pid == 0x0410:
-            self.name = "stm32f10xxxMedDensity"
-            self.ram = Region("ram", 0x20000200, 0x20004FFF)
-            self.flash_page_size = 1024
-            self.flash_page_num = 128
-            self.flash_info_blk_size = 258
-        elif self.pid == 0x0414:
-            self.name = "stm32f10xxxHighDensity"
-            self.ram = Region("ram", 0x20000200, 0x2000FFFF)
-            self.flash_page_size = 2048
-            self.flash_page_num = 256
-            self.flash_info_blk_size = 258
-        elif self.pid == 0x0420:
-            self.name = "stm32f10xxxMedDensityValueLine"
-            self.ram = Region("ram", 0x20000200, 0x20001FFF)
-            self.flash_page_size = 1024
-            self.flash_page_num = 128
-            self.flash_info_blk_size = 258
-        elif self.pid == 0x0428:
-            self.name = "stm32f10xxxHighDensityValueLine"
-            self.ram = Region("ram", 0x20000200, 0x20007FFF)
-            self.flash_page_size = 2048
-            self.flash_page_num = 256
-            self.flash_info_blk_size = 258
-        elif self.pid == 0x0430:
-            self.name = "stm32f10xxxXlDensity"
-            self.ram = Region("ram", 0x20000800, 0x20017FFF)
-            self.system_memory = Region("system memory", 0x1FFFF000, 0x1FFF77FF)
-            self.flash_page_size = 2048
-            self.flash_page_num = 256
-            self.flash_info_blk_size = 258
-            self.bootloader_ram = Region("bootloader ram", 0x20000000, 0x200007FF)
-        else:
-            raise DeviceNotSupportedError("Either an invalid or unsupported product")
+        self.flash_option_bytes = FLASH_OPTION_BYTES
 
-        # flash memory region common
-        self.flash_memory = Region(
-            "flash memory",
-            0x08000000,
-            (0x08000000 + (self.flash_page_num * self.flash_page_size)),
-        )
+        # command codes advertised by the bootloader's GET response
+        self.capabilities = frozenset()
 
-        self.flash_pages = []
-        for i in range(self.flash_page_num):
-            self.flash_pages.append(
-                Region(
-                    f"flash_page_{i}",
-                    start=(self.flash_memory.start + (i * self.flash_page_size)),
-                    end=(self.flash_memory.start + (i * self.flash_page_size))
-                    + self.flash_page_size,
-                )
-            )
+        # fill this in on demand, opt_bytes_valid is set once read from the device
+        self.opt_bytes = OptionBytes.FromAttributes()
+        self.opt_bytes_valid = False
 
-        # the flash option bytes should be read in their entirety
-        # so use region rather than Register
-        self.flash_option_bytes = Region("OptionBytes", 0x1FFFF800, 0x1FFF800 + 16)
+    @property
+    def pid(self) -> int:
+        """device product ID"""
+        return self.descriptor.pid
 
-        # fill this in on demand
-        self.opt_bytes = OptionBytes.FromAttributes()
+    @property
+    def name(self) -> str:
+        """device name"""
+        return self.descriptor.name
+
+    @property
+    def ram(self) -> Region:
+        """user-accessible ram region"""
+        return self.descriptor.ram
+
+    @property
+    def bootloader_ram(self) -> Region:
+        """ram region reserved by the bootloader"""
+        return self.descriptor.bootloader_ram
+
+    @property
+    def system_memory(self) -> Region:
+        """system memory region"""
+        return self.descriptor.system_memory
+
+    @property
+    def flash_page_size(self) -> int:
+        """flash page size in bytes"""
+        return self.descriptor.flash_page_size
+
+    @property
+    def flash_page_num(self) -> int:
+        """number of flash pages"""
+        return self.descriptor.flash_page_num
+
+    @property
+    def flash_info_blk_size(self) -> int:
+        """flash information block size"""
+        return self.descriptor.flash_info_blk_size
+
+    @property
+    def flash_memory(self) -> Region:
+        """flash memory region"""
+        return self.descriptor.flash_memory
+
+    @property
+    def flash_pages(self) -> tuple:
+        """tuple of flash page regions"""
+        return self.descriptor.flash_pages
+
+    @property
+    def wrp_sectors(self) -> tuple:
+        """tuple of page ranges covered by each write-protect bit"""
+        return self.descriptor.wrp_sectors
+
+    def getFlashPage(self, address: int) -> int:
+        """get the index of the flash page containing an address
+
+        Args:
+            address (int): flash address
+
+        Raises:
+            InvalidAddressError: address is not in flash memory
+
+        Returns:
+            int: page index
+        """
+        if not self.flash_memory.is_valid(address):
+            raise InvalidAddressError(f"Address {hex(address)} is not in flash memory")
+        return (address - self.flash_memory.start) // self.flash_page_size
+
+    def getWriteProtectSector(self, page: int) -> int:
+        """get the write-protect sector (option byte WRP bit) covering a page
+
+        Args:
+            page (int): page index
+
+        Returns:
+            int: sector index
+        """
+        return self.descriptor.wrp_page_sector[page]
 
     def updateOptionBytes(self, data: bytearray) -> None:
         """create the OptionBytes object
@@ -580,6 +838,11 @@ class DeviceType:
             data (bytearray): raw optionbytes data
         """
         self.opt_bytes = OptionBytes.FromBytes(data)
+        self.opt_bytes_valid = True
+
+    def invalidateOptionBytes(self) -> None:
+        """mark the option bytes as stale, e.g. after a device reset"""
+        self.opt_bytes_valid = False
 
     def getFlashPageAddress(self, page: int) -> int:
         """get the address for a particular flash page
@@ -592,6 +855,102 @@ class DeviceType:
         """
         if page >= self.flash_page_num:
             raise InvalidAddressError(
-                f"Invalid flash page requested (max {self.flash_pages_num-1})"
+                f"Invalid flash page requested (max {self.flash_page_num-1})"
             )
         return self.flash_pages[page].start
+
+    def supportsCommand(self, command: int) -> bool:
+        """check if the bootloader advertised a command
+
+        Args:
+            command (int): command code
+
+        Returns:
+            bool: command supported
+        """
+        return command in self.capabilities
+
+    def getFlashBankPages(self, bank: int) -> range:
+        """get the range of pages in a flash bank
+
+        Args:
+            bank (int): bank index, from 0
+
+        Raises:
+            InvalidAddressError: the device does not have this bank
+
+        Returns:
+            range: page indexes in the bank
+        """
+        if bank < 0 or bank >= self.descriptor.flash_bank_num:
+            raise InvalidAddressError(f"Device has no flash bank {bank}")
+        bank_pages = self.flash_page_num // self.descriptor.flash_bank_num
+        return range(bank * bank_pages, (bank + 1) * bank_pages)
+
+    def countErasedPages(self, batch: EraseBatch) -> int:
+        """the number of pages an erase command clears
+
+        Args:
+            batch (EraseBatch): the erase command
+
+        Returns:
+            int: pages erased
+        """
+        if batch.pages is not None:
+            return len(batch.pages)
+        if batch.special == STM_EXT_ERASE_BANK1:
+            return len(self.getFlashBankPages(0))
+        if batch.special == STM_EXT_ERASE_BANK2:
+            return len(self.getFlashBankPages(1))
+        return self.flash_page_num
+
+    def planFlashErase(self, pages: list) -> list:
+        """split a set of pages into the fewest erase commands. Whole-device
+        and, with extended erase, whole-bank erases use the special codes
+
+        Args:
+            pages (list): page indexes to erase
+
+        Raises:
+            InvalidAddressError: page out of range, or not addressable by
+                the legacy erase command
+
+        Returns:
+            list: EraseBatch commands to send
+        """
+        pages = sorted(set(pages))
+        if len(pages) < 1:
+            return []
+        if pages[0] < 0 or pages[-1] >= self.flash_page_num:
+            raise InvalidAddressError(
+                f"Invalid flash page requested (max {self.flash_page_num-1})"
+            )
+
+        extended = self.supportsCommand(STM_CMD_EXT_ERASE)
+
+        if len(pages) == self.flash_page_num:
+            return [EraseBatch(STM_EXT_ERASE_MASS, None)]
+
+        batches = []
+        if extended and self.descriptor.flash_bank_num == 2:
+            remaining = set(pages)
+            for bank, code in enumerate((STM_EXT_ERASE_BANK1, STM_EXT_ERASE_BANK2)):
+                bank_pages = self.getFlashBankPages(bank)
+                if remaining.issuperset(bank_pages):
+                    batches.append(EraseBatch(code, None))
+                    remaining.difference_update(bank_pages)
+            pages = sorted(remaining)
+
+        if extended:
+            max_pages = STM_EXT_ERASE_MAX_PAGES
+        else:
+            if pages and pages[-1] > 0xFF:
+                raise InvalidAddressError(
+                    "Legacy erase command can only address pages 0 - 255"
+                )
+            max_pages = STM_ERASE_MAX_PAGES
+
+        for i in range(0, len(pages), max_pages):
+            batches.append(EraseBatch(None, pages[i : i + max_pages]))
+
+        return batches
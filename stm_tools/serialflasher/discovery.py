@@ -0,0 +1,179 @@
+"""
+ file  discovery.py
+ Description: Finds STM32 bootloaders on the host's serial ports. Candidate
+ ports are probed concurrently with a short handshake timeout, so probing
+ many ports takes about as long as probing one.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from threading import Event
+from serial import Serial
+from serial.tools.list_ports import comports
+from .constants import *
+from .errors import *
+from .cache import BootloaderInfo, DeviceInfoCache
+from .devices import getDeviceDescriptor
+from .serialtool import SerialTool
+from .stmdevice import STMInterface
+from .transport import openTransport
+
+
+@dataclass(frozen=True)
+class ProbeResult:
+    """a bootloader found on a port"""
+
+    port: str
+    info: BootloaderInfo
+    name: str = None
+
+    @property
+    def pid(self) -> int:
+        return self.info.pid
+
+    @property
+    def version(self) -> float:
+        return self.info.version
+
+    @property
+    def uid(self) -> int:
+        return self.info.uid
+
+
+def openSerialPort(port: str, baud: int) -> Serial:
+    """default port opener for probing, ports may be bridge URLs"""
+    return openTransport(port, baud, timeout=1.0, write_timeout=1.0)
+
+
+def listCandidatePorts() -> list:
+    """list the serial ports the host knows about
+
+    Returns:
+        list: port device names
+    """
+    return sorted(p.device for p in comports())
+
+
+def probePort(
+    port: str,
+    baud: int = STM_PROBE_BAUD,
+    timeout: float = STM_PROBE_TIMEOUT_S,
+    opener=None,
+) -> ProbeResult:
+    """check a port for an STM32 bootloader and identify it. The device is
+    not reset, so it must already be running the bootloader
+
+    Args:
+        port (str): port to probe
+        baud (int, optional): baud rate. Defaults to STM_PROBE_BAUD.
+        timeout (float, optional): seconds to wait for the handshake. Defaults to
+            STM_PROBE_TIMEOUT_S.
+        opener (callable, optional): opener(port, baud) returns an open pyserial-like
+            object. Defaults to openSerialPort.
+
+    Returns:
+        ProbeResult: the device found, or None if nothing answered
+    """
+    opener = openSerialPort if opener is None else opener
+    try:
+        serial = opener(port, baud)
+    except (OSError, ValueError):
+        # missing, busy or not a serial port
+        return None
+
+    try:
+        tool = SerialTool(serial=serial)
+        if not tool.reconnect(STM_RESET_DTR, timeout):
+            return None
+        stm = STMInterface(tool, infoCache=DeviceInfoCache())
+        stm.connected = True
+        stm.readDeviceInfo()
+        try:
+            stm.readDeviceUid()
+        except Exception:
+            # readout protected devices refuse the read, leave the UID unknown
+            pass
+        info = stm.infoCache.get(tool.getPort())
+    except Exception:
+        # something answered, but not a bootloader we can identify
+        return None
+    finally:
+        serial.close()
+
+    try:
+        name = getDeviceDescriptor(info.pid).name
+    except DeviceNotSupportedError:
+        name = None
+    return ProbeResult(port, info, name)
+
+
+def discoverDevices(
+    ports: list = None,
+    baud: int = STM_PROBE_BAUD,
+    timeout: float = STM_PROBE_TIMEOUT_S,
+    opener=None,
+    maxWorkers: int = STM_PROBE_MAX_WORKERS,
+) -> list:
+    """probe ports concurrently for STM32 bootloaders
+
+    Args:
+        ports (list, optional): ports to probe. Defaults to every port on the host.
+        baud (int, optional): baud rate. Defaults to STM_PROBE_BAUD.
+        timeout (float, optional): per-port handshake timeout. Defaults to
+            STM_PROBE_TIMEOUT_S.
+        opener (callable, optional): see probePort. Defaults to openSerialPort.
+        maxWorkers (int, optional): most ports probed at once. Defaults to
+            STM_PROBE_MAX_WORKERS.
+
+    Returns:
+        list: ProbeResult for each port with a bootloader, in port order
+    """
+    ports = listCandidatePorts() if ports is None else sorted(ports)
+    if not ports:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(len(ports), maxWorkers)) as pool:
+        results = pool.map(lambda p: probePort(p, baud, timeout, opener), ports)
+        return [result for result in results if result is not None]
+
+
+def watchDevices(
+    interval: float = STM_PROBE_WATCH_INTERVAL_S,
+    stop: Event = None,
+    lister=None,
+    **probeArgs,
+):
+    """watch for adapters being plugged in and removed. Existing ports are
+    reported first, then each new port is probed when it appears. A port
+    which did not answer is probed again only after it is replugged
+
+    Args:
+        interval (float, optional): seconds between port scans. Defaults to
+            STM_PROBE_WATCH_INTERVAL_S.
+        stop (Event, optional): set to stop watching. Defaults to None (watch forever).
+        lister (callable, optional): returns the current ports. Defaults to
+            listCandidatePorts.
+        probeArgs: passed to discoverDevices
+
+    Yields:
+        tuple: ("added", ProbeResult) or ("removed", port)
+    """
+    stop = Event() if stop is None else stop
+    lister = listCandidatePorts if lister is None else lister
+    known = set()
+    found = set()
+
+    while not stop.is_set():
+        ports = set(lister())
+        for port in sorted(found - ports):
+            found.discard(port)
+            yield "removed", port
+        new = ports - known
+        known = ports
+        if new:
+            for result in discoverDevices(sorted(new), **probeArgs):
+                found.add(result.port)
+                yield "added", result
+        stop.wait(interval)
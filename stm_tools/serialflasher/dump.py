@@ -0,0 +1,226 @@
+"""
+ file  dump.py
+ Description: Memory dumps written straight into a preallocated,
+ memory-mapped output file as blocks arrive. A sidecar file next to the
+ dump holds a bitmap of the blocks completed so far, so a dump interrupted
+ by a dropped link resumes where it stopped instead of starting over.
+
+ Sparse dumps leave blocks which read back as erased flash (all 0xFF)
+ unwritten, as holes in the file, and mark them in a second bitmap. The
+ sidecar is kept once a sparse dump completes, since it is needed to tell
+ holes from real zeros: loadDump reads either kind of dump back.
+
+ Sidecar layout (little endian):
+    header      magic, format version, flags, region address, region length,
+                block size
+    done        one bit per block, set once the block is in the dump
+    erased      one bit per block, set for sparse blocks of 0xFF
+"""
+
+from __future__ import annotations
+
+import mmap
+import os
+import struct
+from .errors import *
+
+DUMP_SIDECAR_MAGIC = b"STMD"
+DUMP_SIDECAR_VERSION = 1
+DUMP_SIDECAR_HEADER = struct.Struct("<4sHHIII")
+DUMP_SIDECAR_SUFFIX = ".blocks"
+DUMP_FLAG_SPARSE = 0x01
+# bytes per block: the unit resumed and, for sparse dumps, left as a hole
+DUMP_BLOCK_SIZE = 4096
+
+
+def sidecarPath(path: str) -> str:
+    """the sidecar file kept alongside a dump"""
+    return path + DUMP_SIDECAR_SUFFIX
+
+
+class DumpFile:
+    """An output file being filled with a memory region a block at a time.
+    If a sidecar from an unfinished dump of the same region with the same
+    settings exists the dump resumes, otherwise the file is created afresh
+
+    Args:
+        path (str): output file
+        address (int): address of the region
+        length (int): bytes in the region
+        blockSize (int, optional): bytes per block. Defaults to DUMP_BLOCK_SIZE.
+        sparse (bool, optional): leave erased blocks as holes. Defaults to False.
+        resume (bool, optional): continue an unfinished dump. Defaults to True.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        address: int,
+        length: int,
+        blockSize: int = DUMP_BLOCK_SIZE,
+        sparse: bool = False,
+        resume: bool = True,
+    ):
+        if length <= 0 or blockSize <= 0:
+            raise InvalidReadLengthError("Dump length and block size must be positive")
+        self.path = path
+        self.address = address
+        self.length = length
+        self.block_size = blockSize
+        self.sparse = sparse
+        self.blocks = -(-length // blockSize)
+        self._bitmap = -(-self.blocks // 8)
+        self._data = None
+        self._map = None
+
+        header = DUMP_SIDECAR_HEADER.pack(
+            DUMP_SIDECAR_MAGIC,
+            DUMP_SIDECAR_VERSION,
+            DUMP_FLAG_SPARSE if sparse else 0,
+            address,
+            length,
+            blockSize,
+        )
+        sidecar_size = len(header) + 2 * self._bitmap
+        if resume:
+            old = self._readSidecar(sidecarPath(path))
+            resume = (
+                old is not None
+                and len(old) == sidecar_size
+                and old.startswith(header)
+                and os.path.exists(path)
+                and os.path.getsize(path) == length
+                and not self._allSet(old[len(header) : len(header) + self._bitmap])
+            )
+
+        with open(path, "r+b" if resume else "w+b") as fp:
+            if not resume:
+                # extends with a hole, so a sparse dump only stores what it writes
+                fp.truncate(length)
+            self._data = mmap.mmap(fp.fileno(), length)
+        with open(sidecarPath(path), "r+b" if resume else "w+b") as fp:
+            if not resume:
+                fp.write(header + bytes(2 * self._bitmap))
+                fp.flush()
+            self._map = mmap.mmap(fp.fileno(), sidecar_size)
+        self._done = memoryview(self._map)[len(header) : len(header) + self._bitmap]
+        self._erased = memoryview(self._map)[len(header) + self._bitmap :]
+
+    @staticmethod
+    def _readSidecar(path: str) -> bytes:
+        """internal method: the content of an existing sidecar, or None"""
+        try:
+            with open(path, "rb") as fp:
+                return fp.read(-1)
+        except OSError:
+            return None
+
+    def _allSet(self, bitmap) -> bool:
+        """internal method: a bitmap has a bit set for every block"""
+        return all(bitmap[i >> 3] & (1 << (i & 7)) for i in range(self.blocks))
+
+    def __enter__(self) -> DumpFile:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def blockRange(self, index: int) -> tuple:
+        """the address and length of a block"""
+        offset = index * self.block_size
+        return self.address + offset, min(self.block_size, self.length - offset)
+
+    def isDone(self, index: int) -> bool:
+        """the block is in the dump"""
+        return bool(self._done[index >> 3] & (1 << (index & 7)))
+
+    def missing(self) -> list:
+        """blocks still to be read, in address order
+
+        Returns:
+            list: block indexes
+        """
+        return [i for i in range(self.blocks) if not self.isDone(i)]
+
+    @property
+    def complete(self) -> bool:
+        """every block is in the dump"""
+        return not self.missing()
+
+    def store(self, index: int, data) -> None:
+        """put a block in the dump and mark it done. The data goes to the
+        file before the block is marked, so an interruption never leaves a
+        block marked which was not stored
+
+        Args:
+            index (int): block index
+            data: the block's bytes, blockRange(index) long
+        """
+        start = index * self.block_size
+        data = memoryview(data).cast("B")
+        if self.sparse and data == b"\xff" * len(data):
+            self._erased[index >> 3] |= 1 << (index & 7)
+        else:
+            self._data[start : start + len(data)] = data
+        self._done[index >> 3] |= 1 << (index & 7)
+
+    def close(self) -> None:
+        """flush the dump. The sidecar of a finished dump is removed unless
+        it marks sparse blocks"""
+        if self._data is None:
+            return
+        self._data.flush()
+        self._data.close()
+        self._data = None
+        keep = not self.complete or any(self._erased)
+        self._done.release()
+        self._erased.release()
+        self._map.flush()
+        self._map.close()
+        self._map = None
+        if not keep:
+            os.remove(sidecarPath(self.path))
+
+
+def loadDump(path: str) -> bytes:
+    """read a finished dump, filling in the erased blocks of a sparse one
+
+    Args:
+        path (str): the dump file
+
+    Raises:
+        InvalidDumpError: the dump is unfinished or its sidecar is damaged
+
+    Returns:
+        bytes: the region's content
+    """
+    with open(path, "rb") as fp:
+        data = bytearray(fp.read(-1))
+    sidecar = DumpFile._readSidecar(sidecarPath(path))
+    if sidecar is None:
+        return bytes(data)
+
+    if len(sidecar) < DUMP_SIDECAR_HEADER.size:
+        raise InvalidDumpError("Dump sidecar is truncated")
+    magic, version, _, _, length, blockSize = DUMP_SIDECAR_HEADER.unpack_from(sidecar)
+    if magic != DUMP_SIDECAR_MAGIC or version != DUMP_SIDECAR_VERSION:
+        raise InvalidDumpError("Not a dump sidecar")
+    if length != len(data) or blockSize <= 0:
+        raise InvalidDumpError("Dump does not match its sidecar")
+    blocks = -(-length // blockSize)
+    bitmap = -(-blocks // 8)
+    if len(sidecar) < DUMP_SIDECAR_HEADER.size + 2 * bitmap:
+        raise InvalidDumpError("Dump sidecar is truncated")
+    done = sidecar[DUMP_SIDECAR_HEADER.size :]
+    erased = done[bitmap:]
+
+    for index in range(blocks):
+        if not done[index >> 3] & (1 << (index & 7)):
+            raise InvalidDumpError(
+                f"Dump is unfinished, block {index} has not been read"
+            )
+        if erased[index >> 3] & (1 << (index & 7)):
+            start = index * blockSize
+            end = min(start + blockSize, length)
+            data[start:end] = b"\xff" * (end - start)
+    return bytes(data)
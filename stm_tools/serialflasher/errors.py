@@ -74,3 +74,27 @@ class DeviceNotSupportedError(Exception):
     """The device is not currently supported"""
 
     pass
+
+
+class InvalidFlashPlanError(Exception):
+    """The flash plan is malformed or was compiled for a different device"""
+
+    pass
+
+
+class OperationCancelledError(Exception):
+    """The operation was cancelled through its CancellationToken"""
+
+    pass
+
+
+class InvalidManifestError(Exception):
+    """No valid flash manifest was found"""
+
+    pass
+
+
+class InvalidDumpError(Exception):
+    """A dump file is unfinished or does not match its sidecar"""
+
+    pass
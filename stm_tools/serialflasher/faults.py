@@ -0,0 +1,171 @@
+"""
+ file  faults.py
+ Description: A serial port wrapper which makes a link misbehave in
+ controlled ways: USB-style latency and jitter, a bandwidth cap, dropped
+ bytes, bit flips and spurious NACKs. Faults come from a seeded RNG so a
+ run can be repeated exactly. Used to tune timeouts, retries and recovery
+ against the simulated bootloader without hardware.
+"""
+
+from __future__ import annotations
+
+import random
+from dataclasses import dataclass
+from threading import Lock
+from time import sleep
+from .constants import *
+
+
+@dataclass(frozen=True)
+class LinkProfile:
+    """how a link misbehaves. Rates are per byte probabilities
+
+    Attributes:
+        latency (float): seconds added to every read and write
+        jitter (float): up to this many more seconds, uniformly distributed
+        bandwidth (float): bytes per second, None for no cap
+        drop_rate (float): chance each byte is lost
+        bitflip_rate (float): chance each byte has one bit flipped
+        nack_rate (float): chance each ACK the host waits for arrives as a NACK
+    """
+
+    latency: float = 0.0
+    jitter: float = 0.0
+    bandwidth: float = None
+    drop_rate: float = 0.0
+    bitflip_rate: float = 0.0
+    nack_rate: float = 0.0
+
+
+# a clean full speed USB adaptor: 1ms frames, up to one more of scheduling
+FAULT_PROFILE_USB = LinkProfile(latency=0.001, jitter=0.001)
+# a long or noisy cable
+FAULT_PROFILE_NOISY = LinkProfile(
+    latency=0.001, jitter=0.002, drop_rate=1e-4, bitflip_rate=1e-4, nack_rate=1e-3
+)
+
+
+class FaultySerial:
+    """Wraps a pyserial-like port and injects the faults of a LinkProfile.
+    SerialTool takes it in place of a Serial object. Anything not to do
+    with reading or writing is passed straight to the wrapped port
+
+    Faults applied to the data the host writes happen on the way to the
+    device, so a dropped byte leaves the device waiting for it. A read
+    which comes up short because of a dropped byte waits out the port's
+    timeout, as it would on a real link
+
+    NACKs are only injected where the host reads a lone ACK byte, as
+    SerialTool.waitForAck does. ACK values inside replies and data are
+    payload, and are left to bitflip_rate
+
+    Args:
+        serial: the wrapped port, e.g. a SimulatedSerial
+        profile (LinkProfile, optional): faults to inject. Defaults to a clean link.
+        seed (int, optional): RNG seed. Defaults to None (unseeded).
+        sleep (callable, optional): called with the seconds of each delay.
+            Defaults to time.sleep.
+    """
+
+    _OWN = ("serial", "profile", "stats", "_rng", "_sleep", "_lock")
+
+    def __init__(
+        self,
+        serial,
+        profile: LinkProfile = LinkProfile(),
+        seed: int = None,
+        sleep=sleep,
+    ):
+        self.serial = serial
+        self.profile = profile
+        self._rng = random.Random(seed)
+        self._sleep = sleep
+        self._lock = Lock()
+        self.stats = {}
+        self.resetStats()
+
+    def __getattr__(self, name):
+        return getattr(self.serial, name)
+
+    def __setattr__(self, name, value):
+        # settings such as timeout and parity belong to the wrapped port
+        if name in self._OWN:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.serial, name, value)
+
+    def resetStats(self) -> None:
+        """zero the counts of injected faults"""
+        self.stats = {
+            "dropped": 0,
+            "flipped": 0,
+            "nacks": 0,
+            "delay_s": 0.0,
+        }
+
+    # ============ FAULTS ============#
+
+    def _delay(self, length: int) -> None:
+        """internal method: wait out the latency and the transfer time"""
+        profile = self.profile
+        seconds = profile.latency
+        if profile.jitter:
+            with self._lock:
+                seconds += self._rng.uniform(0, profile.jitter)
+        if profile.bandwidth:
+            seconds += length / profile.bandwidth
+        if seconds > 0:
+            self.stats["delay_s"] += seconds
+            self._sleep(seconds)
+
+    def _corrupt(self, data: bytes, nacks: bool = False) -> bytes:
+        """internal method: drop, flip and NACK bytes of a transfer"""
+        profile = self.profile
+        if not (profile.drop_rate or profile.bitflip_rate or nacks):
+            return data
+        out = bytearray()
+        with self._lock:
+            rng = self._rng
+            for b in data:
+                if profile.drop_rate and rng.random() < profile.drop_rate:
+                    self.stats["dropped"] += 1
+                    continue
+                if nacks and b == STM_CMD_ACK and rng.random() < profile.nack_rate:
+                    self.stats["nacks"] += 1
+                    b = STM_CMD_NACK
+                elif profile.bitflip_rate and rng.random() < profile.bitflip_rate:
+                    self.stats["flipped"] += 1
+                    b ^= 1 << rng.randrange(8)
+                out.append(b)
+        return bytes(out)
+
+    def _received(self, rx: bytes, complete, ack: bool = False) -> bytes:
+        """internal method: fault the bytes read from the wrapped port.
+        complete(rx) tells whether a read got everything it waited for,
+        ack whether the read was for a lone ACK byte"""
+        if rx:
+            self._delay(len(rx))
+        rx = self._corrupt(rx, nacks=ack and self.profile.nack_rate > 0)
+        if not complete(rx) and self.serial.timeout:
+            # a real read would wait for the missing bytes until it timed out
+            self._sleep(self.serial.timeout)
+        return rx
+
+    # ============ PORT ============#
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._delay(len(data))
+        self.serial.write(self._corrupt(data))
+        # the host's side of the link always accepts the whole write
+        return len(data)
+
+    def read(self, size: int = 1) -> bytes:
+        return self._received(self.serial.read(size), lambda rx: len(rx) == size)
+
+    def read_until(self, expected: bytes = b"\n", size: int = None) -> bytes:
+        return self._received(
+            self.serial.read_until(expected, size),
+            lambda rx: rx.endswith(expected) or (size is not None and len(rx) == size),
+            ack=size == 1 and expected == bytes([STM_CMD_ACK]),
+        )
@@ -0,0 +1,186 @@
+"""
+ file  flashplan.py
+ Description: Compiled flash plans. A plan holds everything needed to
+ program one image into one device type: the pages to erase, every write
+ memory command fully framed with its checksums, and a CRC32 of each chunk
+ for verification. Plans are stored in a flat binary format which is used
+ in place from a read-only mmap, so many workers share one copy.
+
+ Layout (little endian):
+    header      magic, version, pid, address, length, erase count,
+                frame count, SHA-256 of the image
+    erase       uint16 page index per erase page
+    crc         uint32 CRC32 per chunk
+    frames      fixed stride records: 5-byte address frame then the
+                data frame (N-1, data, checksum), zero padded
+"""
+
+from __future__ import annotations
+
+import hashlib
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+from .errors import *
+from .devices import DeviceType
+from .image import IMAGE_CHUNK_SIZE, FramedImage
+
+FLASH_PLAN_MAGIC = b"STFP"
+FLASH_PLAN_VERSION = 1
+FLASH_PLAN_HEADER = struct.Struct("<4sHHIIII32s")
+# address frame plus the largest data frame
+FLASH_PLAN_FRAME_STRIDE = 5 + IMAGE_CHUNK_SIZE + 2
+
+
+def _loadArray(typecode: str, data) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def _storeArray(values: array) -> bytes:
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def compileFlashPlan(image: FramedImage, device: DeviceType) -> bytes:
+    """compile an image for a device type into a flash plan
+
+    Args:
+        image (FramedImage): framed image
+        device (DeviceType): target device model
+
+    Raises:
+        InvalidAddressError: image does not fit in the device's flash
+
+    Returns:
+        bytes: the serialized plan, see FlashPlan
+    """
+    first = device.getFlashPage(image.address)
+    last = device.getFlashPage(image.end - 1)
+    pages = array("H", range(first, last + 1))
+
+    crcs = array("I")
+    frames = bytearray()
+    for frame in image.frames():
+        crcs.append(zlib.crc32(frame.data_frame[1:-1]))
+        record = frame.address_frame + frame.data_frame
+        frames += record + bytes(FLASH_PLAN_FRAME_STRIDE - len(record))
+
+    header = FLASH_PLAN_HEADER.pack(
+        FLASH_PLAN_MAGIC,
+        FLASH_PLAN_VERSION,
+        device.pid,
+        image.address,
+        len(image),
+        len(pages),
+        len(crcs),
+        hashlib.sha256(image.data).digest(),
+    )
+    return header + _storeArray(pages) + _storeArray(crcs) + bytes(frames)
+
+
+class FlashPlan:
+    """A compiled flash plan, read in place from a buffer. Use Load to map
+    a plan file
+
+    Args:
+        buffer: bytes-like plan data, see compileFlashPlan
+
+    Raises:
+        InvalidFlashPlanError: the buffer is not a valid plan
+    """
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        if len(self.buffer) < FLASH_PLAN_HEADER.size:
+            raise InvalidFlashPlanError("Plan is truncated")
+        (
+            magic,
+            version,
+            self.pid,
+            self.address,
+            self.length,
+            erase_count,
+            self.frame_count,
+            self.sha256,
+        ) = FLASH_PLAN_HEADER.unpack_from(self.buffer)
+        if magic != FLASH_PLAN_MAGIC:
+            raise InvalidFlashPlanError("Not a flash plan")
+        if version != FLASH_PLAN_VERSION:
+            raise InvalidFlashPlanError(f"Unsupported plan version {version}")
+
+        crc_offset = FLASH_PLAN_HEADER.size + 2 * erase_count
+        self._frames_offset = crc_offset + 4 * self.frame_count
+        size = self._frames_offset + FLASH_PLAN_FRAME_STRIDE * self.frame_count
+        if len(self.buffer) != size:
+            raise InvalidFlashPlanError("Plan size does not match its header")
+
+        self.erase_pages = _loadArray(
+            "H", self.buffer[FLASH_PLAN_HEADER.size : crc_offset]
+        )
+        self.chunk_crcs = _loadArray("I", self.buffer[crc_offset : self._frames_offset])
+
+    @classmethod
+    def Load(cls, path: str) -> FlashPlan:
+        """map a plan file read-only. The mapping is shared with every other
+        process which maps the same file
+
+        Args:
+            path (str): plan file
+
+        Returns:
+            FlashPlan: the plan
+        """
+        with open(path, "rb") as fp:
+            return cls(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @staticmethod
+    def Compile(image: FramedImage, device: DeviceType, path: str) -> None:
+        """compile a plan and write it to a file
+
+        Args:
+            image (FramedImage): framed image
+            device (DeviceType): target device model
+            path (str): plan file to write
+        """
+        with open(path, "wb") as fp:
+            fp.write(compileFlashPlan(image, device))
+
+    def close(self) -> None:
+        """release the buffer, closing the mapping if the plan was loaded"""
+        obj = self.buffer.obj
+        self.buffer.release()
+        if isinstance(obj, mmap.mmap):
+            obj.close()
+
+    def frames(self):
+        """iterate the framed write commands without copying them
+
+        Yields:
+            tuple: (memoryview address frame, memoryview data frame)
+        """
+        offset = self._frames_offset
+        for _ in range(self.frame_count):
+            record = self.buffer[offset : offset + FLASH_PLAN_FRAME_STRIDE]
+            # the data frame starts with N-1
+            yield record[:5], record[5 : 5 + record[5] + 3]
+            offset += FLASH_PLAN_FRAME_STRIDE
+
+    def chunks(self):
+        """iterate the address, length and CRC32 of each chunk, for
+        verification
+
+        Yields:
+            tuple: (address, length, crc32)
+        """
+        for index, crc in enumerate(self.chunk_crcs):
+            offset = index * IMAGE_CHUNK_SIZE
+            length = min(IMAGE_CHUNK_SIZE, self.length - offset)
+            yield self.address + offset, length, crc
@@ -0,0 +1,156 @@
+"""
+ file  image.py
+ Description: Firmware images framed ahead of time for the write memory
+ command, with cheap per-device patching. A base image is split into
+ 256-byte chunks and each chunk's address and data frames are built once.
+ Patching a unit's serial number, MAC or calibration data only reframes the
+ chunks the patches touch.
+"""
+
+from __future__ import annotations
+
+from collections import namedtuple
+from .errors import *
+from .serialtool import SerialTool
+
+# bytes of data in one write memory command
+IMAGE_CHUNK_SIZE = 256
+
+# data to place at an absolute address
+Patch = namedtuple("Patch", ["address", "data"])
+
+# a ready-to-send write memory command
+WriteFrame = namedtuple("WriteFrame", ["address", "address_frame", "data_frame"])
+
+
+class FramedImage:
+    """A base image with the write frames of every chunk precomputed. The
+    image is padded to a whole number of words with erased flash bytes
+
+    Args:
+        data (bytes): image content
+        address (int): address the image is written to, must be word aligned
+    """
+
+    def __init__(self, data: bytes, address: int):
+        if address % 4:
+            raise InvalidAddressError("Image address must be word aligned")
+        data = bytes(data)
+        self.address = address
+        self.data = data + bytes([0xFF]) * (-len(data) % 4)
+        self.chunk_frames = [
+            self._frameChunk(i, self.data[i : i + IMAGE_CHUNK_SIZE])
+            for i in range(0, len(self.data), IMAGE_CHUNK_SIZE)
+        ]
+
+    @classmethod
+    def FromFile(cls, path: str, address: int) -> FramedImage:
+        """frame an image file
+
+        Args:
+            path (str): path to the binary
+            address (int): address the image is written to
+
+        Returns:
+            FramedImage: the framed image
+        """
+        with open(path, "rb") as fp:
+            return cls(fp.read(-1), address)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    @property
+    def end(self) -> int:
+        """address after the last image byte"""
+        return self.address + len(self.data)
+
+    def frames(self):
+        """iterate the write frames in address order
+
+        Returns:
+            iterator: WriteFrame for each chunk
+        """
+        return iter(self.chunk_frames)
+
+    def _frameChunk(self, offset: int, chunk: bytes) -> WriteFrame:
+        """internal method: build the frames for the chunk at an image offset"""
+        address = self.address + offset
+        return WriteFrame(
+            address,
+            SerialTool.frameAddress(address),
+            SerialTool.frameWriteData(chunk),
+        )
+
+    def patch(self, patches: list) -> PatchedImage:
+        """apply per-device patches on top of the base image. Only the
+        chunks the patches touch are copied and reframed, so the cost depends
+        on the patches and not on the image size
+
+        Args:
+            patches (list): Patch tuples, each must lie inside the image
+
+        Raises:
+            InvalidAddressError: a patch falls outside the image
+
+        Returns:
+            PatchedImage: the patched image
+        """
+        chunks = {}
+        for address, data in patches:
+            if address < self.address or address + len(data) > self.end:
+                raise InvalidAddressError(
+                    f"Patch at {hex(address)} ({len(data)} bytes) is outside the image"
+                )
+            offset = address - self.address
+            while data:
+                index = offset // IMAGE_CHUNK_SIZE
+                start = offset % IMAGE_CHUNK_SIZE
+                part = data[: IMAGE_CHUNK_SIZE - start]
+                chunk = chunks.get(index)
+                if chunk is None:
+                    base = index * IMAGE_CHUNK_SIZE
+                    chunk = bytearray(self.data[base : base + IMAGE_CHUNK_SIZE])
+                    chunks[index] = chunk
+                chunk[start : start + len(part)] = part
+                offset += len(part)
+                data = data[len(part) :]
+
+        overrides = {
+            index: self._frameChunk(index * IMAGE_CHUNK_SIZE, bytes(chunk))
+            for index, chunk in chunks.items()
+        }
+        return PatchedImage(self, overrides)
+
+
+class PatchedImage:
+    """A base FramedImage plus the reframed chunks for one device
+
+    Args:
+        base (FramedImage): the shared base image
+        overrides (dict): chunk index -> WriteFrame for patched chunks
+    """
+
+    def __init__(self, base: FramedImage, overrides: dict):
+        self.base = base
+        self.overrides = overrides
+
+    @property
+    def address(self) -> int:
+        return self.base.address
+
+    @property
+    def end(self) -> int:
+        return self.base.end
+
+    def __len__(self) -> int:
+        return len(self.base)
+
+    def frames(self):
+        """iterate the write frames in address order
+
+        Yields:
+            WriteFrame: the frame for each chunk
+        """
+        for index, frame in enumerate(self.base.chunk_frames):
+            yield self.overrides.get(index, frame)
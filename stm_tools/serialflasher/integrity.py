@@ -0,0 +1,277 @@
+"""
+ file  integrity.py
+ Description: Records what was written to flash. A WriteDigest is fed
+ each frame as it is sent and keeps running CRC32 and SHA-256 digests of
+ the whole image and a CRC32 per flash page, at no serial cost. A
+ FlashManifest is the compact, serialized form of a digest which can be
+ kept in a reserved region at the end of flash, so a later run can learn
+ what the device holds by reading a few hundred bytes instead of the
+ whole image.
+
+ Manifest layout (little endian):
+    header      magic, format version, flags, image address, image length,
+                image version, image CRC32, image SHA-256, page size,
+                page count
+    pages       uint32 CRC32 per page the image covers
+    trailer     uint32 CRC32 of everything before it
+"""
+
+from __future__ import annotations
+
+import hashlib
+import struct
+import zlib
+from dataclasses import dataclass
+from .errors import *
+
+INTEGRITY_MANIFEST_MAGIC = b"STMF"
+INTEGRITY_MANIFEST_VERSION = 1
+INTEGRITY_MANIFEST_HEADER = struct.Struct("<4sHHIIII32sHH")
+INTEGRITY_MANIFEST_TRAILER = struct.Struct("<I")
+# flash pages kept at the end of flash for the manifest
+INTEGRITY_MANIFEST_PAGES = 1
+
+
+@dataclass(frozen=True)
+class PageDigest:
+    """the written bytes of one flash page: the page index, how many of its
+    bytes were written and their CRC32"""
+
+    index: int
+    address: int
+    length: int
+    crc32: int
+
+
+class WriteDigest:
+    """Running digests of data written to flash. update() must be called
+    with the data in address order, which is how every write path sends it
+
+    Args:
+        pageSize (int): flash page size in bytes
+        flashStart (int): address of flash page 0
+    """
+
+    def __init__(self, pageSize: int, flashStart: int):
+        self.page_size = pageSize
+        self.flash_start = flashStart
+        self.address = None
+        self.length = 0
+        self.crc32 = 0
+        self._sha256 = hashlib.sha256()
+        self._pages = {}
+
+    @classmethod
+    def ForDevice(cls, device) -> WriteDigest:
+        """a digest using a device's flash page layout
+
+        Args:
+            device (DeviceType): the device model
+
+        Returns:
+            WriteDigest: an empty digest
+        """
+        return cls(device.flash_page_size, device.flash_memory.start)
+
+    @property
+    def sha256(self) -> bytes:
+        """SHA-256 of everything written so far"""
+        return self._sha256.digest()
+
+    @property
+    def end(self) -> int:
+        """address after the last byte written"""
+        return self.address + self.length
+
+    def update(self, address: int, data) -> None:
+        """add a written chunk
+
+        Args:
+            address (int): address the chunk was written to
+            data: the chunk, any bytes-like object
+
+        Raises:
+            InvalidAddressError: the chunk does not follow the previous one
+        """
+        if self.address is None:
+            self.address = address
+        elif address != self.end:
+            raise InvalidAddressError(
+                f"Digest expected data at {hex(self.end)}, got {hex(address)}"
+            )
+        data = memoryview(data).cast("B")
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self._sha256.update(data)
+        self.length += len(data)
+
+        offset = 0
+        while offset < len(data):
+            index, start = divmod(address + offset - self.flash_start, self.page_size)
+            count = min(self.page_size - start, len(data) - offset)
+            crc, length = self._pages.get(index, (0, 0))
+            self._pages[index] = (
+                zlib.crc32(data[offset : offset + count], crc),
+                length + count,
+            )
+            offset += count
+
+    def pages(self) -> list:
+        """the digests of the pages written, in address order
+
+        Returns:
+            list: PageDigest for each page
+        """
+        return [
+            PageDigest(
+                index,
+                max(self.address, self.flash_start + index * self.page_size),
+                length,
+                crc,
+            )
+            for index, (crc, length) in sorted(self._pages.items())
+        ]
+
+
+@dataclass(frozen=True)
+class FlashManifest:
+    """what an image write left in flash: the image's location, length,
+    version and digests, and a CRC32 for each page it covers"""
+
+    address: int
+    length: int
+    version: int
+    crc32: int
+    sha256: bytes
+    page_size: int
+    page_crcs: tuple
+
+    @classmethod
+    def FromDigest(cls, digest: WriteDigest, version: int = 0) -> FlashManifest:
+        """build a manifest from the digest of a completed write
+
+        Args:
+            digest (WriteDigest): the digest
+            version (int, optional): the image's version number. Defaults to 0.
+
+        Returns:
+            FlashManifest: the manifest
+        """
+        return cls(
+            digest.address,
+            digest.length,
+            version,
+            digest.crc32,
+            digest.sha256,
+            digest.page_size,
+            tuple(page.crc32 for page in digest.pages()),
+        )
+
+    @staticmethod
+    def sizeOf(pageCount: int) -> int:
+        """bytes taken by a manifest covering pageCount pages"""
+        return (
+            INTEGRITY_MANIFEST_HEADER.size
+            + 4 * pageCount
+            + INTEGRITY_MANIFEST_TRAILER.size
+        )
+
+    def __len__(self) -> int:
+        return self.sizeOf(len(self.page_crcs))
+
+    def toBytes(self) -> bytes:
+        """serialize the manifest
+
+        Returns:
+            bytes: the manifest, a whole number of words
+        """
+        body = INTEGRITY_MANIFEST_HEADER.pack(
+            INTEGRITY_MANIFEST_MAGIC,
+            INTEGRITY_MANIFEST_VERSION,
+            0,
+            self.address,
+            self.length,
+            self.version,
+            self.crc32,
+            self.sha256,
+            self.page_size,
+            len(self.page_crcs),
+        ) + struct.pack(f"<{len(self.page_crcs)}I", *self.page_crcs)
+        return body + INTEGRITY_MANIFEST_TRAILER.pack(zlib.crc32(body))
+
+    @classmethod
+    def ParseHeader(cls, data: bytes) -> int:
+        """check a manifest header and get the manifest's full size, so it
+        can be read in two steps
+
+        Args:
+            data (bytes): at least INTEGRITY_MANIFEST_HEADER.size bytes
+
+        Raises:
+            InvalidManifestError: not a manifest header
+
+        Returns:
+            int: size of the whole manifest in bytes
+        """
+        if len(data) < INTEGRITY_MANIFEST_HEADER.size:
+            raise InvalidManifestError("Manifest is truncated")
+        fields = INTEGRITY_MANIFEST_HEADER.unpack_from(data)
+        if fields[0] != INTEGRITY_MANIFEST_MAGIC:
+            raise InvalidManifestError("No manifest")
+        if fields[1] != INTEGRITY_MANIFEST_VERSION:
+            raise InvalidManifestError(f"Unsupported manifest version {fields[1]}")
+        return cls.sizeOf(fields[-1])
+
+    @classmethod
+    def FromBytes(cls, data: bytes) -> FlashManifest:
+        """parse a serialized manifest
+
+        Args:
+            data (bytes): the manifest, trailing bytes are ignored
+
+        Raises:
+            InvalidManifestError: data is not a valid manifest
+
+        Returns:
+            FlashManifest: the manifest
+        """
+        size = cls.ParseHeader(data)
+        if len(data) < size:
+            raise InvalidManifestError("Manifest is truncated")
+        body = bytes(data[: size - INTEGRITY_MANIFEST_TRAILER.size])
+        (crc,) = INTEGRITY_MANIFEST_TRAILER.unpack_from(data, len(body))
+        if zlib.crc32(body) != crc:
+            raise InvalidManifestError("Manifest CRC mismatch")
+
+        (
+            _,
+            _,
+            _,
+            address,
+            length,
+            version,
+            image_crc,
+            sha256,
+            page_size,
+            page_count,
+        ) = INTEGRITY_MANIFEST_HEADER.unpack_from(body)
+        page_crcs = struct.unpack_from(
+            f"<{page_count}I", body, INTEGRITY_MANIFEST_HEADER.size
+        )
+        return cls(address, length, version, image_crc, sha256, page_size, page_crcs)
+
+    def changedPages(self, digest: WriteDigest) -> list:
+        """compare with the digest of a new image, e.g. to plan a delta
+        update. Pages the new image covers which the manifest does not, or
+        whose CRC differs, are changed
+
+        Args:
+            digest (WriteDigest): digest of the new image
+
+        Returns:
+            list: page indexes to rewrite
+        """
+        first = (self.address - digest.flash_start) // self.page_size
+        old = {first + i: crc for i, crc in enumerate(self.page_crcs)}
+        return [
+            page.index for page in digest.pages() if old.get(page.index) != page.crc32
+        ]
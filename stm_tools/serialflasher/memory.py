@@ -0,0 +1,278 @@
+"""
+ file  memory.py
+ Description: Sliceable views of device memory. Reads are served from a
+ cache of 256-byte blocks, each filled with a single full-size read
+ command. Writes are buffered in the cached blocks and sent as one
+ word-aligned write frame per run of written words when the view is
+ flushed.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from .errors import *
+
+# bytes per cache block, the largest read or write memory command
+MEMORY_BLOCK_SIZE = 256
+MEMORY_CACHE_BLOCKS = 64
+
+
+class _Block:
+    """a cached block: its data, whether the data was read from the device,
+    and which bytes have been written since the last flush"""
+
+    __slots__ = ("data", "valid", "dirty", "lo", "hi")
+
+    def __init__(self):
+        self.data = bytearray(MEMORY_BLOCK_SIZE)
+        self.valid = False
+        self.dirty = None
+        self.lo = MEMORY_BLOCK_SIZE
+        self.hi = 0
+
+
+class DeviceMemory:
+    """A view of a device memory region indexed by offset from the region
+    start, e.g. stm.flash[0x100:0x140] or stm.ram[0:4] = b"...". Reads fill
+    whole blocks through an LRU cache. Writes are buffered until flush() or
+    the end of a with block, then each run of words holding written bytes
+    is sent as one frame. Words between the runs are not sent, and bytes in
+    a sent word which were not written keep their current value. Flash must
+    be erased before it is written through the view
+
+    The cached contents are forgotten whenever the STMInterface erases,
+    writes or resets the device. Call invalidate() if the memory changes
+    any other way
+
+    Args:
+        stm (STMInterface): connected interface
+        name (str): region name, for messages
+        start (int): region start address
+        size (int): region size in bytes
+        cacheBlocks (int, optional): blocks kept in the cache. Defaults to
+            MEMORY_CACHE_BLOCKS.
+    """
+
+    def __init__(
+        self,
+        stm,
+        name: str,
+        start: int,
+        size: int,
+        cacheBlocks: int = MEMORY_CACHE_BLOCKS,
+    ):
+        self.stm = stm
+        self.name = name
+        self.start = start
+        self.size = size
+        self.cache_blocks = cacheBlocks
+        self._blocks = OrderedDict()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __enter__(self) -> DeviceMemory:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.flush()
+
+    def __repr__(self) -> str:
+        return f"DeviceMemory({self.name}, {hex(self.start)}, {self.size} bytes)"
+
+    # ============ INDEXING ============#
+
+    def _range(self, key) -> tuple:
+        """internal method: (offset, length) of an index or slice"""
+        if isinstance(key, slice):
+            offset, stop, step = key.indices(self.size)
+            if step != 1:
+                raise ValueError("DeviceMemory slices must be contiguous")
+            return offset, max(0, stop - offset)
+        if key < 0:
+            key += self.size
+        if not 0 <= key < self.size:
+            raise IndexError(f"{self.name} offset {hex(key)} out of range")
+        return key, 1
+
+    def __getitem__(self, key):
+        offset, length = self._range(key)
+        data = self.read(offset, length)
+        return data if isinstance(key, slice) else data[0]
+
+    def __setitem__(self, key, value) -> None:
+        offset, length = self._range(key)
+        data = bytes([value]) if isinstance(value, int) else bytes(value)
+        if len(data) != length:
+            raise ValueError(
+                f"Cannot assign {len(data)} bytes to a {length} byte range"
+            )
+        self.write(offset, data)
+
+    def __buffer__(self, flags) -> memoryview:
+        # python 3.12+: memoryview(view) gives a read-only snapshot of the region
+        return memoryview(self.read(0, self.size))
+
+    # ============ CACHE ============#
+
+    def _block(self, index: int, fill: bool = True) -> _Block:
+        """internal method: get a cached block, reading it if asked to and
+        it has not been read"""
+        block = self._blocks.get(index)
+        if block is None:
+            block = _Block()
+            self._blocks[index] = block
+            self._evict()
+        else:
+            self._blocks.move_to_end(index)
+
+        if fill and not block.valid:
+            self._fill(index, block)
+        return block
+
+    def _fill(self, index: int, block: _Block) -> None:
+        """internal method: read a block, keeping any buffered writes"""
+        offset = index * MEMORY_BLOCK_SIZE
+        length = min(MEMORY_BLOCK_SIZE, self.size - offset)
+        success, rx = self.stm.serialTool.cmdReadFromMemoryAddress(
+            self.start + offset, length
+        )
+        if not success:
+            raise CommandFailedError(f"Read of {self.name} at {hex(offset)} failed")
+        if block.dirty is None:
+            block.data[:length] = rx
+        else:
+            for i in range(length):
+                if not block.dirty[i]:
+                    block.data[i] = rx[i]
+        block.valid = True
+
+    def _evict(self) -> None:
+        """internal method: drop least recently used blocks over the limit"""
+        while len(self._blocks) > self.cache_blocks:
+            index, block = next(iter(self._blocks.items()))
+            if block.dirty is not None:
+                self._flushBlock(index, block)
+            del self._blocks[index]
+
+    def invalidate(self) -> None:
+        """forget the cached device contents. Buffered writes are kept and
+        the rest of their blocks are read again when needed"""
+        for index, block in list(self._blocks.items()):
+            if block.dirty is None:
+                del self._blocks[index]
+            else:
+                block.valid = False
+
+    # ============ READ/WRITE ============#
+
+    def read(self, offset: int, length: int) -> bytes:
+        """read bytes, through the cache
+
+        Args:
+            offset (int): offset from the region start
+            length (int): bytes to read
+
+        Raises:
+            IndexError: range is outside the region
+
+        Returns:
+            bytes: the data
+        """
+        if offset < 0 or offset + length > self.size:
+            raise IndexError(f"{self.name} read out of range")
+        out = bytearray()
+        end = offset + length
+        while offset < end:
+            index, start = divmod(offset, MEMORY_BLOCK_SIZE)
+            count = min(MEMORY_BLOCK_SIZE - start, end - offset)
+            out += self._block(index).data[start : start + count]
+            offset += count
+        return bytes(out)
+
+    def readinto(self, offset: int, buffer) -> int:
+        """read into a writable buffer, for callers wanting to reuse one
+
+        Args:
+            offset (int): offset from the region start
+            buffer: writable bytes-like object, filled completely
+
+        Returns:
+            int: bytes read
+        """
+        view = memoryview(buffer).cast("B")
+        view[:] = self.read(offset, len(view))
+        return len(view)
+
+    def write(self, offset: int, data: bytes) -> None:
+        """buffer a write. Nothing is sent until the block is flushed
+
+        Args:
+            offset (int): offset from the region start
+            data (bytes): data to write
+
+        Raises:
+            IndexError: range is outside the region
+        """
+        if offset < 0 or offset + len(data) > self.size:
+            raise IndexError(f"{self.name} write out of range")
+        pos = 0
+        while pos < len(data):
+            index, start = divmod(offset + pos, MEMORY_BLOCK_SIZE)
+            count = min(MEMORY_BLOCK_SIZE - start, len(data) - pos)
+            block = self._block(index, fill=False)
+            block.data[start : start + count] = data[pos : pos + count]
+            if block.dirty is None:
+                block.dirty = bytearray(MEMORY_BLOCK_SIZE)
+            block.dirty[start : start + count] = bytes([1]) * count
+            block.lo = min(block.lo, start)
+            block.hi = max(block.hi, start + count)
+            pos += count
+
+    @staticmethod
+    def _dirtyRuns(block: _Block) -> list:
+        """internal method: [lo, hi) of each run of whole words in a block
+        holding written bytes"""
+        runs = []
+        for word in range(block.lo & ~0b11, block.hi, 4):
+            if not any(block.dirty[word : word + 4]):
+                continue
+            if runs and runs[-1][1] == word:
+                runs[-1][1] = word + 4
+            else:
+                runs.append([word, word + 4])
+        return runs
+
+    def _flushBlock(self, index: int, block: _Block) -> None:
+        """internal method: write each run of a dirty block's written words
+        as one frame"""
+        runs = self._dirtyRuns(block)
+        # words partly written need their other bytes from the device
+        if not block.valid and not all(all(block.dirty[lo:hi]) for lo, hi in runs):
+            self._fill(index, block)
+        address = self.start + index * MEMORY_BLOCK_SIZE
+        for lo, hi in runs:
+            success = self.stm.serialTool.cmdWriteToMemoryAddress(
+                address + lo, block.data[lo:hi]
+            )
+            if not success:
+                raise CommandFailedError(
+                    f"Write of {self.name} at {hex(address + lo)} failed"
+                )
+            # a failed flush retries only the runs not yet sent
+            block.dirty[lo:hi] = bytes(hi - lo)
+        block.dirty = None
+        block.lo = MEMORY_BLOCK_SIZE
+        block.hi = 0
+
+    def flush(self) -> None:
+        """send all buffered writes"""
+        for index, block in list(self._blocks.items()):
+            if block.dirty is not None:
+                self._flushBlock(index, block)
+
+    @property
+    def dirty(self) -> bool:
+        """there are buffered writes"""
+        return any(block.dirty is not None for block in self._blocks.values())
@@ -0,0 +1,130 @@
+"""
+ file  progress.py
+ Description: Progress reporting and cooperative cancellation for long
+ running memory operations. Operations report a ProgressEvent after every
+ frame and check their CancellationToken before starting the next one, so a
+ cancelled operation always stops on a frame boundary with the bootloader
+ ready for its next command.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from threading import Event
+from time import monotonic
+from .errors import *
+
+PROGRESS_PHASE_READ = "read"
+PROGRESS_PHASE_WRITE = "write"
+PROGRESS_PHASE_ERASE = "erase"
+PROGRESS_PHASE_VERIFY = "verify"
+
+# weight of the newest frame in the smoothed rate
+PROGRESS_RATE_SMOOTHING = 0.3
+
+
+@dataclass(frozen=True)
+class ProgressEvent:
+    """progress of one phase of an operation. Erase progress counts pages,
+    the other phases count bytes"""
+
+    phase: str
+    done: int
+    total: int
+    elapsed: float
+    rate: float
+    eta: float
+
+    @property
+    def fraction(self) -> float:
+        return self.done / self.total if self.total else 1.0
+
+
+class CancellationToken:
+    """Shared flag used to stop an operation from another thread. One token
+    can be passed to many operations"""
+
+    def __init__(self):
+        self._event = Event()
+
+    def cancel(self) -> None:
+        """request cancellation"""
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def check(self) -> None:
+        """raise if cancellation has been requested
+
+        Raises:
+            OperationCancelledError: token was cancelled
+        """
+        if self._event.is_set():
+            raise OperationCancelledError("Operation cancelled")
+
+
+class ProgressTracker:
+    """Tracks one phase of an operation and reports to a callback. Either
+    the callback or the token may be None
+
+    Args:
+        phase (str): phase name, one of the PROGRESS_PHASE constants
+        total (int): units in the phase
+        callback (callable, optional): called with a ProgressEvent after each step.
+            Defaults to None.
+        token (CancellationToken, optional): checked before each step. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        phase: str,
+        total: int,
+        callback=None,
+        token: CancellationToken = None,
+    ):
+        self.phase = phase
+        self.total = total
+        self.callback = callback
+        self.token = token
+        self.done = 0
+        self.rate = 0.0
+        self.start = monotonic()
+        self._last = self.start
+
+    def check(self) -> None:
+        """call before each step: raises if the operation was cancelled
+
+        Raises:
+            OperationCancelledError: token was cancelled
+        """
+        if self.token is not None and self.token.cancelled:
+            raise OperationCancelledError(
+                f"{self.phase} cancelled after {self.done} of {self.total}"
+            )
+
+    def update(self, count: int) -> None:
+        """record a completed step
+
+        Args:
+            count (int): units completed by the step
+        """
+        self.done += count
+        if self.callback is None:
+            return
+        now = monotonic()
+        step_time = now - self._last
+        self._last = now
+        if step_time > 0:
+            step_rate = count / step_time
+            if self.rate:
+                self.rate += PROGRESS_RATE_SMOOTHING * (step_rate - self.rate)
+            else:
+                self.rate = step_rate
+        eta = (self.total - self.done) / self.rate if self.rate else None
+        self.callback(
+            ProgressEvent(
+                self.phase, self.done, self.total, now - self.start, self.rate, eta
+            )
+        )
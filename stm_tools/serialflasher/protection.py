@@ -0,0 +1,137 @@
+"""
+ file  protection.py
+ Description: Per-page view of the flash write protection held in the
+ option bytes WRP bits, used to check and plan writes before sending them.
+"""
+
+from __future__ import annotations
+
+from array import array
+from .devices import DeviceType, OptionBytes
+from .errors import InvalidAddressError
+
+
+class ProtectionMap:
+    """Translates the option byte write-protect bits into per-page
+    protection status using the device's sector layout. Range checks are
+    answered from a prefix count of protected pages, so they cost the same
+    regardless of range length
+
+    Args:
+        device (DeviceType): the device model
+        opt_bytes (OptionBytes): option bytes to map
+    """
+
+    def __init__(self, device: DeviceType, opt_bytes: OptionBytes):
+        self.device = device
+        self.opt_bytes = opt_bytes
+        self.wrp_bits = opt_bytes.writeProtectBits
+
+        # a cleared bit protects every page in its sector
+        self.protected_sectors = frozenset(
+            sector
+            for sector in range(len(device.wrp_sectors))
+            if not (self.wrp_bits >> sector) & 0b1
+        )
+
+        self.page_protected = bytearray(device.flash_page_num)
+        for sector in self.protected_sectors:
+            for page in device.wrp_sectors[sector]:
+                self.page_protected[page] = 1
+
+        # _prefix[n] is the number of protected pages below page n
+        self._prefix = array("I", [0])
+        for protected in self.page_protected:
+            self._prefix.append(self._prefix[-1] + protected)
+
+    def _pageRange(self, address: int, length: int) -> tuple:
+        """internal method: first and last page of an address range"""
+        if length < 1:
+            raise InvalidAddressError("Range length must be at least 1 byte")
+        first = self.device.getFlashPage(address)
+        last = self.device.getFlashPage(address + length - 1)
+        return first, last
+
+    def isPageProtected(self, page: int) -> bool:
+        """check if a flash page is write-protected
+
+        Args:
+            page (int): page index
+
+        Returns:
+            bool: page is protected
+        """
+        return bool(self.page_protected[page])
+
+    def getProtectedPages(self) -> list:
+        """get every write-protected page
+
+        Returns:
+            list: protected page indexes
+        """
+        return [page for page, prot in enumerate(self.page_protected) if prot]
+
+    def isRangeWritable(self, address: int, length: int) -> bool:
+        """check that no page in an address range is write-protected
+
+        Args:
+            address (int): flash start address
+            length (int): range length in bytes
+
+        Raises:
+            InvalidAddressError: range is not inside flash memory
+
+        Returns:
+            bool: whole range is writable
+        """
+        first, last = self._pageRange(address, length)
+        return self._prefix[last + 1] == self._prefix[first]
+
+    def getProtectedSectors(self, address: int, length: int) -> list:
+        """get the protected sectors overlapping an address range. These are
+        the sectors which must be unprotected to write the range
+
+        Args:
+            address (int): flash start address
+            length (int): range length in bytes
+
+        Raises:
+            InvalidAddressError: range is not inside flash memory
+
+        Returns:
+            list: sector indexes
+        """
+        first, last = self._pageRange(address, length)
+        if self._prefix[last + 1] == self._prefix[first]:
+            return []
+        return [
+            sector
+            for sector in range(
+                self.device.getWriteProtectSector(first),
+                self.device.getWriteProtectSector(last) + 1,
+            )
+            if sector in self.protected_sectors
+        ]
+
+    def planUnprotect(self, ranges: list) -> OptionBytes:
+        """plan the option bytes which unprotect just the sectors needed to
+        write a set of address ranges, leaving all other protection in place
+
+        Args:
+            ranges (list): (address, length) tuples to be written
+
+        Returns:
+            OptionBytes: target option bytes, or None if nothing needs unprotecting
+        """
+        sectors = set()
+        for address, length in ranges:
+            sectors.update(self.getProtectedSectors(address, length))
+        if not sectors:
+            return None
+
+        target = OptionBytes.FromBytes(bytes(self.opt_bytes.rawBytes))
+        bits = self.wrp_bits
+        for sector in sectors:
+            bits |= 1 << sector
+        target.writeProtectBits = bits
+        return target
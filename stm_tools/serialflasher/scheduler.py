@@ -0,0 +1,127 @@
+"""
+ file  scheduler.py
+ Description: Serializes access to one bootloader port. Each bootloader
+ command runs as a transaction holding the port for all of its frames, so
+ commands from different threads are never interleaved. Waiting
+ transactions are granted in priority order, first come first served
+ within a priority.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from contextlib import contextmanager
+from functools import wraps
+from heapq import heapify, heappop, heappush
+from itertools import count
+from threading import Condition, get_ident
+from .constants import *
+
+
+class TransactionScheduler:
+    """A reentrant priority lock for one port. The thread holding it may
+    start nested transactions, so a multi-command sequence can be wrapped in
+    an outer transaction to keep other threads out until it completes"""
+
+    def __init__(self):
+        self._cond = Condition()
+        self._owner = None
+        self._depth = 0
+        self._waiting = []
+        self._tickets = count()
+
+    def acquire(self, priority: int = STM_PRIORITY_NORMAL) -> None:
+        """wait for the port, see transaction
+
+        Args:
+            priority (int, optional): lower is served first. Defaults to STM_PRIORITY_NORMAL.
+        """
+        me = get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._depth += 1
+                return
+            entry = (priority, next(self._tickets), me)
+            heappush(self._waiting, entry)
+            try:
+                while self._owner is not None or self._waiting[0] is not entry:
+                    self._cond.wait()
+            except BaseException:
+                # interrupted while waiting, give up our place
+                self._waiting.remove(entry)
+                heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+            heappop(self._waiting)
+            self._owner = me
+            self._depth = 1
+
+    def release(self) -> None:
+        """release the port
+
+        Raises:
+            RuntimeError: the calling thread does not hold the port
+        """
+        with self._cond:
+            if self._owner != get_ident():
+                raise RuntimeError("Transaction released by a thread not holding it")
+            self._depth -= 1
+            if self._depth == 0:
+                self._owner = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def transaction(self, priority: int = STM_PRIORITY_NORMAL):
+        """hold the port for the duration of a with block
+
+        Args:
+            priority (int, optional): lower is served first. Defaults to STM_PRIORITY_NORMAL.
+        """
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @property
+    def waiting(self) -> int:
+        """number of transactions waiting for the port"""
+        with self._cond:
+            return len(self._waiting)
+
+    def run(self, function, *args, priority: int = STM_PRIORITY_NORMAL, **kwargs):
+        """run a function as one transaction
+
+        Returns:
+            the function's return value
+        """
+        with self.transaction(priority):
+            return function(*args, **kwargs)
+
+    async def runAsync(
+        self, function, *args, priority: int = STM_PRIORITY_NORMAL, **kwargs
+    ):
+        """run a function as one transaction from an asyncio task. The
+        function runs on the event loop's executor, so blocking serial I/O
+        does not stall the loop and tasks queue for the port like threads
+
+        Returns:
+            the function's return value
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, lambda: self.run(function, *args, priority=priority, **kwargs)
+        )
+
+
+def scheduled(method):
+    """decorator: run a SerialTool method as a single transaction on the
+    tool's scheduler at the caller's priority (normal unless the caller is
+    already inside a transaction)"""
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.scheduler.transaction():
+            return method(self, *args, **kwargs)
+
+    return wrapper
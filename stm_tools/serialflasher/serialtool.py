@@ -5,7 +5,8 @@
  Bootloader's serial interface.
 """
 
-from time import sleep
+from collections import deque
+from time import sleep, monotonic
 import sys
 from serial import Serial, SerialTimeoutException, SerialException, PARITY_EVEN
 from .constants import *
@@ -19,6 +20,40 @@ from .errors import (
     InvalidEraseLengthError,
 )
 from .utilities import getByteComplement
+from .scheduler import TransactionScheduler, scheduled
+from .transport import openTransport
+
+
+class ResetTiming:
+    """reconnect times for one kind of reset. Only the totals and the most
+    recent times are kept, so a long running session does not grow it
+
+    Attributes:
+        count (int): reconnects recorded
+        min (float): fastest reconnect in seconds
+        max (float): slowest reconnect in seconds
+        last (float): latest reconnect in seconds
+        recent (deque): the last STM_RESET_TIMING_HISTORY times, oldest first
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.recent = deque(maxlen=STM_RESET_TIMING_HISTORY)
+
+    def add(self, seconds: float) -> None:
+        """record a reconnect
+
+        Args:
+            seconds (float): time taken
+        """
+        self.count += 1
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        self.last = seconds
+        self.recent.append(seconds)
 
 
 class SerialTool:
@@ -33,10 +68,11 @@ class SerialTool:
         * return the bytearrays read from the device
 
     Args:
-        * port (str, optional): serial port to connect to. Defaults to None.
+        * port (str, optional): serial port to connect to, or a tcp:// or rfc2217://
+        bridge URL, see transport.py. Defaults to None.
         * baud (int, optional): baudrate to connect with. Defaults to 9600.
-        * serial (Serial, optional): user can supply a configured pyserial Serial object for more
-        granular control of the interface. If the Serial object is not supplied then
+        * serial (Serial, optional): user can supply a configured pyserial Serial object, or
+        any other transport, for more granular control of the interface. If the Serial object is not supplied then
         the port __must__ be supplied. Defaults to None.
 
     Raises:
@@ -44,8 +80,6 @@ class SerialTool:
 
     """
 
-    connected = False
-
     # =========== UTILITY FUNCTIONS =========#
 
     @staticmethod
@@ -77,6 +111,19 @@ class SerialTool:
             ]
         )
 
+    @staticmethod
+    def frameAddress(address: int) -> bytes:
+        """build the address frame of a memory command: address MSB first
+        plus checksum"""
+        return bytes(SerialTool.appendChecksum(SerialTool.addressToBytes(address)))
+
+    @staticmethod
+    def frameWriteData(data: bytearray) -> bytes:
+        """build the data frame of a write memory command: N-1, the N data
+        bytes and checksum"""
+        return bytes(SerialTool.appendChecksum(bytearray([len(data) - 1]) + data))
+
+    @scheduled
     def reset(self):
         """
         reset the device using the DTR pin of the serial adaptor
@@ -90,7 +137,7 @@ class SerialTool:
         """the contructor for SerialTool
 
         Args:
-            *port (str, optional): serial port to connect to. Defaults to None.
+            *port (str, optional): serial port or bridge URL to connect to. Defaults to None.
             *baud (int, optional): baudrate to connect with. Defaults to 9600.
             *serial (Serial, optional): user can supply a configured pyserial Serial object for more
             *granular control of the interface. If the Serial object is not supplied then
@@ -109,10 +156,17 @@ class SerialTool:
         else:
             self.port = port
             self.baud = baud
-            self.serial = Serial(port, baud, timeout=1.0, write_timeout=1.0)
+            self.serial = openTransport(port, baud, timeout=1.0, write_timeout=1.0)
+        self.connected = False
+        # serializes commands from multiple threads
+        self.scheduler = TransactionScheduler()
+
         self.serial.parity = PARITY_EVEN
         self.serial.setDTR(False)
 
+        # seconds taken for the bootloader to answer after each kind of reset
+        self.reset_timings = {}
+
     # ============ GETTERS/SETTERS ============#
 
     def getBaud(self) -> int:
@@ -176,6 +230,28 @@ class SerialTool:
         """
         return self.serial.is_open
 
+    def getResetTimings(self) -> dict:
+        """get the recorded reconnect times
+
+        Returns:
+            dict: reset kind -> ResetTiming
+        """
+        return self.reset_timings
+
+    def transaction(self, priority: int = STM_PRIORITY_NORMAL):
+        """hold the port for a sequence of commands, see TransactionScheduler.
+        Commands are transactions on their own, this is for keeping other
+        threads out of a multi-command sequence or for setting the priority
+        of the commands inside
+
+        Args:
+            priority (int, optional): lower is served first. Defaults to STM_PRIORITY_NORMAL.
+
+        Returns:
+            context manager holding the port
+        """
+        return self.scheduler.transaction(priority)
+
     def getConnectedState(self):
         """get the connected state
 
@@ -260,6 +336,7 @@ class SerialTool:
 
     # ============== Device Interaction =========#
 
+    @scheduled
     def connect(self) -> bool:
         """connect to the STM chip bootloader by sending the
         handshake byte
@@ -272,34 +349,77 @@ class SerialTool:
             self.connected = True
         return success
 
+    @scheduled
     def disconnect(self) -> None:
         """close the serial socket"""
         self.serial.close()
         self.connected = False
 
-    def reconnect(self) -> bool:
-        """Disconnect and reconnect to the device
-        (useful after commands which cause reset)
+    @scheduled
+    def reconnect(
+        self, kind: str = STM_RESET_DTR, timeout: float = STM_RECONNECT_TIMEOUT_S
+    ) -> bool:
+        """Reconnect to the device after a reset. Rather than waiting a fixed
+        time, the handshake is polled on a short backoff schedule and this
+        returns as soon as the bootloader answers. The time taken is recorded
+        against the reset kind, see getResetTimings
+
+        Args:
+            kind (str, optional): the kind of reset, for the timing record.
+                Defaults to STM_RESET_DTR.
+            timeout (float, optional): give up after this many seconds.
+                Defaults to STM_RECONNECT_TIMEOUT_S.
 
         Returns:
             bool: Success
         """
-        self.disconnect()
-        sleep(0.1)
-        self.serial.open()
-        return self.connect()
+        self.connected = False
+        if not self.serial.is_open:
+            self.serial.open()
+
+        start = monotonic()
+        deadline = start + timeout
+        delays = iter(STM_RECONNECT_BACKOFF_S)
+        delay = 0
+
+        # a byte and its reply must fit in the poll timeout at slow baud rates
+        user_timeout = self.serial.timeout
+        self.serial.timeout = max(
+            STM_RECONNECT_POLL_TIMEOUT_S, 30 / self.serial.baudrate
+        )
+
+        try:
+            while True:
+                self.serial.reset_input_buffer()
+                if self.writeDevice(bytearray([STM_CMD_HANDSHAKE])):
+                    rx = self.serial.read(1)
+                    # a NACK means the bootloader already saw a handshake
+                    if len(rx) == 1 and rx[0] in (STM_CMD_ACK, STM_CMD_NACK):
+                        self.connected = True
+                        break
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                delay = next(delays, delay)
+                sleep(min(delay, remaining))
+        finally:
+            self.serial.timeout = user_timeout
+
+        if self.connected:
+            self.reset_timings.setdefault(kind, ResetTiming()).add(monotonic() - start)
+
+        return self.connected
 
     # =============== DEVICE COMMANDS ==========#
 
-    def writeCommand(self, data: bytearray, length: int) -> tuple:
+    @scheduled
+    def writeCommand(self, data: bytearray, length: int = None) -> tuple:
         """Write a command to the device
 
-            TODO: length is a bit weird here, remove & get the expected length
-                  from the first byte of command?
-
         Args:
             * data (bytearray): the command & any arguments, plus checksum byte
-            * length (int): expected length of the response
+            * length (int, optional): expected length of the response. If None,
+              the length announced by the device is accepted. Defaults to None.
 
         Raises:
             InvalidResponseLengthError: Invalid response length
@@ -317,7 +437,9 @@ class SerialTool:
 
         if success:
             incomming = rx[0]
-            if incomming + 1 != length:
+            if length is None:
+                length = incomming + 1
+            elif incomming + 1 != length:
                 raise InvalidResponseLengthError(
                     f"Device responds with {incomming+1} bytes, but expected {length} bytes"
                 )
@@ -330,6 +452,7 @@ class SerialTool:
 
         return success, rx
 
+    @scheduled
     def cmdGetId(self) -> tuple:
         """Send the ID command
 
@@ -339,8 +462,11 @@ class SerialTool:
         id_command = bytearray([STM_CMD_GET_ID, getByteComplement(STM_CMD_GET_ID)])
         return self.writeCommand(id_command, STM_GET_ID_RSP_LEN)
 
+    @scheduled
     def cmdGetInfo(self) -> tuple:
-        """Send the Info command
+        """Send the Info command. The response is the bootloader version
+        followed by every supported command code, so its length varies
+        between bootloader versions
 
         Returns:
             tuple: (bool Success, bytearray received data)
@@ -351,8 +477,9 @@ class SerialTool:
                 getByteComplement(STM_CMD_GET),
             ]
         )
-        return self.writeCommand(get_commands, STM_RSP_GET_LEN)
+        return self.writeCommand(get_commands)
 
+    @scheduled
     def cmdGetVersionProt(self) -> tuple:
         """Get the device's bootloader protocol version
         this command is structured differently, presumably for backwards
@@ -380,6 +507,7 @@ class SerialTool:
 
         return success, rx
 
+    @scheduled
     def cmdReadFromMemoryAddress(self, address: int, length: int) -> tuple:
         """Send the read memory command
 
@@ -394,8 +522,8 @@ class SerialTool:
             tuple: (bool Success, bytearray received data)
         """
         # check read length
-        if length > 255 or length < 1:
-            raise InvalidReadLengthError("Read length must be > 0 and < 256 bytes")
+        if length > 256 or length < 1:
+            raise InvalidReadLengthError("Read length must be > 0 and <= 256 bytes")
 
         # read command bytes
         commands = bytearray(
@@ -433,6 +561,7 @@ class SerialTool:
 
         return success, rx
 
+    @scheduled
     def cmdWriteToMemoryAddress(self, address: int, data: bytearray) -> tuple:
         """Send the Write to memory command
 
@@ -454,6 +583,26 @@ class SerialTool:
         if len(data) % 4 > 0:
             raise InvalidWriteLengthError("Must be a multiple of 4 bytes")
 
+        return self.cmdWriteFramed(
+            self.frameAddress(address), self.frameWriteData(data)
+        )
+
+    @scheduled
+    def cmdWriteFramed(self, address_frame: bytes, data_frame: bytes) -> bool:
+        """Send the Write to memory command with an address frame and data
+        frame which are already built (see frameAddress and frameWriteData),
+        so callers writing the same data repeatedly can frame it once
+
+        Args:
+            address_frame (bytes): 4 address bytes and checksum
+            data_frame (bytes): N-1, the data bytes and checksum
+
+        Raises:
+            NoResponseError: No response was received from the device
+
+        Returns:
+            bool: Success
+        """
         commands = bytearray(
             [
                 STM_CMD_WRITE_MEM,
@@ -461,30 +610,22 @@ class SerialTool:
             ]
         )
 
-        # address bytes
-        address_bytes = self.addressToBytes(address)
-        address_bytes = self.appendChecksum(address_bytes)
-
-        # write the length (N) and N+1 (????) data bytes and Checksum^N
-        tx_data = bytearray([len(data) - 1])
-        tx_data += data
-        tx_data = self.appendChecksum(tx_data)
-
         success = self.writeAndWaitAck(commands)
 
         if success:
-            success = self.writeAndWaitAck(address_bytes)
+            success = self.writeAndWaitAck(address_frame)
 
         if success:
             # no NACK returned if invalid write area
             try:
-                success = self.writeAndWaitAck(tx_data)
+                success = self.writeAndWaitAck(data_frame)
             except NoResponseError:
                 # want to raise an exception with a specific message
                 raise NoResponseError("Invalid write address")
 
         return success
 
+    @scheduled
     def cmdEraseFlashMemoryPages(self, pages: bytearray) -> bool:
         """Send the erase flash memory command with a list of pages. This
             command will cause the device to reset
@@ -498,7 +639,8 @@ class SerialTool:
         Returns:
             bool: Success
         """
-        if len(pages) < 1 or len(pages) > 256:
+        # N = 0xFF would request a global erase, so 255 pages at most
+        if len(pages) < 1 or len(pages) > STM_ERASE_MAX_PAGES:
             raise InvalidEraseLengthError
 
         commands = bytearray(
@@ -523,6 +665,7 @@ class SerialTool:
 
         return success
 
+    @scheduled
     def cmdEraseFlashMemory(self) -> bool:
         """send the command to erase all flash memory pages
 
@@ -550,6 +693,63 @@ class SerialTool:
 
         return success
 
+    @scheduled
+    def cmdExtendedErase(self, pages: list = None, special: int = None) -> bool:
+        """Send the extended erase command (0x44) with either a list of pages
+        or one of the special erase codes. Page numbers are sent as two bytes,
+        so pages above 255 can be erased. Bootloaders support either this
+        command or the legacy erase command, not both
+
+        Args:
+            pages (list, optional): page numbers to erase. Defaults to None.
+            special (int, optional): STM_EXT_ERASE_MASS, STM_EXT_ERASE_BANK1 or
+                STM_EXT_ERASE_BANK2. Defaults to None.
+
+        Raises:
+            ValueError: must supply exactly one of pages or special
+            InvalidEraseLengthError: length of page list invalid
+
+        Returns:
+            bool: Success
+        """
+        if (pages is None) == (special is None):
+            raise ValueError("Supply either a page list or a special erase code")
+
+        if special is not None:
+            if special not in (
+                STM_EXT_ERASE_MASS,
+                STM_EXT_ERASE_BANK1,
+                STM_EXT_ERASE_BANK2,
+            ):
+                raise ValueError(f"Invalid special erase code: {hex(special)}")
+            tx_data = bytearray([(special >> 8) & 0xFF, special & 0xFF])
+        else:
+            if len(pages) < 1 or len(pages) > STM_EXT_ERASE_MAX_PAGES:
+                raise InvalidEraseLengthError
+
+            tx_data = bytearray(
+                [((len(pages) - 1) >> 8) & 0xFF, (len(pages) - 1) & 0xFF]
+            )
+            for page in pages:
+                tx_data += bytearray([(page >> 8) & 0xFF, page & 0xFF])
+
+        tx_data = self.appendChecksum(tx_data)
+
+        commands = bytearray(
+            [
+                STM_CMD_EXT_ERASE,
+                getByteComplement(STM_CMD_EXT_ERASE),
+            ]
+        )
+
+        success = self.writeAndWaitAck(commands)
+
+        if success:
+            success = self.writeAndWaitAck(tx_data)
+
+        return success
+
+    @scheduled
     def cmdWriteProtect(self, sectors: bytearray) -> bool:
         """send the bootloader command to write-protect the flash
         memory. This command resets the device, disconnecting it.
@@ -591,6 +791,7 @@ class SerialTool:
 
         return success
 
+    @scheduled
     def cmdWriteUnprotect(self) -> bool:
         """Send the command to disable write protection on the flash. This
             Command will cause the device to reset
@@ -612,6 +813,7 @@ class SerialTool:
 
         return first_ack & second_ack
 
+    @scheduled
     def cmdReadoutProtect(self) -> bool:
         """Send the readout protect command, protecting the flash memory from read
         access. This command will cause a device reset
@@ -633,6 +835,7 @@ class SerialTool:
 
         return first_ack & second_ack
 
+    @scheduled
     def cmdReadoutUnprotect(self) -> bool:
         """Send the commmand to disable readout protect on the flash memory. This
             This command will cause a device reset
@@ -656,6 +859,7 @@ class SerialTool:
 
         return first_ack & second_ack
 
+    @scheduled
     def cmdGoToAddress(self, address: int) -> bool:
         """send the Go command with associated memory address. This command
         will finish the bootloader's interaction with this driver, however serial bytes
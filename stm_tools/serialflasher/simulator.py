@@ -0,0 +1,683 @@
+"""
+ file  simulator.py
+ Description: A simulated STM32F10x bootloader speaking the AN3155 USART
+ protocol, and a pyserial-like port to reach it through. Lets SerialTool and
+ STMInterface run end to end without hardware.
+"""
+
+from __future__ import annotations
+
+import os
+import select
+import socket
+from threading import Event, RLock, Thread
+from time import monotonic
+from serial.rfc2217 import PortManager
+from .constants import *
+from .devices import DeviceType, OptionBytes
+from .utilities import getByteComplement
+
+# flash-style default option bytes: unprotected, no write protection
+SIM_DEFAULT_OPTION_BYTES = bytes(
+    [0xA5, 0x5A, 0xFF, 0x00, 0xFF, 0x00, 0xFF, 0x00]
+    + [0xFF, 0x00, 0xFF, 0x00, 0xFF, 0x00, 0xFF, 0x00]
+)
+
+SIM_COMMANDS = (
+    STM_CMD_GET,
+    STM_CMD_VERSION_READ_PROTECT,
+    STM_CMD_GET_ID,
+    STM_CMD_READ_MEM,
+    STM_CMD_GO,
+    STM_CMD_WRITE_MEM,
+    STM_CMD_ERASE_MEM,
+    STM_CMD_WRITE_PROTECT_EN,
+    STM_CMD_WRITE_PROTECT_DIS,
+    STM_CMD_READOUT_PROTECT_EN,
+    STM_CMD_READOUT_PROTECT_DIS,
+)
+
+
+class SimulatedBootloader:
+    """Model of a device running the system memory bootloader. Bytes written
+    by the host are fed to a protocol parser and the responses are queued
+    for the host to read. Flash programming only clears bits, as on the
+    real part, and write-protected pages are refused
+
+    Args:
+        pid (int, optional): product ID to report. Defaults to 0x0410 (medium density).
+        version (int, optional): bootloader version byte. Defaults to 0x22.
+        extended_erase (bool, optional): advertise extended erase (0x44) in place
+            of the legacy erase command. Defaults to False.
+        uid (bytes, optional): 12-byte unique ID. Defaults to a fixed pattern.
+        reset_delay (float, optional): seconds after a reset before the
+            bootloader listens for the handshake. Defaults to 0.
+    """
+
+    def __init__(
+        self,
+        pid: int = 0x0410,
+        version: int = 0x22,
+        extended_erase: bool = False,
+        uid: bytes = bytes(range(1, 13)),
+        reset_delay: float = 0,
+    ):
+        self.device = DeviceType(pid, 0)
+        self.version = version
+        self.commands = tuple(
+            STM_CMD_EXT_ERASE if (cmd == STM_CMD_ERASE_MEM and extended_erase) else cmd
+            for cmd in SIM_COMMANDS
+        )
+        self.uid = bytes(uid)
+        self.reset_delay = reset_delay
+
+        self.flash = bytearray([0xFF] * self.device.flash_memory.size)
+        # the ram region's end is the address of its last byte
+        self.ram = bytearray(self.device.ram.end + 1 - self.device.bootloader_ram.start)
+        self.option_bytes = bytearray(SIM_DEFAULT_OPTION_BYTES)
+        # option bytes only take effect on reset
+        self.active_option_bytes = OptionBytes.FromBytes(bytes(self.option_bytes))
+
+        self.resets = 0
+        self.go_address = None
+        self.synced = False
+        self.ready_at = 0.0
+        self.rx = bytearray()
+        self.tx = bytearray()
+        self._parser = self._run()
+        next(self._parser)
+
+    # ============ HOST SIDE ============#
+
+    def feed(self, data: bytes) -> None:
+        """feed bytes sent by the host into the protocol parser"""
+        if monotonic() < self.ready_at:
+            # still restarting, the bytes are lost
+            return
+        self.rx += data
+        try:
+            self._parser.send(None)
+        except StopIteration:
+            # the command reset the device, which started a new parser
+            pass
+
+    def reset(self) -> None:
+        """reset the device: apply the option bytes and restart the bootloader"""
+        self.resets += 1
+        self.synced = False
+        self.active_option_bytes = OptionBytes.FromBytes(bytes(self.option_bytes))
+        self.ready_at = monotonic() + self.reset_delay
+        self.rx = bytearray()
+        self._parser = self._run()
+        next(self._parser)
+
+    # ============ MEMORY MODEL ============#
+
+    @property
+    def readProtected(self) -> bool:
+        return self.active_option_bytes.readProtect
+
+    def _locate(self, address: int, length: int) -> tuple:
+        """map an address range to (buffer, offset, kind), or None"""
+        end = address + length
+        flash = self.device.flash_memory
+        if flash.start <= address and end <= flash.end:
+            return self.flash, address - flash.start, "flash"
+        ram_start = self.device.bootloader_ram.start
+        if ram_start <= address and end <= self.device.ram.end + 1:
+            return self.ram, address - ram_start, "ram"
+        opt_start = self.device.flash_option_bytes.start
+        if opt_start <= address and end <= opt_start + 16:
+            return self.option_bytes, address - opt_start, "option_bytes"
+        if STM_F10X_UID_ADDR <= address and end <= STM_F10X_UID_ADDR + len(self.uid):
+            return self.uid, address - STM_F10X_UID_ADDR, "uid"
+        return None
+
+    def _pageWritable(self, page: int) -> bool:
+        sector = self.device.getWriteProtectSector(page)
+        return (self.active_option_bytes.writeProtectBits >> sector) & 0b1 == 1
+
+    def _writeMemory(self, address: int, data: bytes) -> bool:
+        location = self._locate(address, len(data))
+        if location is None:
+            return False
+        buffer, offset, kind = location
+        if kind == "uid":
+            return False
+        if kind == "ram" and address < self.device.ram.start:
+            # the bootloader's own ram is off limits
+            return False
+        if kind == "flash":
+            first = self.device.getFlashPage(address)
+            last = self.device.getFlashPage(address + len(data) - 1)
+            if not all(self._pageWritable(p) for p in range(first, last + 1)):
+                return False
+            for i, b in enumerate(data):
+                buffer[offset + i] &= b
+        else:
+            buffer[offset : offset + len(data)] = data
+        return True
+
+    def _erasePages(self, pages: list) -> bool:
+        if any(p >= self.device.flash_page_num for p in pages):
+            return False
+        if not all(self._pageWritable(p) for p in pages):
+            return False
+        size = self.device.flash_page_size
+        for page in pages:
+            self.flash[page * size : (page + 1) * size] = bytes([0xFF]) * size
+        return True
+
+    # ============ PROTOCOL ============#
+
+    def _send(self, *data) -> None:
+        for d in data:
+            if isinstance(d, int):
+                self.tx.append(d)
+            else:
+                self.tx += d
+
+    def _take(self, n: int):
+        while len(self.rx) < n:
+            yield
+        data = bytes(self.rx[:n])
+        del self.rx[:n]
+        return data
+
+    def _takeChecked(self, n: int):
+        """take n bytes plus an XOR checksum byte, None if the checksum fails"""
+        data = yield from self._take(n + 1)
+        chk = 0
+        for b in data[:-1]:
+            chk ^= b
+        if n == 1:
+            # single bytes are followed by their complement
+            chk = getByteComplement(data[0])
+        return data[:-1] if chk == data[-1] else None
+
+    def _run(self):
+        yield
+        while True:
+            if not self.synced:
+                (b,) = yield from self._take(1)
+                if b == STM_CMD_HANDSHAKE:
+                    self.synced = True
+                    self._send(STM_CMD_ACK)
+                continue
+
+            (cmd,) = yield from self._take(1)
+            if cmd == STM_CMD_HANDSHAKE:
+                # already synced
+                self._send(STM_CMD_NACK)
+                continue
+            (check,) = yield from self._take(1)
+            if check != getByteComplement(cmd) or cmd not in self.commands:
+                self._send(STM_CMD_NACK)
+                continue
+
+            handler = {
+                STM_CMD_GET: self._cmdGet,
+                STM_CMD_VERSION_READ_PROTECT: self._cmdGetVersion,
+                STM_CMD_GET_ID: self._cmdGetId,
+                STM_CMD_READ_MEM: self._cmdRead,
+                STM_CMD_GO: self._cmdGo,
+                STM_CMD_WRITE_MEM: self._cmdWrite,
+                STM_CMD_ERASE_MEM: self._cmdErase,
+                STM_CMD_EXT_ERASE: self._cmdExtendedErase,
+                STM_CMD_WRITE_PROTECT_EN: self._cmdWriteProtect,
+                STM_CMD_WRITE_PROTECT_DIS: self._cmdWriteUnprotect,
+                STM_CMD_READOUT_PROTECT_EN: self._cmdReadoutProtect,
+                STM_CMD_READOUT_PROTECT_DIS: self._cmdReadoutUnprotect,
+            }[cmd]
+            reset = yield from handler()
+            if reset:
+                self.reset()
+                return
+
+    def _cmdGet(self):
+        self._send(STM_CMD_ACK, len(self.commands), self.version)
+        self._send(bytes(self.commands), STM_CMD_ACK)
+        return False
+        yield
+
+    def _cmdGetVersion(self):
+        self._send(STM_CMD_ACK, self.version, 0x00, 0x00, STM_CMD_ACK)
+        return False
+        yield
+
+    def _cmdGetId(self):
+        pid = self.device.pid
+        self._send(STM_CMD_ACK, 1, (pid >> 8) & 0xFF, pid & 0xFF, STM_CMD_ACK)
+        return False
+        yield
+
+    def _cmdRead(self):
+        if self.readProtected:
+            self._send(STM_CMD_NACK)
+            return False
+        self._send(STM_CMD_ACK)
+        address = yield from self._takeChecked(4)
+        if address is None:
+            self._send(STM_CMD_NACK)
+            return False
+        address = int.from_bytes(address, "big")
+        self._send(STM_CMD_ACK)
+        length = yield from self._takeChecked(1)
+        location = None if length is None else self._locate(address, length[0] + 1)
+        if location is None:
+            self._send(STM_CMD_NACK)
+            return False
+        buffer, offset, kind = location
+        self._send(STM_CMD_ACK, bytes(buffer[offset : offset + length[0] + 1]))
+        return False
+
+    def _cmdGo(self):
+        if self.readProtected:
+            self._send(STM_CMD_NACK)
+            return False
+        self._send(STM_CMD_ACK)
+        address = yield from self._takeChecked(4)
+        if address is None:
+            self._send(STM_CMD_NACK)
+            return False
+        self.go_address = int.from_bytes(address, "big")
+        self._send(STM_CMD_ACK)
+        # the application is running now, so the bootloader stops listening
+        while True:
+            yield from self._take(1)
+
+    def _cmdWrite(self):
+        if self.readProtected:
+            self._send(STM_CMD_NACK)
+            return False
+        self._send(STM_CMD_ACK)
+        address = yield from self._takeChecked(4)
+        if address is None:
+            self._send(STM_CMD_NACK)
+            return False
+        address = int.from_bytes(address, "big")
+        self._send(STM_CMD_ACK)
+        (n,) = yield from self._take(1)
+        data = yield from self._take(n + 1)
+        (chk,) = yield from self._take(1)
+        expected = n
+        for b in data:
+            expected ^= b
+        if chk != expected or not self._writeMemory(address, data):
+            self._send(STM_CMD_NACK)
+            return False
+        self._send(STM_CMD_ACK)
+        # option byte writes reset the device to load the new values
+        return self._locate(address, len(data))[2] == "option_bytes"
+
+    def _cmdErase(self):
+        if self.readProtected:
+            self._send(STM_CMD_NACK)
+            return False
+        self._send(STM_CMD_ACK)
+        (n,) = yield from self._take(1)
+        if n == 0xFF:
+            (chk,) = yield from self._take(1)
+            ok = chk == 0x00 and self._erasePages(range(self.device.flash_page_num))
+        else:
+            pages = yield from self._take(n + 1)
+            (chk,) = yield from self._take(1)
+            expected = n
+            for b in pages:
+                expected ^= b
+            ok = chk == expected and self._erasePages(list(pages))
+        self._send(STM_CMD_ACK if ok else STM_CMD_NACK)
+        return False
+
+    def _cmdExtendedErase(self):
+        if self.readProtected:
+            self._send(STM_CMD_NACK)
+            return False
+        self._send(STM_CMD_ACK)
+        nbytes = yield from self._take(2)
+        n = int.from_bytes(nbytes, "big")
+        bank = self.device.flash_page_num // self.device.descriptor.flash_bank_num
+        if n >= 0xFFF0:
+            (chk,) = yield from self._take(1)
+            if chk != nbytes[0] ^ nbytes[1]:
+                ok = False
+            elif n == STM_EXT_ERASE_MASS:
+                ok = self._erasePages(range(self.device.flash_page_num))
+            elif n == STM_EXT_ERASE_BANK1:
+                ok = self._erasePages(range(bank))
+            elif n == STM_EXT_ERASE_BANK2 and self.device.descriptor.flash_bank_num > 1:
+                ok = self._erasePages(range(bank, 2 * bank))
+            else:
+                ok = False
+        else:
+            data = yield from self._take(2 * (n + 1))
+            (chk,) = yield from self._take(1)
+            expected = nbytes[0] ^ nbytes[1]
+            for b in data:
+                expected ^= b
+            pages = [
+                int.from_bytes(data[i : i + 2], "big") for i in range(0, len(data), 2)
+            ]
+            ok = chk == expected and self._erasePages(pages)
+        self._send(STM_CMD_ACK if ok else STM_CMD_NACK)
+        return False
+
+    def _setOptionBytes(self, opt: OptionBytes) -> None:
+        self.option_bytes[:] = opt.toBytes()
+
+    def _cmdWriteProtect(self):
+        if self.readProtected:
+            self._send(STM_CMD_NACK)
+            return False
+        self._send(STM_CMD_ACK)
+        (n,) = yield from self._take(1)
+        sectors = yield from self._take(n + 1)
+        (chk,) = yield from self._take(1)
+        expected = n
+        for b in sectors:
+            expected ^= b
+        if chk != expected:
+            self._send(STM_CMD_NACK)
+            return False
+        opt = OptionBytes.FromBytes(bytes(self.option_bytes))
+        opt.setWriteProtectedSectors(
+            sorted(set(opt.getWriteProtectedSectors()) | set(sectors))
+        )
+        self._setOptionBytes(opt)
+        self._send(STM_CMD_ACK)
+        return True
+
+    def _cmdWriteUnprotect(self):
+        if self.readProtected:
+            self._send(STM_CMD_NACK)
+            return False
+        opt = OptionBytes.FromBytes(bytes(self.option_bytes))
+        opt.disableWriteProtect()
+        self._setOptionBytes(opt)
+        self._send(STM_CMD_ACK, STM_CMD_ACK)
+        return True
+        yield
+
+    def _cmdReadoutProtect(self):
+        if self.readProtected:
+            self._send(STM_CMD_NACK)
+            return False
+        opt = OptionBytes.FromBytes(bytes(self.option_bytes))
+        opt.readProtect = True
+        self._setOptionBytes(opt)
+        self._send(STM_CMD_ACK, STM_CMD_ACK)
+        return True
+        yield
+
+    def _cmdReadoutUnprotect(self):
+        # lifting readout protection mass erases the flash
+        self.flash[:] = bytes([0xFF]) * len(self.flash)
+        self.option_bytes[:] = SIM_DEFAULT_OPTION_BYTES
+        self._send(STM_CMD_ACK, STM_CMD_ACK)
+        return True
+        yield
+
+
+class SimulatedSerial:
+    """Stands in for a pyserial Serial object connected to a
+    SimulatedBootloader. Responses are available as soon as the host's
+    bytes are written, so reads never wait out the timeout
+
+    Args:
+        bootloader (SimulatedBootloader, optional): the device. Defaults to a new
+            medium density device.
+        port (str, optional): port name to report. Defaults to "sim://0".
+        baudrate (int, optional): baud rate to report. Defaults to 57600.
+    """
+
+    def __init__(
+        self,
+        bootloader: SimulatedBootloader = None,
+        port: str = "sim://0",
+        baudrate: int = 57600,
+    ):
+        self.bootloader = SimulatedBootloader() if bootloader is None else bootloader
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = 1.0
+        self.write_timeout = 1.0
+        self.parity = None
+        self.bytesize = 8
+        self.stopbits = 1
+        self.xonxoff = False
+        self.rtscts = False
+        self.break_condition = False
+        self.rts = False
+        # no modem status inputs are wired
+        self.cts = self.dsr = self.ri = self.cd = False
+        self.is_open = True
+        self._dtr = False
+        self._lock = RLock()
+
+    def open(self) -> None:
+        self.is_open = True
+
+    def close(self) -> None:
+        self.is_open = False
+
+    @property
+    def dtr(self) -> bool:
+        return self._dtr
+
+    @dtr.setter
+    def dtr(self, state: bool) -> None:
+        self.setDTR(state)
+
+    def setDTR(self, state: bool) -> None:
+        # DTR is wired to the reset pin
+        with self._lock:
+            if state and not self._dtr:
+                self.bootloader.reset()
+            self._dtr = bool(state)
+
+    def setRTS(self, state: bool) -> None:
+        self.rts = bool(state)
+
+    @property
+    def in_waiting(self) -> int:
+        return len(self.bootloader.tx)
+
+    def reset_input_buffer(self) -> None:
+        with self._lock:
+            self.bootloader.tx.clear()
+
+    def reset_output_buffer(self) -> None:
+        pass
+
+    def write(self, data: bytes) -> int:
+        with self._lock:
+            self.bootloader.feed(bytes(data))
+        return len(data)
+
+    def read(self, size: int = 1) -> bytes:
+        with self._lock:
+            tx = self.bootloader.tx
+            data = bytes(tx[:size])
+            del tx[:size]
+            return data
+
+    def read_until(self, expected: bytes = b"\n", size: int = None) -> bytes:
+        with self._lock:
+            tx = self.bootloader.tx
+            end = tx.find(expected)
+            end = len(tx) if end < 0 else end + len(expected)
+            if size is not None:
+                end = min(end, size)
+            data = bytes(tx[:end])
+            del tx[:end]
+            return data
+
+
+class _BridgeConnection:
+    """the connection PortManager sends its telnet replies through"""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+
+    def write(self, data: bytes) -> None:
+        self.sock.sendall(data)
+
+
+class SimulatedBridge:
+    """A ser2net-style serial bridge on localhost serving a SimulatedSerial
+    over TCP, either as a raw byte stream or as an RFC2217 server with
+    baud and control line changes passed to the port. Connections are
+    served one at a time, like a real bridge
+
+    Args:
+        serial (SimulatedSerial, optional): the bridged port. Defaults to a new one.
+        rfc2217 (bool, optional): speak RFC2217 rather than raw TCP. Defaults to False.
+    """
+
+    def __init__(self, serial: SimulatedSerial = None, rfc2217: bool = False):
+        self.serial = SimulatedSerial() if serial is None else serial
+        self.rfc2217 = rfc2217
+        self.connections = 0
+        self._server = socket.create_server(("127.0.0.1", 0))
+        host, port = self._server.getsockname()[:2]
+        self.url = f"{'rfc2217' if rfc2217 else 'tcp'}://{host}:{port}"
+        self._thread = Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        self._server.close()
+
+    def _serve(self) -> None:
+        while True:
+            try:
+                sock, _ = self._server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            with sock:
+                self._bridge(sock)
+
+    def _bridge(self, sock: socket.socket) -> None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        manager = (
+            PortManager(self.serial, _BridgeConnection(sock)) if self.rfc2217 else None
+        )
+        while True:
+            try:
+                data = sock.recv(4096)
+            except OSError:
+                return
+            if not data:
+                return
+            if manager is not None:
+                data = b"".join(manager.filter(data))
+            if data:
+                self.serial.write(data)
+            # the simulator answers as soon as it is fed
+            rx = self.serial.read(self.serial.in_waiting)
+            if rx:
+                if manager is not None:
+                    rx = b"".join(manager.escape(rx))
+                try:
+                    sock.sendall(rx)
+                except OSError:
+                    return
+
+
+class SimulatedPty:
+    """A SimulatedSerial reached through a pseudo terminal, so real tty
+    drivers (pyserial, FdTransport) can be run and timed against the
+    simulator. The terminal is put in raw mode and port is its path. A
+    pty has no modem lines, so the device cannot be reset with DTR
+
+    Args:
+        serial (SimulatedSerial, optional): the device's port. Defaults to a new one.
+    """
+
+    def __init__(self, serial: SimulatedSerial = None):
+        import pty
+        import tty
+
+        self.serial = SimulatedSerial() if serial is None else serial
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop = Event()
+        self._thread = Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _serve(self) -> None:
+        poll = select.poll()
+        poll.register(self._master, select.POLLIN)
+        while not self._stop.is_set():
+            if not poll.poll(50):
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                return
+            self.serial.write(data)
+            rx = memoryview(self.serial.read(self.serial.in_waiting))
+            while rx:
+                rx = rx[os.write(self._master, rx) :]
+
+
+class NullSerial:
+    """A pyserial-like port with nothing behind it: writes are swallowed,
+    every acknowledge wait gets an ACK and data reads return zeros at once.
+    It does not follow the protocol, it only lets commands complete, so
+    timing SerialTool over it measures host overhead alone
+
+    Args:
+        port (str, optional): port name to report. Defaults to "null://0".
+        baudrate (int, optional): baud rate to report. Defaults to 57600.
+    """
+
+    def __init__(self, port: str = "null://0", baudrate: int = 57600):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = 1.0
+        self.write_timeout = 1.0
+        self.parity = None
+        self.is_open = True
+        self.in_waiting = 0
+        self._ack = bytes([STM_CMD_ACK])
+        self._zeros = bytes(256)
+
+    def open(self) -> None:
+        self.is_open = True
+
+    def close(self) -> None:
+        self.is_open = False
+
+    def setDTR(self, state: bool) -> None:
+        pass
+
+    def setRTS(self, state: bool) -> None:
+        pass
+
+    def reset_input_buffer(self) -> None:
+        pass
+
+    def reset_output_buffer(self) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def write(self, data) -> int:
+        return len(data)
+
+    def read(self, size: int = 1) -> bytes:
+        if size <= len(self._zeros):
+            return self._zeros[:size]
+        return bytes(size)
+
+    def read_until(self, expected: bytes = b"\n", size: int = None) -> bytes:
+        return self._ack
@@ -1,9 +1,33 @@
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from struct import unpack
 from time import sleep
 from .utilities import unpack16BitInt
 from .constants import *
 from .errors import *
-from .devices import DeviceType
+from .devices import DeviceType, OptionBytes
 from .serialtool import SerialTool
+from .cache import BootloaderInfo, DeviceInfoCache, deviceInfoCache
+from .protection import ProtectionMap
+from .image import IMAGE_CHUNK_SIZE, FramedImage, WriteFrame
+from .flashplan import FlashPlan
+from .memory import DeviceMemory
+from .dump import DUMP_BLOCK_SIZE, DumpFile
+from .verify import Mismatch, MismatchCollector, VerifyReport
+from .integrity import (
+    INTEGRITY_MANIFEST_HEADER,
+    INTEGRITY_MANIFEST_PAGES,
+    FlashManifest,
+    WriteDigest,
+)
+from .progress import (
+    CancellationToken,
+    ProgressTracker,
+    PROGRESS_PHASE_ERASE,
+    PROGRESS_PHASE_READ,
+    PROGRESS_PHASE_VERIFY,
+    PROGRESS_PHASE_WRITE,
+)
 
 
 class STMInterface:
@@ -16,16 +40,62 @@ class STMInterface:
     - lock/unlock flash sections
     """
 
-    def __init__(self, serialTool: SerialTool = None):
+    def __init__(
+        self, serialTool: SerialTool = None, infoCache: DeviceInfoCache = None
+    ):
         """constructor
 
         Args:
             serialTool (SerialTool, optional): user-configured SerialTool object. Defaults to None.
+            infoCache (DeviceInfoCache, optional): cache of bootloader info. Defaults to the
+                shared module cache.
         """
         self.connected = False
         self.serialTool = serialTool
         self.connected = False if serialTool is None else serialTool.getConnectedState()
         self.device = None
+        self.infoCache = deviceInfoCache if infoCache is None else infoCache
+        # identity verified with the device since the last connectToDevice
+        self._session = None
+        self._memory = {}
+
+    @property
+    def flash(self) -> DeviceMemory:
+        """cached, sliceable view of flash memory, see DeviceMemory"""
+        return self._memoryView("flash")
+
+    @property
+    def ram(self) -> DeviceMemory:
+        """cached, sliceable view of user RAM, see DeviceMemory"""
+        return self._memoryView("ram")
+
+    def _memoryView(self, name: str) -> DeviceMemory:
+        """internal method: get or create a memory view for the current device"""
+        if self.device is None:
+            raise InformationNotRetrieved("Must read device type first")
+        view = self._memory.get(name)
+        if view is None or view.device is not self.device:
+            view = DeviceMemory(self, name, *self._regionBounds(name))
+            view.device = self.device
+            self._memory[name] = view
+        return view
+
+    def _regionBounds(self, name: str) -> tuple:
+        """internal method: start address and size of the flash or ram region"""
+        if name == "flash":
+            region = self.device.flash_memory
+            return region.start, region.size
+        if name == "ram":
+            # the ram region's end is the address of its last byte
+            region = self.device.ram
+            return region.start, region.end + 1 - region.start
+        raise InvalidAddressError(f"Unknown memory region {name}")
+
+    def invalidateMemoryCache(self) -> None:
+        """clear the cached contents of the flash and ram views, used when
+        memory is changed other than through them"""
+        for view in self._memory.values():
+            view.invalidate()
 
     def buildOptionBytesFromDict(self, data: dict) -> bytearray:
         """not sure if I need this"""
@@ -59,6 +129,8 @@ class STMInterface:
             if len(port) < 1:
                 raise ValueError("Must supply port if no SerialTool initialised")
             self.serialTool = SerialTool(port=port, baud=baud)
+        # a new connection may be to a different board on the same port
+        self._session = None
         sleep(0.01)
         self.connected = self.serialTool.connect()
         return self.connected
@@ -89,33 +161,127 @@ class STMInterface:
 
         return success
 
-    def readDeviceInfo(self) -> bool:
-        """collects the object's id and bootloader version
-        and creates a device model from it
+    def readDeviceInfo(self, refresh: bool = False) -> bool:
+        """collects the object's id, bootloader version and supported
+        commands and creates a device model from it. The first call after
+        connectToDevice always issues GET ID and reads the UID; the GET
+        round trip is skipped if both match the info cached for the port,
+        and the cached entry is dropped if either differs. Later calls in
+        the same session, e.g. after a reset, reuse the verified identity
         NOTE: probably shouldn't have so many exceptions here?
         Use exceptions for now as this is a fundamental function which
         requires multiple other commands to work in order to build
         Device model
+
+        Args:
+            refresh (bool, optional): ignore any cached info. Defaults to False.
         """
         if not self.connected:
             raise DeviceNotConnectedError("Device connection not started")
 
-        success, id = self.serialTool.cmdGetId()
+        if refresh or self._session is None:
+            self._session = self._verifyIdentity(refresh)
+        info = self._session
+
+        self.device = DeviceType(info.pid, info.version)
+        self.device.capabilities = info.capabilities
+        self.device.uid = info.uid
 
+        return True
+
+    def _verifyIdentity(self, refresh: bool) -> BootloaderInfo:
+        """internal method: issue GET ID and read the UID, and check them
+        against the info cached for the port before trusting it"""
+        port = self.serialTool.getPort()
+        success, id = self.serialTool.cmdGetId()
         if not success:
             raise CommandFailedError("GetId Command failed")
-
         pid = unpack16BitInt(id)
-
+        uid = self._readUid()
+
+        cached = self.infoCache.get(port)
+        if cached is not None and (refresh or cached.pid != pid or cached.uid != uid):
+            self.infoCache.invalidate(port)
+            cached = None
+        if cached is not None:
+            return cached
+
+        info = self._identifyDevice(pid, uid)
+        self.infoCache.put(port, info)
+        return info
+
+    def _readUid(self) -> int:
+        """internal method: read the UID, 0 if the device refuses the read
+        (readout protection)"""
+        try:
+            success, rx = self.serialTool.cmdReadFromMemoryAddress(
+                STM_F10X_UID_ADDR, STM_F10X_UID_LEN
+            )
+        except (NoResponseError, UnexpectedResponseError):
+            return 0
+        if not success or len(rx) != STM_F10X_UID_LEN:
+            return 0
+        return int.from_bytes(rx, "little")
+
+    def _identifyDevice(self, pid: int, uid: int) -> BootloaderInfo:
+        """internal method: issue the GET command for a device whose ID and
+        UID have been read"""
         success, info = self.serialTool.cmdGetInfo()
 
         if not success:
             raise CommandFailedError("GetInfo Command failed")
 
         bl_version = self.unpackBootloaderVersion(info)
-        self.device = DeviceType(pid, bl_version)
+        return BootloaderInfo(pid, bl_version, frozenset(info[1:]), uid)
 
-        return True
+    def readDeviceUid(self) -> int:
+        """read the device's 96-bit unique ID and add it to the cached
+        device info, so the info can also be found by UID
+
+        Raises:
+            DeviceNotConnectedError: Device is not connected
+            InformationNotRetrieved: Device type is unknown
+
+        Returns:
+            int: the unique ID, or 0 if it could not be read
+        """
+        if not self.connected:
+            raise DeviceNotConnectedError
+        if self.device is None:
+            raise InformationNotRetrieved
+
+        success, rx = self.serialTool.cmdReadFromMemoryAddress(
+            STM_F10X_UID_ADDR, STM_F10X_UID_LEN
+        )
+
+        if not success:
+            return 0
+
+        self.device.uid = int.from_bytes(rx, "little")
+        self._session = BootloaderInfo(
+            self.device.pid,
+            self.device.bootloaderVersion,
+            self.device.capabilities,
+            self.device.uid,
+        )
+        self.infoCache.put(self.serialTool.getPort(), self._session)
+
+        return self.device.uid
+
+    def getDeviceValidCommands(self) -> list:
+        """getter for the commands supported by the bootloader
+
+        Raises:
+            InformationNotRetrieved: Device info not read yet
+
+        Returns:
+            list: supported command codes
+        """
+        if not self.device:
+            raise InformationNotRetrieved(
+                "Device commands have not been read yet, call self.readDeviceInfo first"
+            )
+        return sorted(self.device.capabilities)
 
     def getDeviceBootloaderVersion(self) -> float:
         """Getter for bootloader version
@@ -174,6 +340,27 @@ class STMInterface:
 
         return success
 
+    def getOptionBytes(self, refresh: bool = False) -> OptionBytes:
+        """get the device option bytes, reading them from the device only if
+        the cached copy is stale (it is invalidated by every device reset)
+
+        Args:
+            refresh (bool, optional): read from the device regardless. Defaults to False.
+
+        Raises:
+            DeviceNotConnectedError: Device is not connected
+            InformationNotRetrieved: Device type is unknown
+
+        Returns:
+            OptionBytes: the option bytes, or None if they could not be read
+        """
+        if self.device is None:
+            raise InformationNotRetrieved("Must read device type first")
+        if refresh or not self.device.opt_bytes_valid:
+            if not self.readOptionBytes():
+                return None
+        return self.device.opt_bytes
+
     def writeToOptionBytes(self, data: bytearray, reconnect: bool = False) -> bool:
         """writes data to the device flash option-bytes address. This must be a 16-byte write
         meeting certain conditions - handled by the OptionBytes class. This
@@ -196,98 +383,229 @@ class STMInterface:
         if self.device is None:
             raise InformationNotRetrieved("Must read device type first")
 
-        success = self._writeToMem(self.device.flash_option_bytes.start, data)
+        with self.serialTool.transaction():
+            success = self._writeToMem(self.device.flash_option_bytes.start, data)
 
-        if success:
-            self.connected = False
+            if success:
+                self.connected = False
+                self.device.invalidateOptionBytes()
+                self.invalidateMemoryCache()
 
-        if not self.connected and reconnect:
-            self.connected = self.serialTool.reconnect()
+            if not self.connected and reconnect:
+                self.connected = self.serialTool.reconnect(STM_RESET_OPTION_BYTES)
 
         return success
 
+    def applyOptionBytes(self, target: OptionBytes, reconnect: bool = True) -> tuple:
+        """bring the device option bytes to the target configuration. The
+        current option bytes are compared field by field with the target, and
+        the option bytes are only written (resetting the device) if a setting
+        differs. Bits not modelled by OptionBytes keep their current values
+
+        Args:
+            target (OptionBytes): desired option bytes
+            reconnect (bool, optional): Reconnect after the reset. Defaults to True.
+
+        Raises:
+            DeviceNotConnectedError: Device is not connected
+            InformationNotRetrieved: Device type is unknown
+            CommandFailedError: the current option bytes could not be read
+
+        Returns:
+            tuple: (bool Success, dict field -> (old, new) of the changed settings)
+        """
+        if not self.connected:
+            raise DeviceNotConnectedError
+
+        current = self.getOptionBytes()
+        if current is None:
+            raise CommandFailedError(
+                "Unable to read option bytes, device may be readout protected"
+            )
+
+        changes = current.diff(target)
+        if not changes:
+            return True, changes
+
+        merged = OptionBytes.FromBytes(bytes(current.rawBytes))
+        for name in changes:
+            setattr(merged, name, getattr(target, name))
+
+        success = self.writeToOptionBytes(merged.toBytes(), reconnect=reconnect)
+
+        return success, changes
+
+    def _resetAndReconnect(
+        self, kind: str, timeout: float = STM_RECONNECT_TIMEOUT_S
+    ) -> None:
+        """internal method: reconnect after a command which resets the device"""
+        if self.device is not None:
+            self.device.invalidateOptionBytes()
+        self.invalidateMemoryCache()
+        self.connected = self.serialTool.reconnect(kind, timeout)
+
     def readUnprotectFlashMemory(self) -> bool:
-        success = self.serialTool.cmdReadoutUnprotect()
-        sleep(0.1)
-        self.connected = self.serialTool.reconnect()
+        # no other thread's command may reach the device until it is back
+        with self.serialTool.transaction():
+            success = self.serialTool.cmdReadoutUnprotect()
+            # the bootloader mass erases the flash before restarting
+            self._resetAndReconnect(
+                STM_RESET_READOUT_UNPROTECT, STM_RECONNECT_MASS_ERASE_TIMEOUT_S
+            )
         return success
 
     def readProtectFlashMemory(self) -> bool:
-        success = self.serialTool.cmdReadoutProtect()
-        sleep(0.1)
-        self.connected = self.serialTool.reconnect()
+        with self.serialTool.transaction():
+            success = self.serialTool.cmdReadoutProtect()
+            self._resetAndReconnect(STM_RESET_READOUT_PROTECT)
         return success
 
     def writeUnprotectFlashMemory(self) -> bool:
-        success = self.serialTool.cmdWriteUnprotect()
-        sleep(0.1)
-        self.connected = self.serialTool.reconnect()
+        with self.serialTool.transaction():
+            success = self.serialTool.cmdWriteUnprotect()
+            self._resetAndReconnect(STM_RESET_WRITE_UNPROTECT)
+        return success
+
+    def writeProtectFlashMemory(self, sectors: bytearray) -> bool:
+        with self.serialTool.transaction():
+            success = self.serialTool.cmdWriteProtect(sectors)
+            self._resetAndReconnect(STM_RESET_WRITE_PROTECT)
         return success
 
-    def writeProtectFlashMemory(self) -> bool:
-        success = self.serialTool.cmdWriteProtect()
-        sleep(0.1)
-        self.connected = self.serialTool.reconnect()
+    def applyProtection(
+        self,
+        readProtect: bool = None,
+        writeProtectedSectors: list = None,
+        reconnect: bool = True,
+    ) -> bool:
+        """set the readout and write protection in as few device resets as
+        possible. The target option bytes are computed from the current ones
+        and written in a single option-byte write, or not at all if nothing
+        changes (see applyOptionBytes). Only lifting readout
+        protection uses the dedicated command, because the bootloader refuses
+        option-byte access while the flash is readout protected (the command
+        also mass erases the flash and clears write protection)
+
+        Args:
+            readProtect (bool, optional): readout protection state, None to leave
+                unchanged. Defaults to None.
+            writeProtectedSectors (list, optional): sectors (0 - 31) to write-protect,
+                every other sector is unprotected. None to leave unchanged. Defaults to None.
+            reconnect (bool, optional): Reconnect after the final reset. Defaults to True.
+
+        Raises:
+            DeviceNotConnectedError: Device is not connected
+            InformationNotRetrieved: Device type is unknown
+            CommandFailedError: the option bytes could not be read
+
+        Returns:
+            bool: Success
+        """
+        if not self.connected:
+            raise DeviceNotConnectedError
+        if self.device is None:
+            raise InformationNotRetrieved("Must read device type first")
+
+        current = self.getOptionBytes()
+        if current is None:
+            # reads are refused while readout protected
+            if readProtect is not False:
+                raise CommandFailedError(
+                    "Unable to read option bytes, device may be readout protected"
+                )
+            if not self.readUnprotectFlashMemory():
+                return False
+            current = self.getOptionBytes()
+            if current is None:
+                raise CommandFailedError("Unable to read option bytes")
+
+        target = OptionBytes.FromBytes(bytes(current.rawBytes))
+        if readProtect is not None:
+            target.readProtect = readProtect
+        if writeProtectedSectors is not None:
+            target.setWriteProtectedSectors(writeProtectedSectors)
+
+        success, changes = self.applyOptionBytes(target, reconnect=reconnect)
+
         return success
 
-    def _readFromMem(self, address: int, length: int):
+    def _readFromMem(
+        self,
+        address: int,
+        length: int,
+        progress=None,
+        cancel: CancellationToken = None,
+    ):
         """internal method: read from memory address - does not sanitize, see
         methods readFromRam/Flash
         """
-        master_rx = bytearray()
+        tracker = ProgressTracker(PROGRESS_PHASE_READ, length, progress, cancel)
+        master_rx = bytearray(length)
         success = True
 
         # max read length is 256 so do larger reads in multiples
-        full_reads = int(length / 256)
-        rem = length % 256
-
-        for i in range(full_reads):
-            success, rx = self.serialTool.cmdReadFromMemoryAddress(
-                address + (i * 256), 256
-            )
+        for offset in range(0, length, 256):
+            tracker.check()
+            count = min(256, length - offset)
+            # bulk priority lets other threads' commands in between frames
+            with self.serialTool.transaction(STM_PRIORITY_BULK):
+                success, rx = self.serialTool.cmdReadFromMemoryAddress(
+                    address + offset, count
+                )
             if not success:
+                del master_rx[offset:]
                 break
-            else:
-                master_rx += rx
-        if rem > 0 and success:
-            success, rx = self.serialTool.cmdReadFromMemoryAddress(
-                (address + (full_reads * 256)), rem
-            )
-            if success:
-                master_rx += rx
+            master_rx[offset : offset + count] = rx
+            tracker.update(count)
 
         return success, master_rx
 
-    def _writeToMem(self, address: int, data: bytearray):
+    def _writeToMem(
+        self,
+        address: int,
+        data: bytearray,
+        progress=None,
+        cancel: CancellationToken = None,
+        digest: WriteDigest = None,
+    ):
         """internal method: write to memory address - does not sanitize, see
-        methods writeToRam/Flash
+        methods writeToRam/Flash. Each frame written is added to the digest
         """
+        self.invalidateMemoryCache()
         length = len(data)
-        full_writes = int(length / 256)
-        rem = length % 256
+        tracker = ProgressTracker(PROGRESS_PHASE_WRITE, length, progress, cancel)
         success = True
 
-        for i in range(full_writes):
-            success = self.serialTool.cmdWriteToMemoryAddress(
-                address + (i * 256), data[(i * 256) : ((i + 1) * 256)]
-            )
+        for offset in range(0, length, 256):
+            tracker.check()
+            chunk = data[offset : offset + 256]
+            with self.serialTool.transaction(STM_PRIORITY_BULK):
+                success = self.serialTool.cmdWriteToMemoryAddress(
+                    address + offset, chunk
+                )
             if not success:
                 raise InvalidResponseLengthError("Invalid status")
-        if rem > 0:
-            success = self.serialTool.cmdWriteToMemoryAddress(
-                (address + (full_writes * 256)),
-                data[(full_writes * 256) : (full_writes * 256) + rem],
-            )
-            if not success:
-                raise InvalidResponseLengthError(f"Invalid status")
+            if digest is not None:
+                digest.update(address + offset, chunk)
+            tracker.update(len(chunk))
         return success
 
-    def readFromRam(self, address: int, length: int) -> tuple:
+    def readFromRam(
+        self,
+        address: int,
+        length: int,
+        progress=None,
+        cancel: CancellationToken = None,
+    ) -> tuple:
         """read bytes from an address in RAM
 
         Args:
             address (int): address to read from
             length (int): bytes to read
+            progress (callable, optional): called with a ProgressEvent after each
+                frame. Defaults to None.
+            cancel (CancellationToken, optional): checked before each frame, see
+                progress.py. Defaults to None.
 
         Raises:
             DeviceNotConnectedError: Device is not connected
@@ -295,6 +613,7 @@ class STMInterface:
             InvalidAddressError: Address is not a valid RAM address
             InvalidReadLengthError: Address read length must be multiple of 4 bytes
             InvalidReadLengthError: Read would go out of bounds
+            OperationCancelledError: cancelled through the token
 
         Returns:
             tuple: Success, Recevied data
@@ -312,14 +631,24 @@ class STMInterface:
         if length % 4 > 0:
             # only allow 4-byte reads
             raise InvalidReadLengthError("Read length should be multiple of 4 bytes")
-        return self._readFromMem(address, length)
-
-    def writeToRam(self, address: int, data: bytearray) -> bool:
+        return self._readFromMem(address, length, progress, cancel)
+
+    def writeToRam(
+        self,
+        address: int,
+        data: bytearray,
+        progress=None,
+        cancel: CancellationToken = None,
+    ) -> bool:
         """Write data to an address in RAM
 
         Args:
             address (int): address to write to
             data (bytearray): data to write
+            progress (callable, optional): called with a ProgressEvent after each
+                frame. Defaults to None.
+            cancel (CancellationToken, optional): checked before each frame, see
+                progress.py. Defaults to None.
 
         Returns:
             bool: Success
@@ -339,14 +668,99 @@ class STMInterface:
         if len(data) % 4 > 0:
             # only allow 4-byte reads
             raise InvalidWriteLengthError("Write length should be multiple of 4 bytes")
-        return self._writeToMem(address, data)
+        return self._writeToMem(address, data, progress, cancel)
+
+    def runFromRam(self, image, address: int = None) -> bool:
+        """load an image into RAM and run it, leaving flash untouched. The
+        image must start with its vector table: the initial stack pointer
+        must lie in RAM and the reset vector must be a Thumb address inside
+        the image. The image is framed in full before the first byte is sent
+        and the write commands are then issued back to back. The bootloader
+        acknowledges every frame before accepting the next, so they cannot
+        overlap on the link. The bootloader's GO command then loads the stack
+        pointer and jumps to the reset vector. The device is no longer
+        connected afterwards
+
+        Args:
+            image: image bytes, or a FramedImage built for the load address
+            address (int, optional): load address. Defaults to the start of user RAM.
+
+        Raises:
+            DeviceNotConnectedError: Device is not connected
+            InformationNotRetrieved: Device type is unknown
+            InvalidAddressError: image overlaps bootloader RAM, does not fit in RAM
+                or has an invalid vector table
+            InvalidWriteLengthError: image is too short to hold a vector table
+
+        Returns:
+            bool: Success
+        """
+        if self.connected is False:
+            raise DeviceNotConnectedError
+        if self.device is None:
+            raise InformationNotRetrieved
+
+        if not isinstance(image, FramedImage):
+            image = FramedImage(
+                image, self.device.ram.start if address is None else address
+            )
+        elif address is not None and address != image.address:
+            raise InvalidAddressError("FramedImage was built for another address")
+
+        ram = self.device.ram
+        # the ram region's end is the address of its last byte
+        ram_top = ram.end + 1
+        if image.address < ram.start or image.end > ram_top:
+            raise InvalidAddressError(
+                f"Image ({hex(image.address)} - {hex(image.end - 1)}) must lie in user RAM ({hex(ram.start)} - {hex(ram.end)}), not bootloader RAM"
+            )
+        if len(image) < 8:
+            raise InvalidWriteLengthError("Image is too short for a vector table")
 
-    def readFromFlash(self, address: int, length: int):
+        stack_pointer, reset_vector = unpack("<II", image.data[:8])
+        if not ram.start < stack_pointer <= ram_top:
+            raise InvalidAddressError(
+                f"Initial stack pointer {hex(stack_pointer)} is not in user RAM"
+            )
+        if not (reset_vector & 0b1) or not (
+            image.address <= (reset_vector & ~0b1) < image.end
+        ):
+            raise InvalidAddressError(
+                f"Reset vector {hex(reset_vector)} is not a Thumb address in the image"
+            )
+
+        self.invalidateMemoryCache()
+        success = True
+        for frame in image.frames():
+            with self.serialTool.transaction(STM_PRIORITY_BULK):
+                success = self.serialTool.cmdWriteFramed(
+                    frame.address_frame, frame.data_frame
+                )
+            if not success:
+                return False
+
+        success = self.serialTool.cmdGoToAddress(image.address)
+        if success:
+            self.connected = False
+
+        return success
+
+    def readFromFlash(
+        self,
+        address: int,
+        length: int,
+        progress=None,
+        cancel: CancellationToken = None,
+    ):
         """Read data from flash memory
 
         Args:
             address (int): address to read from
             length (int): bytes to read
+            progress (callable, optional): called with a ProgressEvent after each
+                frame. Defaults to None.
+            cancel (CancellationToken, optional): checked before each frame, see
+                progress.py. Defaults to None.
 
         Raises:
             DeviceNotConnectedError: _description_
@@ -366,21 +780,280 @@ class STMInterface:
             raise InvalidAddressError(
                 f"Address {hex(address)} is out of range ({hex(self.device.ram.start)} - {hex(self.device.ram.end-1)}"
             )
-        if not self.device.flash_memory.is_valid(address + length):
+        if address + length > self.device.flash_memory.end:
             raise InvalidWriteLengthError(
                 f"Read would go out of bounds ({hex(self.device.ram.start)} - {hex(self.device.ram.end-1)}"
             )
         if length % 4 > 0:
             raise InvalidReadLengthError("Read length should be multiple of 4 bytes")
 
-        return self._readFromMem(address, length)
+        return self._readFromMem(address, length, progress, cancel)
+
+    def dumpToFile(
+        self,
+        region: str,
+        path: str,
+        sparse: bool = False,
+        resume: bool = True,
+        blockSize: int = DUMP_BLOCK_SIZE,
+        progress=None,
+        cancel: CancellationToken = None,
+    ) -> bool:
+        """dump a whole memory region to a file. Each block is read into the
+        memory-mapped output file as it arrives, and a sidecar bitmap of
+        finished blocks lets a dump cut short by a failed read, an error or
+        a cancel resume where it stopped, see dump.py
+
+        Args:
+            region (str): "flash" or "ram"
+            path (str): output file
+            sparse (bool, optional): leave blocks of erased flash as holes in the
+                file, read it back with loadDump. Defaults to False.
+            resume (bool, optional): continue an unfinished dump to the same file.
+                Defaults to True.
+            blockSize (int, optional): bytes per resumable block. Defaults to
+                DUMP_BLOCK_SIZE.
+            progress (callable, optional): called with a ProgressEvent after each
+                frame. Defaults to None.
+            cancel (CancellationToken, optional): checked before each frame.
+                Defaults to None.
+
+        Raises:
+            DeviceNotConnectedError: Device is not connected
+            InformationNotRetrieved: Device type is unknown
+            InvalidAddressError: unknown region
+            OperationCancelledError: cancelled through the token
 
-    def writeToFlash(self, address: int, data: bytearray) -> bool:
+        Returns:
+            bool: Success, False if a read failed and the dump is unfinished
+        """
+        if self.connected is False:
+            raise DeviceNotConnectedError
+        if self.device is None:
+            raise InformationNotRetrieved
+        address, length = self._regionBounds(region)
+
+        with DumpFile(path, address, length, blockSize, sparse, resume) as dump:
+            missing = dump.missing()
+            tracker = ProgressTracker(
+                PROGRESS_PHASE_READ,
+                sum(dump.blockRange(index)[1] for index in missing),
+                progress,
+                cancel,
+            )
+            block = memoryview(bytearray(blockSize))
+            for index in missing:
+                start, count = dump.blockRange(index)
+                for offset in range(0, count, 256):
+                    tracker.check()
+                    size = min(256, count - offset)
+                    with self.serialTool.transaction(STM_PRIORITY_BULK):
+                        success, rx = self.serialTool.cmdReadFromMemoryAddress(
+                            start + offset, size
+                        )
+                    if not success or len(rx) != size:
+                        return False
+                    block[offset : offset + size] = rx
+                    tracker.update(size)
+                dump.store(index, block[:count])
+
+        return True
+
+    def _streamRegion(self, address: int, length: int, error) -> tuple:
+        """internal method: the flash or ram region a stream lies in, as
+        (name, start, size). error is raised if the stream leaves it"""
+        if self.connected is False:
+            raise DeviceNotConnectedError
+        if self.device is None:
+            raise InformationNotRetrieved
+        for name in ("flash", "ram"):
+            start, size = self._regionBounds(name)
+            if start <= address < start + size:
+                if address + length > start + size:
+                    raise error(
+                        f"Stream would go out of bounds ({hex(start)} - {hex(start + size - 1)})"
+                    )
+                return name, start, size
+        raise InvalidAddressError(f"Address {hex(address)} is not in flash or ram")
+
+    def iterRead(
+        self,
+        address: int,
+        length: int,
+        block: int = 256,
+        progress=None,
+        cancel: CancellationToken = None,
+    ):
+        """read flash or ram as a stream of blocks. Each block is read when
+        the caller asks for it, so a slow consumer holds the link back
+        rather than data piling up, and memory use stays at one block.
+        The address and length are checked before the generator is returned
+
+        Args:
+            address (int): address to read from
+            length (int): bytes to read
+            block (int, optional): bytes per block yielded. Defaults to 256.
+            progress (callable, optional): called with a ProgressEvent after each
+                frame. Defaults to None.
+            cancel (CancellationToken, optional): checked before each frame.
+                Defaults to None.
+
+        Raises:
+            DeviceNotConnectedError: Device is not connected
+            InformationNotRetrieved: Device type is unknown
+            InvalidAddressError: address is not in flash or ram
+            InvalidReadLengthError: read would go out of bounds
+            ValueError: block is less than 1
+            CommandFailedError: a read failed, raised by the generator
+            OperationCancelledError: cancelled through the token, raised by the
+                generator
+
+        Returns:
+            iterator: a memoryview of each block. The views share one buffer,
+                so a block must be used or copied before asking for the next
+        """
+        self._streamRegion(address, length, InvalidReadLengthError)
+        if block < 1:
+            raise ValueError("block must be at least 1 byte")
+        return self._iterRead(address, length, block, progress, cancel)
+
+    def _iterRead(self, address, length, block, progress, cancel):
+        """internal method: the iterRead generator"""
+        tracker = ProgressTracker(PROGRESS_PHASE_READ, length, progress, cancel)
+        buffer = memoryview(bytearray(min(block, length)))
+        for start in range(address, address + length, block):
+            count = min(block, address + length - start)
+            for offset in range(0, count, 256):
+                tracker.check()
+                size = min(256, count - offset)
+                with self.serialTool.transaction(STM_PRIORITY_BULK):
+                    success, rx = self.serialTool.cmdReadFromMemoryAddress(
+                        start + offset, size
+                    )
+                if not success or len(rx) != size:
+                    raise CommandFailedError(f"Read failed at {hex(start + offset)}")
+                buffer[offset : offset + size] = rx
+                tracker.update(size)
+            yield buffer[:count]
+
+    def writeStream(
+        self,
+        address: int,
+        chunks,
+        length: int = None,
+        progress=None,
+        cancel: CancellationToken = None,
+        digest: WriteDigest = None,
+    ) -> bool:
+        """write an iterable of chunks of any size to flash or ram. Chunks
+        are pulled only as frames are sent, so a producer such as a file
+        reader or decompressor is held back by the link and at most one
+        frame of data is buffered. Flash must already be erased, and a
+        flash write ending mid-word is padded with 0xFF
+
+        Args:
+            address (int): address to write to, word aligned
+            chunks (iterable): bytes-like chunks, written in order
+            length (int, optional): total length if known, checked against the
+                region up front and used as the progress total. Defaults to None.
+            progress (callable, optional): called with a ProgressEvent after each
+                frame. Defaults to None.
+            cancel (CancellationToken, optional): checked before each frame.
+                Defaults to None.
+            digest (WriteDigest, optional): digest to add the written data to.
+                Defaults to None.
+
+        Raises:
+            DeviceNotConnectedError: Device is not connected
+            InformationNotRetrieved: Device type is unknown
+            InvalidAddressError: address is not word aligned, or not in flash or ram
+            InvalidWriteLengthError: the stream goes out of bounds, or a ram
+                write is not whole words
+            OperationCancelledError: cancelled through the token
+
+        Returns:
+            bool: Success
+        """
+        if address % 4:
+            raise InvalidAddressError("Stream address must be word aligned")
+        name, start, size = self._streamRegion(
+            address, length or 0, InvalidWriteLengthError
+        )
+        end = start + size
+        self.invalidateMemoryCache()
+        tracker = ProgressTracker(PROGRESS_PHASE_WRITE, length or 0, progress, cancel)
+        cursor = address
+
+        def send(data) -> bool:
+            nonlocal cursor
+            if len(data) % 4:
+                if name != "flash":
+                    raise InvalidWriteLengthError(
+                        "Write length should be multiple of 4 bytes"
+                    )
+                data = bytes(data) + b"\xff" * (-len(data) % 4)
+            if cursor + len(data) > end:
+                raise InvalidWriteLengthError(
+                    f"Stream would go out of bounds ({hex(start)} - {hex(end - 1)})"
+                )
+            tracker.check()
+            with self.serialTool.transaction(STM_PRIORITY_BULK):
+                success = self.serialTool.cmdWriteFramed(
+                    SerialTool.frameAddress(cursor), SerialTool.frameWriteData(data)
+                )
+            if not success:
+                return False
+            if digest is not None:
+                digest.update(cursor, data)
+            cursor += len(data)
+            tracker.update(len(data))
+            return True
+
+        pending = bytearray()
+        for chunk in chunks:
+            chunk = memoryview(chunk).cast("B")
+            if pending:
+                take = min(256 - len(pending), len(chunk))
+                pending += chunk[:take]
+                chunk = chunk[take:]
+                if len(pending) < 256:
+                    continue
+                if not send(pending):
+                    return False
+                pending = bytearray()
+            # whole frames go straight from the caller's chunk
+            whole = len(chunk) - len(chunk) % 256
+            for offset in range(0, whole, 256):
+                if not send(chunk[offset : offset + 256]):
+                    return False
+            pending += chunk[whole:]
+
+        if pending:
+            return send(pending)
+        return True
+
+    def writeToFlash(
+        self,
+        address: int,
+        data: bytearray,
+        unprotect: bool = False,
+        progress=None,
+        cancel: CancellationToken = None,
+        digest: WriteDigest = None,
+    ) -> bool:
         """Write data to flash memory
 
         Args:
             address (int): address to write to
             data (bytearray): data to write
+            unprotect (bool, optional): first unprotect any write-protected sectors
+                the data covers, see unprotectForWrite. Defaults to False.
+            progress (callable, optional): called with a ProgressEvent after each
+                frame. Defaults to None.
+            cancel (CancellationToken, optional): checked before each frame, see
+                progress.py. Defaults to None.
+            digest (WriteDigest, optional): digest to add the written data to, see
+                integrity.py. Defaults to None.
 
         Returns:
             bool: Success
@@ -393,32 +1066,126 @@ class STMInterface:
             raise InvalidAddressError(
                 f"Address {hex(address)} is out of range ({hex(self.device.flash_memory.start)} - {hex(self.device.flash_memory.end-1)}"
             )
-        if not self.device.flash_memory.is_valid(address + len(data)):
+        if address + len(data) > self.device.flash_memory.end:
             raise InvalidWriteLengthError(
                 f"Write would go out of bounds ({hex(self.device.flash_memory.start)} - {hex(self.device.flash_memory.end-1)}"
             )
         if len(data) % 4 > 0:
             raise InvalidWriteLengthError("Write length should be multiple of 4 bytes")
 
-        return self._writeToMem(address, data)
+        if unprotect:
+            success, changes = self.unprotectForWrite([(address, len(data))])
+            if not success:
+                return False
+
+        return self._writeToMem(address, data, progress, cancel, digest)
 
     def globalEraseFlash(self) -> bool:
-        """erase all flash pages
+        """erase all flash pages, using the extended erase command if
+        the bootloader supports it
 
         Returns:
             bool: Success
         """
+        self.invalidateMemoryCache()
+        if self.device is not None and self.device.supportsCommand(STM_CMD_EXT_ERASE):
+            return self.serialTool.cmdExtendedErase(special=STM_EXT_ERASE_MASS)
         return self.serialTool.cmdEraseFlashMemory()
 
-    def writeApplicationFileToFlash(self, path: str, offset: int = 0) -> bool:
+    def eraseFlashPages(
+        self, pages: list, progress=None, cancel: CancellationToken = None
+    ) -> bool:
+        """erase a set of flash pages. The pages are batched into as few
+        erase commands as possible, and the legacy or extended erase command
+        is chosen from the commands advertised by the bootloader
+
+        Args:
+            pages (list): page indexes to erase
+            progress (callable, optional): called with a ProgressEvent, counting
+                pages, after each erase command. Defaults to None.
+            cancel (CancellationToken, optional): checked before each erase
+                command. Defaults to None.
+
+        Raises:
+            DeviceNotConnectedError: Device is not connected
+            InformationNotRetrieved: Device type is unknown
+            InvalidAddressError: Page is out of range
+            OperationCancelledError: cancelled through the token
+
+        Returns:
+            bool: Success
+        """
+        if self.connected is False:
+            raise DeviceNotConnectedError
+        if self.device is None:
+            raise InformationNotRetrieved
+
+        self.invalidateMemoryCache()
+        extended = self.device.supportsCommand(STM_CMD_EXT_ERASE)
+        success = True
+        batches = self.device.planFlashErase(pages)
+        tracker = ProgressTracker(
+            PROGRESS_PHASE_ERASE, len(set(pages)), progress, cancel
+        )
+
+        for batch in batches:
+            tracker.check()
+            if batch.special == STM_EXT_ERASE_MASS and not extended:
+                success = self.serialTool.cmdEraseFlashMemory()
+            elif batch.special is not None:
+                success = self.serialTool.cmdExtendedErase(special=batch.special)
+            elif extended:
+                success = self.serialTool.cmdExtendedErase(pages=batch.pages)
+            else:
+                success = self.serialTool.cmdEraseFlashMemoryPages(
+                    bytearray(batch.pages)
+                )
+            if not success:
+                break
+            tracker.update(self.device.countErasedPages(batch))
+
+        return success
+
+    def eraseFlashBank(self, bank: int) -> bool:
+        """erase a whole flash bank (XL density devices have two)
+
+        Args:
+            bank (int): bank index, from 0
+
+        Raises:
+            InformationNotRetrieved: Device type is unknown
+            InvalidAddressError: Device does not have this bank
+
+        Returns:
+            bool: Success
+        """
+        if self.device is None:
+            raise InformationNotRetrieved
+        return self.eraseFlashPages(self.device.getFlashBankPages(bank))
+
+    def writeApplicationFileToFlash(
+        self,
+        path: str,
+        offset: int = 0,
+        progress=None,
+        cancel: CancellationToken = None,
+        digest: WriteDigest = None,
+    ) -> bool:
         """write an application to flash memory
 
         Args:
             path (str): path to the application file
             offset (int, optional): offset from flash start. Defaults to 0.
+            progress (callable, optional): called with a ProgressEvent after each
+                frame. Defaults to None.
+            cancel (CancellationToken, optional): checked before each frame, see
+                progress.py. Defaults to None.
+            digest (WriteDigest, optional): digest to add the written data to.
+                Defaults to None.
 
         Raises:
             InformationNotRetrieved: Device type unknown
+            OperationCancelledError: cancelled through the token
 
         Returns:
             bool: Success
@@ -430,37 +1197,507 @@ class STMInterface:
         with open(path, "rb") as fp:
             content = fp.read(-1)
             success = self.writeToFlash(
-                self.device.flash_memory.start + offset, bytearray(content)
+                self.device.flash_memory.start + offset,
+                bytearray(content),
+                progress=progress,
+                cancel=cancel,
+                digest=digest,
             )
 
         return success
 
-    def isFlashWriteProtected(self):
-        if not self.connected:
+    def writeFramedImage(
+        self,
+        image: FramedImage,
+        patches: list = None,
+        uidPatches=None,
+        progress=None,
+        cancel: CancellationToken = None,
+        digest: WriteDigest = None,
+    ) -> bool:
+        """write a pre-framed image to flash, with optional per-device
+        patches. Unpatched chunks are sent from the frames built when the
+        image was created, so only the patched chunks are framed here
+
+        Args:
+            image (FramedImage): the base image
+            patches (list, optional): Patch tuples for this device. Defaults to None.
+            uidPatches (callable, optional): uidPatches(uid) returns further Patch
+                tuples derived from the device UID, which is always read from the
+                connected device. Defaults to None.
+            progress (callable, optional): called with a ProgressEvent after each
+                frame. Defaults to None.
+            cancel (CancellationToken, optional): checked before each frame, see
+                progress.py. Defaults to None.
+            digest (WriteDigest, optional): digest to add the written data to.
+                Defaults to None.
+
+        Raises:
+            DeviceNotConnectedError: Device is not connected
+            InformationNotRetrieved: Device type is unknown
+            InvalidAddressError: image or a patch is out of range
+            CommandFailedError: the UID could not be read for uidPatches
+            OperationCancelledError: cancelled through the token
+
+        Returns:
+            bool: Success
+        """
+        if self.connected is False:
             raise DeviceNotConnectedError
-        if not self.device:
+        if self.device is None:
             raise InformationNotRetrieved
-        if self.device.opt_bytes == None:
+        flash = self.device.flash_memory
+        if image.address < flash.start or image.end > flash.end:
+            raise InvalidAddressError(
+                f"Image ({hex(image.address)} - {hex(image.end - 1)}) is out of range ({hex(flash.start)} - {hex(flash.end-1)})"
+            )
+
+        patches = list(patches) if patches else []
+        if uidPatches is not None:
+            # never a cached UID, the patches must match the board being written
+            uid = self.readDeviceUid()
+            if not uid:
+                raise CommandFailedError("Unable to read the device UID")
+            patches += uidPatches(uid)
+
+        self.invalidateMemoryCache()
+        tracker = ProgressTracker(PROGRESS_PHASE_WRITE, len(image), progress, cancel)
+        success = True
+        for frame in image.patch(patches).frames():
+            tracker.check()
+            with self.serialTool.transaction(STM_PRIORITY_BULK):
+                success = self.serialTool.cmdWriteFramed(
+                    frame.address_frame, frame.data_frame
+                )
+            if not success:
+                break
+            if digest is not None:
+                digest.update(frame.address, frame.data_frame[1:-1])
+            tracker.update(frame.data_frame[0] + 1)
+
+        return success
+
+    def programFlash(
+        self,
+        address: int,
+        data: bytearray,
+        batchPages: int = STM_ERASE_AHEAD_PAGES,
+        progress=None,
+        cancel: CancellationToken = None,
+        digest: WriteDigest = None,
+    ) -> bool:
+        """erase and write flash in one pass. Only the pages the data covers
+        are erased, batchPages at a time just ahead of the write cursor, so
+        the first frames go out after a short erase rather than a mass erase
+        and a small image never pays for erasing the whole part. The frames
+        of the next batch are built on a worker thread while the current
+        batch erases
+
+        Args:
+            address (int): address to write to, word aligned
+            data (bytearray): data to write, a multiple of 4 bytes
+            batchPages (int, optional): pages per erase command. Defaults to
+                STM_ERASE_AHEAD_PAGES.
+            progress (callable, optional): called with a ProgressEvent after each
+                erase command (counting pages) and each frame (counting bytes).
+                Defaults to None.
+            cancel (CancellationToken, optional): checked before each command.
+                Defaults to None.
+            digest (WriteDigest, optional): digest to add the written data to.
+                Defaults to None.
+
+        Raises:
+            DeviceNotConnectedError: Device is not connected
+            InformationNotRetrieved: Device type is unknown
+            InvalidAddressError: address is out of range or not word aligned
+            InvalidWriteLengthError: data goes out of range or is not whole words
+            ValueError: batchPages is less than 1
+            OperationCancelledError: cancelled through the token
+
+        Returns:
+            bool: Success
+        """
+        if self.connected is False:
+            raise DeviceNotConnectedError
+        if self.device is None:
             raise InformationNotRetrieved
-        write_prot = False
-        if (
-            self.device.opt_bytes.write_protect_0 == 0
-            and self.device.opt_bytes.write_protect_1 == 0
-            and self.device.opt_bytes.write_protect_2 == 0
-            and self.device.opt_bytes.write_protect_3 == 0
-        ):
+        flash = self.device.flash_memory
+        if not flash.is_valid(address) or address % 4:
+            raise InvalidAddressError(
+                f"Address {hex(address)} is out of range ({hex(flash.start)} - {hex(flash.end-1)}) or not word aligned"
+            )
+        if address + len(data) > flash.end:
+            raise InvalidWriteLengthError(
+                f"Write would go out of bounds ({hex(flash.start)} - {hex(flash.end-1)}"
+            )
+        if len(data) % 4 > 0:
+            raise InvalidWriteLengthError("Write length should be multiple of 4 bytes")
+        if batchPages < 1:
+            raise ValueError("batchPages must be at least 1")
+        if not data:
             return True
-        else:
+
+        self.invalidateMemoryCache()
+        data = bytes(data)
+        batches = self._eraseAheadBatches(address, len(data), batchPages)
+        erased = ProgressTracker(
+            PROGRESS_PHASE_ERASE,
+            sum(len(pages) for pages, _ in batches),
+            progress,
+            cancel,
+        )
+        written = ProgressTracker(PROGRESS_PHASE_WRITE, len(data), progress, cancel)
+        success = True
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = pool.submit(self._frameChunks, address, data, batches[0][1])
+            for index, (pages, offsets) in enumerate(batches):
+                upcoming = None
+                if index + 1 < len(batches):
+                    upcoming = pool.submit(
+                        self._frameChunks, address, data, batches[index + 1][1]
+                    )
+                erased.check()
+                success = self.eraseFlashPages(pages, cancel=cancel)
+                if not success:
+                    break
+                erased.update(len(pages))
+
+                for frame in pending.result():
+                    written.check()
+                    with self.serialTool.transaction(STM_PRIORITY_BULK):
+                        success = self.serialTool.cmdWriteFramed(
+                            frame.address_frame, frame.data_frame
+                        )
+                    if not success:
+                        break
+                    if digest is not None:
+                        digest.update(frame.address, frame.data_frame[1:-1])
+                    written.update(frame.data_frame[0] + 1)
+                if not success:
+                    break
+                pending = upcoming
+
+        return success
+
+    def _eraseAheadBatches(self, address: int, length: int, batchPages: int) -> list:
+        """internal method: split a write into (pages, chunk offsets) batches.
+        A chunk goes in the batch erasing the page holding its last byte, so
+        every page it touches is erased before it is written"""
+        first = self.device.getFlashPage(address)
+        last = self.device.getFlashPage(address + length - 1)
+        batches = [
+            (list(range(page, min(page + batchPages, last + 1))), [])
+            for page in range(first, last + 1, batchPages)
+        ]
+        for offset in range(0, length, IMAGE_CHUNK_SIZE):
+            end = min(offset + IMAGE_CHUNK_SIZE, length)
+            page = self.device.getFlashPage(address + end - 1)
+            batches[(page - first) // batchPages][1].append(offset)
+        return batches
+
+    @staticmethod
+    def _frameChunks(address: int, data: bytes, offsets: list) -> list:
+        """internal method: build the write frames of the chunks at the
+        given offsets"""
+        return [
+            WriteFrame(
+                address + offset,
+                SerialTool.frameAddress(address + offset),
+                SerialTool.frameWriteData(data[offset : offset + IMAGE_CHUNK_SIZE]),
+            )
+            for offset in offsets
+        ]
+
+    def executeFlashPlan(
+        self,
+        plan: FlashPlan,
+        erase: bool = True,
+        verify: bool = True,
+        progress=None,
+        cancel: CancellationToken = None,
+        digest: WriteDigest = None,
+    ) -> bool:
+        """program the device from a compiled flash plan. The frames are
+        sent straight from the plan buffer, so no per-device preparation is
+        done here
+
+        Args:
+            plan (FlashPlan): the plan
+            erase (bool, optional): erase the plan's pages first. Defaults to True.
+            verify (bool, optional): read back each chunk and check its CRC32.
+                Defaults to True.
+            progress (callable, optional): called with a ProgressEvent after each
+                command of each phase (erase, write, verify). Defaults to None.
+            cancel (CancellationToken, optional): checked before each command.
+                Defaults to None.
+            digest (WriteDigest, optional): digest to add the written data to.
+                Defaults to None.
+
+        Raises:
+            DeviceNotConnectedError: Device is not connected
+            InformationNotRetrieved: Device type is unknown
+            InvalidFlashPlanError: plan was compiled for a different device
+            OperationCancelledError: cancelled through the token
+
+        Returns:
+            bool: Success, False if any step failed or a chunk did not verify
+        """
+        if self.connected is False:
+            raise DeviceNotConnectedError
+        if self.device is None:
+            raise InformationNotRetrieved
+        if plan.pid != self.device.pid:
+            raise InvalidFlashPlanError(
+                f"Plan is for device {hex(plan.pid)}, not {hex(self.device.pid)}"
+            )
+
+        self.invalidateMemoryCache()
+        success = True
+        if erase and len(plan.erase_pages):
+            success = self.eraseFlashPages(list(plan.erase_pages), progress, cancel)
+
+        if success:
+            tracker = ProgressTracker(
+                PROGRESS_PHASE_WRITE, plan.length, progress, cancel
+            )
+            address = plan.address
+            for address_frame, data_frame in plan.frames():
+                tracker.check()
+                with self.serialTool.transaction(STM_PRIORITY_BULK):
+                    success = self.serialTool.cmdWriteFramed(address_frame, data_frame)
+                if not success:
+                    break
+                if digest is not None:
+                    digest.update(address, data_frame[1:-1])
+                address += IMAGE_CHUNK_SIZE
+                tracker.update(data_frame[0] + 1)
+
+        if success and verify:
+            tracker = ProgressTracker(
+                PROGRESS_PHASE_VERIFY, plan.length, progress, cancel
+            )
+            for address, length, crc in plan.chunks():
+                tracker.check()
+                success, rx = self._readFromMem(address, length)
+                if not success or zlib.crc32(rx) != crc:
+                    success = False
+                    break
+                tracker.update(length)
+
+        return success
+
+    def verifyFlash(
+        self,
+        address: int,
+        data: bytearray,
+        repair: bool = False,
+        progress=None,
+        cancel: CancellationToken = None,
+    ) -> VerifyReport:
+        """read flash back and compare it with the data which should be
+        there. Each frame is compared as it arrives, so the check finishes
+        with the readback. With repair, the pages with mismatches are erased
+        and programmed again, keeping any of their bytes outside the data,
+        then verified again
+
+        Args:
+            address (int): address of the data
+            data (bytearray): expected content
+            repair (bool, optional): reprogram mismatching pages. Defaults to False.
+            progress (callable, optional): called with a ProgressEvent after each
+                frame read. Defaults to None.
+            cancel (CancellationToken, optional): checked before each frame.
+                Defaults to None.
+
+        Raises:
+            DeviceNotConnectedError: Device is not connected
+            InformationNotRetrieved: Device type is unknown
+            InvalidAddressError: range is outside flash
+            OperationCancelledError: cancelled through the token
+
+        Returns:
+            VerifyReport: the mismatches, and the pages repaired
+        """
+        if self.connected is False:
+            raise DeviceNotConnectedError
+        if self.device is None:
+            raise InformationNotRetrieved
+        flash = self.device.flash_memory
+        if address < flash.start or address + len(data) > flash.end:
+            raise InvalidAddressError(
+                f"Verify range {hex(address)} - {hex(address + len(data) - 1)} is outside flash"
+            )
+
+        report = self._verifyRange(address, data, progress, cancel)
+        if repair and not report.ok:
+            pages = report.pages
+            if self._reprogramPages(pages, address, data):
+                report = self._verifyRange(address, data, progress, cancel)
+            report.repaired = pages
+        return report
+
+    def _verifyRange(
+        self, address: int, data, progress=None, cancel: CancellationToken = None
+    ) -> VerifyReport:
+        """internal method: stream the readback of a range through a
+        MismatchCollector"""
+        data = memoryview(data).cast("B")
+        collector = MismatchCollector()
+        tracker = ProgressTracker(PROGRESS_PHASE_VERIFY, len(data), progress, cancel)
+        for offset in range(0, len(data), 256):
+            tracker.check()
+            expected = data[offset : offset + 256]
+            with self.serialTool.transaction(STM_PRIORITY_BULK):
+                success, rx = self.serialTool.cmdReadFromMemoryAddress(
+                    address + offset, len(expected)
+                )
+            if not success:
+                raise CommandFailedError(
+                    f"Read of {hex(address + offset)} failed during verify"
+                )
+            collector.compare(address + offset, expected, rx)
+            tracker.update(len(expected))
+
+        report = VerifyReport(address, len(data))
+        for start, length in collector.mismatches():
+            first = self.device.getFlashPage(start)
+            last = self.device.getFlashPage(start + length - 1)
+            report.mismatches.append(
+                Mismatch(start, length, tuple(range(first, last + 1)))
+            )
+        return report
+
+    def _reprogramPages(self, pages: list, address: int, data) -> bool:
+        """internal method: erase pages and write them again from data. The
+        parts of the pages outside the data are read first and put back"""
+        end = address + len(data)
+        contents = {}
+        for page in pages:
+            start = self.device.getFlashPageAddress(page)
+            content = bytearray()
+            for lo, hi in (
+                (start, min(address, start + self.device.flash_page_size)),
+                (max(address, start), min(end, start + self.device.flash_page_size)),
+                (max(end, start), start + self.device.flash_page_size),
+            ):
+                if hi <= lo:
+                    continue
+                if lo >= address and hi <= end:
+                    content += data[lo - address : hi - address]
+                else:
+                    success, rx = self._readFromMem(lo, hi - lo)
+                    if not success:
+                        return False
+                    content += rx
+            contents[start] = content
+
+        if not self.eraseFlashPages(pages):
             return False
+        for start, content in contents.items():
+            # erased words need not be written
+            content = bytes(content)
+            if content.count(0xFF) == len(content):
+                continue
+            if not self._writeToMem(start, content):
+                return False
+        return True
+
+    def manifestAddress(self, pages: int = INTEGRITY_MANIFEST_PAGES) -> int:
+        """start of the flash tail reserved for the manifest
+
+        Args:
+            pages (int, optional): flash pages reserved. Defaults to
+                INTEGRITY_MANIFEST_PAGES.
+
+        Raises:
+            InformationNotRetrieved: Device type is unknown
+
+        Returns:
+            int: address of the manifest
+        """
+        if self.device is None:
+            raise InformationNotRetrieved
+        return self.device.flash_memory.end - pages * self.device.flash_page_size
+
+    def writeManifest(
+        self, manifest: FlashManifest, pages: int = INTEGRITY_MANIFEST_PAGES
+    ) -> bool:
+        """erase the reserved flash tail and write a manifest into it
+
+        Args:
+            manifest (FlashManifest): the manifest, see integrity.py
+            pages (int, optional): flash pages reserved. Defaults to
+                INTEGRITY_MANIFEST_PAGES.
+
+        Raises:
+            InvalidWriteLengthError: the manifest does not fit the reserved pages
+            InvalidAddressError: the image it describes overlaps the reserved pages
+
+        Returns:
+            bool: Success
+        """
+        address = self.manifestAddress(pages)
+        if len(manifest) > pages * self.device.flash_page_size:
+            raise InvalidWriteLengthError(
+                f"Manifest of {len(manifest)} bytes does not fit in {pages} page(s)"
+            )
+        if manifest.address + manifest.length > address:
+            raise InvalidAddressError(
+                f"Image overlaps the manifest region at {hex(address)}"
+            )
+
+        first = self.device.getFlashPage(address)
+        if not self.eraseFlashPages(list(range(first, first + pages))):
+            return False
+        data = manifest.toBytes()
+        data += bytes([0xFF]) * (-len(data) % 4)
+        return self.writeToFlash(address, bytearray(data))
+
+    def readManifest(self, pages: int = INTEGRITY_MANIFEST_PAGES) -> FlashManifest:
+        """read the manifest from the reserved flash tail. Only the header
+        and the manifest itself are read
+
+        Args:
+            pages (int, optional): flash pages reserved. Defaults to
+                INTEGRITY_MANIFEST_PAGES.
+
+        Raises:
+            InvalidManifestError: there is no valid manifest
+            CommandFailedError: the read failed
+
+        Returns:
+            FlashManifest: the manifest
+        """
+        address = self.manifestAddress(pages)
+        header_size = INTEGRITY_MANIFEST_HEADER.size
+        success, header = self.readFromFlash(address, header_size)
+        if not success:
+            raise CommandFailedError("Unable to read the manifest")
+        size = FlashManifest.ParseHeader(header)
+        if size > pages * self.device.flash_page_size:
+            raise InvalidManifestError("Manifest is larger than its region")
+
+        success, rest = self.readFromFlash(
+            address + header_size, (size - header_size + 3) & ~0b11
+        )
+        if not success:
+            raise CommandFailedError("Unable to read the manifest")
+        return FlashManifest.FromBytes(header + rest)
 
     def isFlashWriteProtected(self):
+        """check if the whole of flash memory is write-protected. See
+        getProtectionMap for per-page protection status
+
+        Returns:
+            bool: every sector is write-protected
+        """
         if not self.connected:
             raise DeviceNotConnectedError
         if not self.device:
             raise InformationNotRetrieved
         if self.device.opt_bytes == None:
             raise InformationNotRetrieved
-        write_prot = False
         if (
             self.device.opt_bytes.write_protect_0 == 0
             and self.device.opt_bytes.write_protect_1 == 0
@@ -470,3 +1707,47 @@ class STMInterface:
             return True
         else:
             return False
+
+    def getProtectionMap(self) -> ProtectionMap:
+        """get the per-page write protection of the flash from the option bytes
+
+        Raises:
+            InformationNotRetrieved: Device type is unknown
+            CommandFailedError: the option bytes could not be read
+
+        Returns:
+            ProtectionMap: the protection map
+        """
+        opt_bytes = self.getOptionBytes()
+        if opt_bytes is None:
+            raise CommandFailedError("Unable to read option bytes")
+        return ProtectionMap(self.device, opt_bytes)
+
+    def isFlashRangeWritable(self, address: int, length: int) -> bool:
+        """check that no page in a flash address range is write-protected
+
+        Args:
+            address (int): flash start address
+            length (int): range length in bytes
+
+        Returns:
+            bool: whole range is writable
+        """
+        return self.getProtectionMap().isRangeWritable(address, length)
+
+    def unprotectForWrite(self, ranges: list, reconnect: bool = True) -> tuple:
+        """unprotect only the write-protected sectors overlapping the ranges
+        about to be written, in a single option-byte update. Protection on
+        every other sector is kept
+
+        Args:
+            ranges (list): (address, length) tuples to be written
+            reconnect (bool, optional): Reconnect after the reset. Defaults to True.
+
+        Returns:
+            tuple: (bool Success, dict field -> (old, new) of the changed settings)
+        """
+        target = self.getProtectionMap().planUnprotect(ranges)
+        if target is None:
+            return True, {}
+        return self.applyOptionBytes(target, reconnect=reconnect)
@@ -0,0 +1,527 @@
+"""
+ file  transport.py
+ Description: The byte transports SerialTool can drive. A transport is any
+ object with the subset of the pyserial Serial interface SerialTool uses:
+ write, read, read_until, reset_input_buffer, setDTR/setRTS, the baudrate,
+ timeout and parity settings, open and close. Local ports use pyserial
+ directly, RFC2217 bridges use pyserial's rfc2217 client and raw TCP
+ bridges (e.g. ser2net in raw mode) use TcpTransport.
+
+ Ports are named by URL:
+    /dev/ttyUSB0, COM3          local serial port
+    tty:///dev/ttyUSB0          local serial port through FdTransport (Linux)
+    tcp://host:port             raw TCP bridge, also socket://host:port
+    rfc2217://host:port         RFC2217 bridge, with baud and DTR/RTS control
+"""
+
+from __future__ import annotations
+
+import errno
+import os
+import socket
+import struct
+from array import array
+from time import monotonic
+from serial import rfc2217, serial_for_url
+from serial.serialutil import (
+    PARITY_EVEN,
+    PARITY_NONE,
+    PARITY_ODD,
+    SerialException,
+    SerialTimeoutException,
+)
+
+try:
+    import fcntl
+    import select
+    import termios
+except ImportError:
+    # not a POSIX host, FdTransport is unavailable
+    termios = None
+
+TRANSPORT_TCP_SCHEMES = ("tcp", "socket")
+TRANSPORT_CONNECT_TIMEOUT_S = 5.0
+# the largest response is a 256-byte read, one recv normally takes it all
+TRANSPORT_RECV_SIZE = 4096
+TRANSPORT_TTY_SCHEME = "tty"
+# USB serial adaptors with a latency timer (FTDI) list it here, in ms
+TRANSPORT_USB_SERIAL_SYSFS = "/sys/bus/usb-serial/devices"
+TRANSPORT_LATENCY_TIMER_MS = 1
+# serial_struct flag for the driver's low latency mode, and the ioctls
+# reading and writing serial_struct, as pyserial uses them
+TRANSPORT_ASYNC_LOW_LATENCY = 0x2000
+TRANSPORT_TIOCGSERIAL = 0x541E
+TRANSPORT_TIOCSSERIAL = 0x541F
+
+
+def openTransport(
+    url: str,
+    baud: int = 57600,
+    timeout: float = 1.0,
+    write_timeout: float = 1.0,
+):
+    """open a transport by port name or URL, see the module description
+
+    Args:
+        url (str): port name or URL
+        baud (int, optional): baud rate. Defaults to 57600.
+        timeout (float, optional): read timeout in seconds. Defaults to 1.0.
+        write_timeout (float, optional): write timeout in seconds. Defaults to 1.0.
+
+    Raises:
+        SerialException: the port or bridge could not be opened
+
+    Returns:
+        the open transport
+    """
+    scheme, sep, address = url.partition("://")
+    if sep and scheme.lower() in TRANSPORT_TCP_SCHEMES:
+        host, _, port = address.partition("/")[0].rpartition(":")
+        try:
+            port = int(port)
+        except ValueError:
+            raise SerialException(f"Expected tcp://host:port, got {url}")
+        return TcpTransport(host, port, baud, timeout, write_timeout)
+    if sep and scheme.lower() == TRANSPORT_TTY_SCHEME:
+        return FdTransport(address, baud, timeout, write_timeout)
+    if sep and scheme.lower() == "rfc2217":
+        return Rfc2217Transport(
+            url, baudrate=baud, timeout=timeout, write_timeout=write_timeout
+        )
+    # local ports and the other pyserial URL handlers
+    return serial_for_url(
+        url, baudrate=baud, timeout=timeout, write_timeout=write_timeout
+    )
+
+
+class Rfc2217Transport(rfc2217.Serial):
+    """pyserial's RFC2217 client, which already disables Nagle's algorithm
+    and sends each write whole. It has no write timeout, so the setting is
+    kept for SerialTool but not applied"""
+
+    @property
+    def write_timeout(self) -> float:
+        return self._bridge_write_timeout
+
+    @write_timeout.setter
+    def write_timeout(self, timeout: float) -> None:
+        self._bridge_write_timeout = timeout
+
+
+class _BufferedTransport:
+    """internal base: reads served from a receive buffer which subclasses
+    fill with _recv(timeout), returning False if nothing arrived in time"""
+
+    def _fill(self, done) -> None:
+        """internal method: receive until done() or the read timeout"""
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        while not done():
+            remaining = None if deadline is None else deadline - monotonic()
+            if remaining is not None and remaining <= 0:
+                return
+            self._recv(remaining)
+
+    @property
+    def in_waiting(self) -> int:
+        while self._recv(0):
+            pass
+        return len(self._buffer)
+
+    def read(self, size: int = 1) -> bytes:
+        self._fill(lambda: len(self._buffer) >= size)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read_until(self, expected: bytes = b"\n", size: int = None) -> bytes:
+        def end() -> int:
+            index = self._buffer.find(expected)
+            stop = len(self._buffer) + 1 if index < 0 else index + len(expected)
+            return stop if size is None else min(stop, size)
+
+        self._fill(lambda: end() <= len(self._buffer))
+        stop = min(end(), len(self._buffer))
+        data = bytes(self._buffer[:stop])
+        del self._buffer[:stop]
+        return data
+
+    def reset_input_buffer(self) -> None:
+        self.in_waiting
+        self._buffer.clear()
+
+    def reset_output_buffer(self) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+
+class TcpTransport(_BufferedTransport):
+    """A serial bridge reached over raw TCP. Nagle's algorithm is disabled
+    and each write is sent whole, so every bootloader frame leaves in one
+    segment as soon as it is written instead of waiting on the previous
+    frame's ACK. Received data is buffered so the byte-at-a-time ACK reads
+    cost no extra system calls
+
+    A raw bridge has no control lines and fixes the line settings on the
+    bridge side: DTR and RTS changes are recorded but not sent, so resets
+    must be done another way, and baudrate and parity are only reported
+
+    Args:
+        host (str): bridge host
+        port (int): bridge TCP port
+        baudrate (int, optional): the bridge's baud rate, for timing. Defaults to 57600.
+        timeout (float, optional): read timeout in seconds. Defaults to 1.0.
+        write_timeout (float, optional): write timeout in seconds. Defaults to 1.0.
+        do_not_open (bool, optional): leave the connection closed. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        baudrate: int = 57600,
+        timeout: float = 1.0,
+        write_timeout: float = 1.0,
+        do_not_open: bool = False,
+    ):
+        self.host = host
+        self.tcp_port = port
+        self.port = f"tcp://{host}:{port}"
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+        self.parity = None
+        self.dtr = False
+        self.rts = False
+        self._socket = None
+        self._buffer = bytearray()
+        if not do_not_open:
+            self.open()
+
+    @property
+    def is_open(self) -> bool:
+        return self._socket is not None
+
+    def open(self) -> None:
+        if self._socket is not None:
+            return
+        try:
+            sock = socket.create_connection(
+                (self.host, self.tcp_port), TRANSPORT_CONNECT_TIMEOUT_S
+            )
+        except OSError as e:
+            raise SerialException(f"Could not connect to {self.port}: {e}")
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._socket = sock
+        self._buffer.clear()
+
+    def close(self) -> None:
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def setDTR(self, state: bool) -> None:
+        self.dtr = bool(state)
+
+    def setRTS(self, state: bool) -> None:
+        self.rts = bool(state)
+
+    # ============ DATA ============#
+
+    def _recv(self, timeout: float) -> bool:
+        """internal method: receive into the buffer, waiting up to timeout
+        seconds (None waits forever). Returns False if nothing arrived"""
+        if self._socket is None:
+            raise SerialException("Transport is not open")
+        self._socket.settimeout(timeout)
+        try:
+            data = self._socket.recv(TRANSPORT_RECV_SIZE)
+        except (socket.timeout, BlockingIOError):
+            return False
+        except OSError as e:
+            raise SerialException(f"Connection to {self.port} failed: {e}")
+        if not data:
+            self.close()
+            raise SerialException(f"Connection to {self.port} closed by the bridge")
+        self._buffer += data
+        return True
+
+    def write(self, data) -> int:
+        if self._socket is None:
+            raise SerialException("Transport is not open")
+        self._socket.settimeout(self.write_timeout)
+        try:
+            self._socket.sendall(data)
+        except socket.timeout:
+            raise SerialTimeoutException("Write timeout")
+        except OSError as e:
+            raise SerialException(f"Connection to {self.port} failed: {e}")
+        return len(data)
+
+
+class FdTransport(_BufferedTransport):
+    """A local serial port driven through its file descriptor with termios
+    and poll, for Linux hosts. Each read is one poll and one read system
+    call rather than pyserial's general purpose loop, which matters for
+    the single byte ACK reads of every command
+
+    When the port is opened the driver's low latency mode is set and a
+    USB adaptor's latency timer is lowered through sysfs where the driver
+    and permissions allow it. FTDI adaptors default to 16ms, which is
+    added to every ACK. The original settings are restored on close
+
+    Args:
+        port (str): device path, e.g. /dev/ttyUSB0
+        baudrate (int, optional): baud rate. Defaults to 57600.
+        timeout (float, optional): read timeout in seconds. Defaults to 1.0.
+        write_timeout (float, optional): write timeout in seconds. Defaults to 1.0.
+        latencyTimer (int, optional): latency timer to set in ms, None to leave it.
+            Defaults to TRANSPORT_LATENCY_TIMER_MS.
+        sysfsRoot (str, optional): where USB serial devices are listed. Defaults to
+            TRANSPORT_USB_SERIAL_SYSFS.
+        do_not_open (bool, optional): leave the port closed. Defaults to False.
+
+    Raises:
+        SerialException: the port could not be opened or configured
+    """
+
+    def __init__(
+        self,
+        port: str,
+        baudrate: int = 57600,
+        timeout: float = 1.0,
+        write_timeout: float = 1.0,
+        latencyTimer: int = TRANSPORT_LATENCY_TIMER_MS,
+        sysfsRoot: str = TRANSPORT_USB_SERIAL_SYSFS,
+        do_not_open: bool = False,
+    ):
+        if termios is None:
+            raise SerialException("FdTransport needs a POSIX host")
+        self.port = port
+        self._baudrate = baudrate
+        self._parity = PARITY_NONE
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+        self.latency_timer = latencyTimer
+        self.sysfs_root = sysfsRoot
+        self.low_latency = False
+        self._fd = None
+        self._buffer = bytearray()
+        self._saved = {}
+        if not do_not_open:
+            self.open()
+
+    @property
+    def is_open(self) -> bool:
+        return self._fd is not None
+
+    @property
+    def baudrate(self) -> int:
+        return self._baudrate
+
+    @baudrate.setter
+    def baudrate(self, baud: int) -> None:
+        self._baudrate = baud
+        if self._fd is not None:
+            self._configure()
+
+    @property
+    def parity(self) -> str:
+        return self._parity
+
+    @parity.setter
+    def parity(self, parity: str) -> None:
+        self._parity = parity
+        if self._fd is not None:
+            self._configure()
+
+    # ============ OPEN/CLOSE ============#
+
+    def open(self) -> None:
+        if self._fd is not None:
+            return
+        try:
+            self._fd = os.open(self.port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        except OSError as e:
+            raise SerialException(f"Could not open {self.port}: {e}")
+        self._buffer.clear()
+        self._saved = {"termios": termios.tcgetattr(self._fd)}
+        self._poll_in = select.poll()
+        self._poll_in.register(self._fd, select.POLLIN)
+        self._poll_out = select.poll()
+        self._poll_out.register(self._fd, select.POLLOUT)
+        try:
+            self._configure()
+        except SerialException:
+            self.close()
+            raise
+        self._setLowLatency()
+        self._setLatencyTimer()
+
+    def close(self) -> None:
+        if self._fd is None:
+            return
+        # restore in reverse order, each one best effort
+        timer = self._saved.get("latency_timer")
+        if timer is not None:
+            try:
+                with open(self._latencyTimerPath(), "w") as fp:
+                    fp.write(timer)
+            except OSError:
+                pass
+        flags = self._saved.get("serial_flags")
+        if flags is not None:
+            try:
+                self._serialStruct(flags)
+            except OSError:
+                pass
+        try:
+            termios.tcsetattr(self._fd, termios.TCSANOW, self._saved["termios"])
+        except termios.error:
+            pass
+        os.close(self._fd)
+        self._fd = None
+
+    def _configure(self) -> None:
+        """internal method: raw 8-bit mode, the baud rate and parity, and
+        non-blocking reads"""
+        speed = getattr(termios, f"B{self._baudrate}", None)
+        if speed is None:
+            raise SerialException(f"Unsupported baud rate {self._baudrate}")
+        iflag, oflag, cflag, lflag, _, _, cc = termios.tcgetattr(self._fd)
+        original_cflag = cflag
+        cflag &= ~(termios.CSIZE | termios.PARENB | termios.PARODD | termios.CSTOPB)
+        cflag &= ~getattr(termios, "CRTSCTS", 0)
+        cflag |= termios.CS8 | termios.CREAD | termios.CLOCAL
+        if self._parity == PARITY_EVEN:
+            cflag |= termios.PARENB
+        elif self._parity == PARITY_ODD:
+            cflag |= termios.PARENB | termios.PARODD
+        elif self._parity != PARITY_NONE:
+            raise SerialException(f"Unsupported parity {self._parity}")
+        cc = list(cc)
+        cc[termios.VMIN] = 0
+        cc[termios.VTIME] = 0
+        attrs = [0, 0, cflag, 0, speed, speed, cc]
+        try:
+            termios.tcsetattr(self._fd, termios.TCSANOW, attrs)
+        except termios.error as e:
+            # pseudo terminals have no line, some kernels refuse line settings
+            # on them. The rest of raw mode still applies
+            if e.args[0] != errno.EINVAL or not os.ttyname(self._fd).startswith(
+                "/dev/pts/"
+            ):
+                raise SerialException(f"Could not configure {self.port}: {e}")
+            attrs[2] = original_cflag
+            termios.tcsetattr(self._fd, termios.TCSANOW, attrs)
+
+    def _serialStruct(self, flags: int = None) -> int:
+        """internal method: read the driver's serial_struct flags, setting
+        them first if given"""
+        buffer = array("i", [0] * 32)
+        fcntl.ioctl(self._fd, TRANSPORT_TIOCGSERIAL, buffer)
+        if flags is not None:
+            buffer[4] = flags
+            fcntl.ioctl(self._fd, TRANSPORT_TIOCSSERIAL, buffer)
+        return buffer[4]
+
+    def _setLowLatency(self) -> None:
+        """internal method: turn on the driver's low latency mode"""
+        try:
+            flags = self._serialStruct()
+            if not flags & TRANSPORT_ASYNC_LOW_LATENCY:
+                self._serialStruct(flags | TRANSPORT_ASYNC_LOW_LATENCY)
+                self._saved["serial_flags"] = flags
+            self.low_latency = True
+        except OSError:
+            # not a real UART driver, e.g. a pty or CDC ACM
+            self.low_latency = False
+
+    def _latencyTimerPath(self) -> str:
+        name = os.path.basename(os.path.realpath(self.port))
+        return os.path.join(self.sysfs_root, name, "latency_timer")
+
+    def _setLatencyTimer(self) -> None:
+        """internal method: lower the USB adaptor's latency timer"""
+        if self.latency_timer is None:
+            return
+        path = self._latencyTimerPath()
+        try:
+            with open(path) as fp:
+                original = fp.read().strip()
+            if original != str(self.latency_timer):
+                with open(path, "w") as fp:
+                    fp.write(str(self.latency_timer))
+                self._saved["latency_timer"] = original
+        except OSError:
+            # no latency timer, or not allowed to change it
+            self.latency_timer = None
+
+    # ============ CONTROL LINES ============#
+
+    def _setLine(self, line: int, state: bool) -> None:
+        request = termios.TIOCMBIS if state else termios.TIOCMBIC
+        try:
+            fcntl.ioctl(self._fd, request, struct.pack("I", line))
+        except OSError as e:
+            # pseudo terminals have no modem lines
+            if e.errno not in (errno.EINVAL, errno.ENOTTY):
+                raise
+
+    def setDTR(self, state: bool) -> None:
+        self._setLine(termios.TIOCM_DTR, state)
+
+    def setRTS(self, state: bool) -> None:
+        self._setLine(termios.TIOCM_RTS, state)
+
+    # ============ DATA ============#
+
+    def _read(self) -> bytes:
+        try:
+            return os.read(self._fd, TRANSPORT_RECV_SIZE)
+        except BlockingIOError:
+            return b""
+
+    def _recv(self, timeout: float) -> bool:
+        if self._fd is None:
+            raise SerialException("Transport is not open")
+        data = self._read()
+        if not data and (timeout is None or timeout > 0):
+            events = self._poll_in.poll(None if timeout is None else timeout * 1000)
+            if events:
+                data = self._read()
+                hangup = select.POLLERR | select.POLLHUP | select.POLLNVAL
+                if not data and events[0][1] & hangup:
+                    raise SerialException(f"{self.port} was disconnected")
+        self._buffer += data
+        return bool(data)
+
+    def write(self, data) -> int:
+        if self._fd is None:
+            raise SerialException("Transport is not open")
+        view = memoryview(data).cast("B")
+        deadline = (
+            None if self.write_timeout is None else monotonic() + self.write_timeout
+        )
+        while view:
+            try:
+                view = view[os.write(self._fd, view) :]
+                continue
+            except BlockingIOError:
+                pass
+            remaining = None if deadline is None else deadline - monotonic()
+            if remaining is not None and remaining <= 0:
+                raise SerialTimeoutException("Write timeout")
+            self._poll_out.poll(None if remaining is None else remaining * 1000)
+        return len(data)
+
+    def reset_input_buffer(self) -> None:
+        termios.tcflush(self._fd, termios.TCIFLUSH)
+        self._buffer.clear()
+
+    def reset_output_buffer(self) -> None:
+        termios.tcflush(self._fd, termios.TCOFLUSH)
+
+    def flush(self) -> None:
+        termios.tcdrain(self._fd)
@@ -0,0 +1,144 @@
+"""
+ file  verify.py
+ Description: Comparison of flash readback against the expected image.
+ Equal blocks are skipped with a single bytes comparison, and blocks which
+ differ are diffed whole: with NumPy when it is installed, otherwise by
+ XORing the blocks as integers and scanning the result for non-zero runs.
+ Neither path loops over bytes in Python, so verifying adds nothing
+ noticeable to the time the readback takes on the link.
+"""
+
+from __future__ import annotations
+
+import re
+from collections import namedtuple
+from dataclasses import dataclass, field
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# bytes compared at a time by findMismatches
+VERIFY_BLOCK_SIZE = 64 * 1024
+
+# a run of differing bytes and the flash pages it touches
+Mismatch = namedtuple("Mismatch", ["address", "length", "pages"])
+
+_NONZERO_RUN = re.compile(rb"[^\x00]+")
+
+
+def _diffRuns(expected, actual, address: int) -> list:
+    """internal method: [start, end) address ranges where two equal length
+    blocks differ"""
+    if numpy is not None:
+        diff = numpy.frombuffer(expected, numpy.uint8) != numpy.frombuffer(
+            actual, numpy.uint8
+        )
+        edges = numpy.flatnonzero(
+            numpy.diff(numpy.concatenate(([False], diff, [False])).astype(numpy.int8))
+        )
+        return [
+            (address + int(start), address + int(end))
+            for start, end in zip(edges[0::2], edges[1::2])
+        ]
+    xor = int.from_bytes(expected, "little") ^ int.from_bytes(actual, "little")
+    xor = xor.to_bytes(len(expected), "little")
+    return [
+        (address + run.start(), address + run.end())
+        for run in _NONZERO_RUN.finditer(xor)
+    ]
+
+
+def _merge(ranges: list, new: list) -> None:
+    """internal method: append ranges, joining ones which touch"""
+    for start, end in new:
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+
+
+class MismatchCollector:
+    """Collects the differences between expected data and readback
+    compared a block at a time, in address order. Runs which cross block
+    boundaries are joined
+    """
+
+    def __init__(self):
+        self.ranges = []
+
+    def compare(self, address: int, expected, actual) -> bool:
+        """compare one block. A short readback counts as differing from
+        where it ends
+
+        Args:
+            address (int): address of the block
+            expected: expected bytes
+            actual: bytes read back
+
+        Returns:
+            bool: the block matched
+        """
+        if expected == actual:
+            return True
+        common = min(len(expected), len(actual))
+        runs = _diffRuns(
+            memoryview(expected)[:common], memoryview(actual)[:common], address
+        )
+        if common < len(expected):
+            runs.append((address + common, address + len(expected)))
+        _merge(self.ranges, runs)
+        return False
+
+    def mismatches(self) -> list:
+        """the differing ranges
+
+        Returns:
+            list: (address, length) of each run of differing bytes
+        """
+        return [(start, end - start) for start, end in self.ranges]
+
+
+def findMismatches(expected, actual, address: int = 0) -> list:
+    """compare expected data with what was read back
+
+    Args:
+        expected: expected bytes
+        actual: bytes read back, missing bytes count as differing
+        address (int, optional): address of the first byte. Defaults to 0.
+
+    Returns:
+        list: (address, length) of each run of differing bytes
+    """
+    collector = MismatchCollector()
+    expected = memoryview(expected).cast("B")
+    actual = memoryview(actual).cast("B")
+    for offset in range(0, len(expected), VERIFY_BLOCK_SIZE):
+        collector.compare(
+            address + offset,
+            expected[offset : offset + VERIFY_BLOCK_SIZE],
+            actual[offset : offset + VERIFY_BLOCK_SIZE],
+        )
+    return collector.mismatches()
+
+
+@dataclass
+class VerifyReport:
+    """the result of verifying a range of flash: each mismatch with the
+    pages it touches, and the pages reprogrammed if repair was asked for"""
+
+    address: int
+    length: int
+    mismatches: list = field(default_factory=list)
+    repaired: list = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        """the flash matched"""
+        return not self.mismatches
+
+    @property
+    def pages(self) -> list:
+        """pages with mismatches, in order"""
+        return sorted({page for m in self.mismatches for page in m.pages})
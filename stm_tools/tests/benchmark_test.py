@@ -0,0 +1,99 @@
+#! Tests for the host-side microbenchmarks and baseline comparison
+#
+
+import io
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from stm_tools.serialflasher import cli
+from stm_tools.serialflasher.benchmark import *
+from stm_tools.serialflasher.serialtool import SerialTool
+from stm_tools.serialflasher.simulator import NullSerial
+
+
+class NullSerialTestCase(unittest.TestCase):
+    def testCommandsComplete(self):
+        tool = SerialTool(serial=NullSerial())
+        self.assertTrue(tool.cmdWriteToMemoryAddress(0x08000000, bytes(256)))
+        success, rx = tool.cmdReadFromMemoryAddress(0x08000000, 256)
+        self.assertTrue(success)
+        self.assertEqual(rx, bytes(256))
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "baseline.json")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def testMeasure(self):
+        result = measure(BenchmarkCase("alloc", lambda: bytearray(4096), 10), 2)
+        self.assertEqual(result.name, "alloc")
+        self.assertGreater(result.ns_per_op, 0)
+        self.assertGreaterEqual(result.peak_bytes, 4096)
+
+    def testDefaultBaselinePath(self):
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(self.dir.name)
+        env = os.environ.pop(BENCH_BASELINE_ENV, None)
+        if env is not None:
+            self.addCleanup(os.environ.__setitem__, BENCH_BASELINE_ENV, env)
+
+        expected = os.path.join(os.getcwd(), BENCH_BASELINE_NAME)
+        self.assertEqual(defaultBaselinePath(), expected)
+        self.assertEqual(loadBaseline(), {})
+        results = [BenchmarkResult("a", 1.0, 0)]
+        saveBaseline(results)
+        self.assertEqual(list(loadBaseline().values()), results)
+
+        os.environ[BENCH_BASELINE_ENV] = self.path
+        self.addCleanup(os.environ.pop, BENCH_BASELINE_ENV, None)
+        self.assertEqual(defaultBaselinePath(), self.path)
+        self.assertEqual(loadBaseline(), {})
+
+    def testRoundTrip(self):
+        results = runBenchmarks(repeat=1, scale=0.001)
+        saveBaseline(results, self.path)
+        baseline = loadBaseline(self.path)
+        self.assertEqual([baseline[r.name] for r in results], results)
+        self.assertEqual(loadBaseline(os.path.join(self.dir.name, "none.json")), {})
+
+    def testFindRegressions(self):
+        baseline = {
+            "a": BenchmarkResult("a", 100.0, 10000),
+            "b": BenchmarkResult("b", 100.0, 10000),
+        }
+        results = [
+            BenchmarkResult("a", 140.0, 11000),
+            BenchmarkResult("b", 200.0, 20000),
+            BenchmarkResult("new", 1e9, 10**9),
+        ]
+        regressions = findRegressions(results, baseline)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(all(r.startswith("b:") for r in regressions))
+        self.assertEqual(findRegressions(results, baseline, 3, memoryTolerance=3), [])
+
+    def testCli(self):
+        args = ["bench", "--baseline", self.path, "--repeat", "1", "--scale", "0.001"]
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(cli.main(args + ["--record"]), 0)
+        # a baseline nothing can beat
+        saveBaseline(
+            [
+                BenchmarkResult(r.name, 0.001, 0)
+                for r in loadBaseline(self.path).values()
+            ],
+            self.path,
+        )
+        err = io.StringIO()
+        with redirect_stdout(io.StringIO()), redirect_stderr(err):
+            self.assertEqual(cli.main(args), 1)
+        self.assertIn("REGRESSION", err.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+#! Tests for the DeviceInfoCache class
+#
+
+import unittest
+from stm_tools.serialflasher.cache import BootloaderInfo, DeviceInfoCache
+from stm_tools.serialflasher.constants import *
+from stm_tools.serialflasher.serialtool import SerialTool
+from stm_tools.serialflasher.simulator import SimulatedBootloader, SimulatedSerial
+from stm_tools.serialflasher.stmdevice import STMInterface
+
+CACHE_TEST_PORT = "/dev/ttyUSB0"
+CACHE_TEST_UID = 0x1234
+CACHE_TEST_INFO = BootloaderInfo(
+    0x0410, 2.2, frozenset([STM_CMD_GET, STM_CMD_ERASE_MEM]), CACHE_TEST_UID
+)
+
+
+class CommandCountingSerialTool(SerialTool):
+    """counts GET ID and GET commands"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ids = 0
+        self.gets = 0
+
+    def cmdGetId(self):
+        self.ids += 1
+        return super().cmdGetId()
+
+    def cmdGetInfo(self):
+        self.gets += 1
+        return super().cmdGetInfo()
+
+
+class DeviceInfoCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = DeviceInfoCache()
+
+    def testGetEmpty(self):
+        self.assertIsNone(self.cache.get(CACHE_TEST_PORT))
+
+    def testPutGetByPort(self):
+        self.cache.put(CACHE_TEST_PORT, CACHE_TEST_INFO)
+        self.assertIs(self.cache.get(CACHE_TEST_PORT), CACHE_TEST_INFO)
+
+    def testPutGetByUid(self):
+        self.cache.put(CACHE_TEST_PORT, CACHE_TEST_INFO)
+        self.assertIs(self.cache.getByUid(CACHE_TEST_UID), CACHE_TEST_INFO)
+
+    def testInvalidatePort(self):
+        self.cache.put(CACHE_TEST_PORT, CACHE_TEST_INFO)
+        self.cache.invalidate(CACHE_TEST_PORT)
+        self.assertIsNone(self.cache.get(CACHE_TEST_PORT))
+        self.assertIsNone(self.cache.getByUid(CACHE_TEST_UID))
+
+
+class DeviceIdentityTestCase(unittest.TestCase):
+    """boards swapped on one port must never inherit each other's identity"""
+
+    def setUp(self):
+        self.cache = DeviceInfoCache()
+        self.board_a = SimulatedBootloader(pid=0x0410, uid=b"\xaa" * 12)
+        self.board_b = SimulatedBootloader(pid=0x0414, uid=b"\xbb" * 12)
+
+    def connect(self, bootloader) -> STMInterface:
+        tool = CommandCountingSerialTool(serial=SimulatedSerial(bootloader))
+        stm = STMInterface(tool, self.cache)
+        stm.connectToDevice()
+        stm.readDeviceInfo()
+        return stm
+
+    def testSwappedBoardIsReidentified(self):
+        self.assertEqual(self.connect(self.board_a).device.pid, 0x0410)
+        stm = self.connect(self.board_b)
+        self.assertEqual(stm.device.pid, 0x0414)
+        self.assertEqual(stm.device.flash_page_num, 256)
+        self.assertEqual(stm.device.uid, int.from_bytes(b"\xbb" * 12, "little"))
+        self.assertEqual(self.cache.get("sim://0").pid, 0x0414)
+        self.assertIsNone(self.cache.getByUid(int.from_bytes(b"\xaa" * 12, "little")))
+
+    def testSamePidDifferentUid(self):
+        self.connect(self.board_a)
+        twin = SimulatedBootloader(pid=0x0410, uid=b"\xcc" * 12)
+        stm = self.connect(twin)
+        self.assertEqual(stm.device.uid, int.from_bytes(b"\xcc" * 12, "little"))
+        self.assertEqual(stm.serialTool.gets, 1)
+
+    def testSameBoardSkipsGet(self):
+        self.connect(self.board_a)
+        self.board_a.reset()
+        stm = self.connect(self.board_a)
+        self.assertEqual(stm.serialTool.ids, 1)
+        self.assertEqual(stm.serialTool.gets, 0)
+
+    def testReconnectInSessionReusesIdentity(self):
+        stm = self.connect(self.board_a)
+        stm.readDeviceInfo()
+        self.assertEqual(stm.serialTool.ids, 1)
+        self.assertEqual(stm.device.uid, int.from_bytes(b"\xaa" * 12, "little"))
@@ -0,0 +1,161 @@
+#! Tests for cloning a source device to many targets, run against simulated bootloaders
+#
+
+import unittest
+from stm_tools.serialflasher.cache import DeviceInfoCache
+from stm_tools.serialflasher.clone import *
+from stm_tools.serialflasher.devices import OptionBytes
+from stm_tools.serialflasher.errors import *
+from stm_tools.serialflasher.progress import CancellationToken
+from stm_tools.serialflasher.serialtool import SerialTool
+from stm_tools.serialflasher.simulator import SimulatedBootloader, SimulatedSerial
+from stm_tools.serialflasher.stmdevice import STMInterface
+
+CLONE_TEST_PAGE = 1024
+
+
+class FlakySerialTool(SerialTool):
+    """fails writes or reads at one address, or flips a bit in every flash
+    read"""
+
+    def __init__(
+        self, *args, failAddress=None, failRead=None, corruptReads=False, **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.fail_address = failAddress
+        self.fail_read = failRead
+        self.corrupt_reads = corruptReads
+        self.writes = 0
+
+    def cmdWriteFramed(self, address_frame, data_frame):
+        self.writes += 1
+        if int.from_bytes(address_frame[:4], "big") == self.fail_address:
+            return False
+        return super().cmdWriteFramed(address_frame, data_frame)
+
+    def cmdReadFromMemoryAddress(self, address, length):
+        if address == self.fail_read:
+            return False, bytearray()
+        success, rx = super().cmdReadFromMemoryAddress(address, length)
+        if self.corrupt_reads and rx and address < 0x1FFFF000:
+            rx = bytes([rx[0] ^ 1]) + rx[1:]
+        return success, rx
+
+
+def connect(bootloader, **kwargs) -> STMInterface:
+    tool = FlakySerialTool(serial=SimulatedSerial(bootloader), **kwargs)
+    stm = STMInterface(tool, DeviceInfoCache())
+    stm.connectToDevice()
+    stm.readDeviceInfo()
+    return stm
+
+
+class CloneDeviceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.source = SimulatedBootloader()
+        flash = self.source.flash
+        flash[0 : 3 * CLONE_TEST_PAGE] = bytes(i & 0xFF for i in range(3072))
+        flash[40 * CLONE_TEST_PAGE : 40 * CLONE_TEST_PAGE + 4] = b"\x01\x02\x03\x04"
+        opt = OptionBytes.FromBytes(bytes(self.source.option_bytes))
+        opt.dataByte0 = 0x5A
+        self.source.option_bytes[:] = opt.toBytes()
+        self.source.reset()
+        self.targets = [SimulatedBootloader() for _ in range(3)]
+        for target in self.targets:
+            # stale firmware from the unit's previous life
+            target.flash[:] = bytes([0x00]) * len(target.flash)
+
+    def testClonesPopulatedPagesAndOptionBytes(self):
+        source = connect(self.source)
+        targets = [connect(target) for target in self.targets]
+        events = []
+        results = cloneDevice(source, targets, progress=events.append)
+
+        self.assertEqual(len(results), 3)
+        for result, target in zip(results, self.targets):
+            self.assertTrue(result.ok, result.error)
+            self.assertEqual(result.pages, [0, 1, 2, 40])
+            self.assertEqual(result.mismatches, [])
+            self.assertIn("data_byte_0", result.option_bytes)
+            self.assertEqual(target.flash, self.source.flash)
+            self.assertEqual(target.option_bytes, self.source.option_bytes)
+        # the source was read once
+        self.assertEqual(events[-1].done, len(self.source.flash))
+        self.assertEqual(source.serialTool.writes, 0)
+
+    def testOneFailingTargetDoesNotStopTheOthers(self):
+        source = connect(self.source)
+        bad = connect(self.targets[0], failAddress=0x08000000 + CLONE_TEST_PAGE)
+        good = [connect(target) for target in self.targets[1:]]
+        results = cloneDevice(source, [bad] + good, queuePages=1)
+
+        self.assertFalse(results[0].ok)
+        self.assertIsNotNone(results[0].error)
+        self.assertEqual(results[0].pages, [0])
+        self.assertEqual(results[0].option_bytes, {})
+        for result, target in zip(results[1:], self.targets[1:]):
+            self.assertTrue(result.ok)
+            self.assertEqual(target.flash, self.source.flash)
+
+    def testVerifyReportsMismatchedPages(self):
+        source = connect(self.source)
+        target = connect(self.targets[0], corruptReads=True)
+        (result,) = cloneDevice(source, [target])
+        self.assertFalse(result.ok)
+        self.assertEqual(result.mismatches, [0, 1, 2, 40])
+        # option bytes are left alone on a unit which did not verify
+        self.assertEqual(result.option_bytes, {})
+
+    def testWithoutOptionBytesOrVerify(self):
+        source = connect(self.source)
+        target = connect(self.targets[0], corruptReads=True)
+        (result,) = cloneDevice(source, [target], optionBytes=False, verify=False)
+        self.assertTrue(result.ok)
+        self.assertNotEqual(self.targets[0].option_bytes, self.source.option_bytes)
+        self.assertEqual(self.targets[0].flash, self.source.flash)
+
+    def testRejectsDifferentPart(self):
+        source = connect(self.source)
+        other = connect(SimulatedBootloader(pid=0x0414))
+        with self.assertRaises(DeviceNotSupportedError):
+            cloneDevice(source, [other])
+
+    def testSourceReadFailsMidFlash(self):
+        # page 10 fails, after pages 0-2 have been queued
+        source = connect(self.source, failRead=0x08000000 + 10 * CLONE_TEST_PAGE)
+        target = connect(self.targets[0])
+        options = bytes(self.targets[0].option_bytes)
+        with self.assertRaises(CommandFailedError) as raised:
+            cloneDevice(source, [target])
+
+        (result,) = raised.exception.results
+        self.assertFalse(result.ok)
+        self.assertIs(result.error, raised.exception)
+        self.assertTrue(result.erased)
+        self.assertEqual(result.pages, [0, 1, 2])
+        self.assertEqual(result.mismatches, [])
+        self.assertEqual(result.option_bytes, {})
+        self.assertEqual(bytes(self.targets[0].option_bytes), options)
+
+    def testCancel(self):
+        source = connect(self.source)
+        targets = [connect(target) for target in self.targets]
+        options = [bytes(target.option_bytes) for target in self.targets]
+        token = CancellationToken()
+        token.cancel()
+        with self.assertRaises(OperationCancelledError) as raised:
+            cloneDevice(source, targets, cancel=token)
+
+        results = raised.exception.results
+        self.assertEqual(len(results), 3)
+        for result, target, before in zip(results, self.targets, options):
+            self.assertFalse(result.erased)
+            self.assertIsInstance(result.error, OperationCancelledError)
+            self.assertEqual(result.pages, [])
+            # never erased, so the stale firmware is still there
+            self.assertEqual(target.flash, bytes(len(target.flash)))
+            self.assertEqual(bytes(target.option_bytes), before)
+
+
+if __name__ == "__main__":
+    unittest.main()
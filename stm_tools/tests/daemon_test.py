@@ -0,0 +1,214 @@
+#! Tests for the provisioning daemon, run against simulated bootloaders
+#
+
+import base64
+import json
+import os
+import tempfile
+import unittest
+from http.client import HTTPConnection
+from socket import AF_UNIX, socket
+from stm_tools.serialflasher.cache import DeviceInfoCache
+from stm_tools.serialflasher.daemon import *
+from stm_tools.serialflasher.devices import DeviceType
+from stm_tools.serialflasher.serialtool import SerialTool
+from stm_tools.serialflasher.simulator import SimulatedBootloader, SimulatedSerial
+from stm_tools.serialflasher.stmdevice import STMInterface
+
+DAEMON_TEST_ADDRESS = 0x08000400
+DAEMON_TEST_DATA = bytes(range(256)) * 2 + b"\x01\x02"
+DAEMON_TEST_WAIT_S = 5.0
+
+
+class _UnixHTTPConnection(HTTPConnection):
+    def __init__(self, path):
+        super().__init__("localhost")
+        self.path = path
+
+    def connect(self):
+        self.sock = socket(AF_UNIX)
+        self.sock.connect(self.path)
+
+
+class ProvisioningDaemonTestCase(unittest.TestCase):
+    def setUp(self):
+        self.devices = {}
+
+        def factory(port):
+            sim = SimulatedSerial(self.devices[port], port=port)
+            return STMInterface(SerialTool(serial=sim), infoCache=DeviceInfoCache())
+
+        self.devices["sim://0"] = SimulatedBootloader()
+        self.devices["sim://1"] = SimulatedBootloader(pid=0x0430, extended_erase=True)
+        self.daemon = ProvisioningDaemon(SessionPool(factory))
+        self.server = self.daemon.serve(("127.0.0.1", 0))
+
+    def tearDown(self):
+        self.daemon.shutdown()
+
+    def request(self, method, path, body=None, conn=None):
+        if conn is None:
+            conn = HTTPConnection(*self.server.server_address)
+        conn.request(method, path, None if body is None else json.dumps(body))
+        response = conn.getresponse()
+        result = response.status, json.loads(response.read())
+        conn.close()
+        return result
+
+    def runJob(self, port, kind, params=None):
+        status, job = self.request(
+            "POST", "/jobs", {"port": port, "kind": kind, "params": params}
+        )
+        self.assertEqual(status, 202)
+        status, job = self.request(
+            "GET", f"/jobs/{job['id']}?wait={DAEMON_TEST_WAIT_S}"
+        )
+        self.assertEqual(status, 200)
+        return job
+
+    def testFlashVerifyRead(self):
+        data = base64.b64encode(DAEMON_TEST_DATA).decode()
+        job = self.runJob(
+            "sim://1",
+            JOB_FLASH,
+            {"address": DAEMON_TEST_ADDRESS, "data": data, "verify": True},
+        )
+        self.assertEqual(job["status"], JOB_DONE, job["error"])
+        self.assertTrue(job["result"]["match"])
+        # padded to a whole word
+        self.assertEqual(job["result"]["length"], 516)
+
+        job = self.runJob(
+            "sim://1", JOB_VERIFY, {"address": DAEMON_TEST_ADDRESS, "data": data}
+        )
+        self.assertTrue(job["result"]["match"])
+
+        job = self.runJob(
+            "sim://1", JOB_READ, {"address": DAEMON_TEST_ADDRESS, "length": 516}
+        )
+        rx = base64.b64decode(job["result"]["data"])
+        self.assertEqual(rx, DAEMON_TEST_DATA + b"\xff\xff")
+
+    def testVerifyMismatch(self):
+        data = base64.b64encode(b"\x00" * 8).decode()
+        job = self.runJob("sim://0", JOB_VERIFY, {"address": 0x08000000, "data": data})
+        self.assertFalse(job["result"]["match"])
+        self.assertEqual(job["result"]["first_mismatch"], 0x08000000)
+
+    def testSessionKeptWarm(self):
+        for _ in range(3):
+            job = self.runJob("sim://0", JOB_READ, {"address": 0x08000000, "length": 4})
+            self.assertEqual(job["status"], JOB_DONE)
+        status, metrics = self.request("GET", "/metrics")
+        port = metrics["ports"]["sim://0"]
+        self.assertEqual(port["connects"], 1)
+        self.assertEqual(port["jobs_done"], 3)
+        self.assertEqual(metrics["jobs"][JOB_DONE], 3)
+        self.assertEqual(self.devices["sim://0"].resets, 0)
+
+    def testBadJobKeepsSession(self):
+        job = self.runJob("sim://0", JOB_READ, {"address": 0x08000000, "length": 3})
+        self.assertEqual(job["status"], JOB_FAILED)
+        self.assertIn("InvalidReadLengthError", job["error"])
+        job = self.runJob("sim://0", JOB_READ, {"address": 0x08000000, "length": 4})
+        self.assertEqual(job["status"], JOB_DONE)
+        status, metrics = self.request("GET", "/metrics")
+        self.assertEqual(metrics["ports"]["sim://0"]["connects"], 1)
+
+    def testOptionBytes(self):
+        job = self.runJob("sim://0", JOB_OPTION_BYTES)
+        self.assertEqual(job["status"], JOB_DONE, job["error"])
+        self.assertEqual(job["result"]["changes"], {})
+
+        job = self.runJob("sim://0", JOB_OPTION_BYTES, {"set": {"data_byte_0": 0x42}})
+        self.assertEqual(job["status"], JOB_DONE, job["error"])
+        self.assertEqual(job["result"]["option_bytes"]["data_byte_0"], 0x42)
+        self.assertIn("data_byte_0", job["result"]["changes"])
+        self.assertEqual(self.devices["sim://0"].resets, 1)
+
+    def testPortsQueuedIndependently(self):
+        ids = [
+            self.daemon.submit(port, JOB_READ, {"address": 0x08000000, "length": 8}).id
+            for port in ("sim://0", "sim://1", "sim://0")
+        ]
+        for job_id in ids:
+            job = self.daemon.wait(job_id, DAEMON_TEST_WAIT_S)
+            self.assertEqual(job.status, JOB_DONE, job.error)
+        status, ports = self.request("GET", "/ports")
+        self.assertEqual(ports, ["sim://0", "sim://1"])
+
+    def testNoDevice(self):
+        job = self.runJob("sim://9", JOB_READ, {"address": 0x08000000, "length": 4})
+        self.assertEqual(job["status"], JOB_FAILED)
+
+    def testBadRequests(self):
+        status, body = self.request("POST", "/jobs", {"port": "sim://0", "kind": "x"})
+        self.assertEqual(status, 400)
+        status, body = self.request("GET", "/jobs/999")
+        self.assertEqual(status, 404)
+
+    def probedSession(self, port):
+        """a session on port, opened by a job and then probed"""
+        job = self.runJob(port, JOB_READ, {"address": 0x08000000, "length": 4})
+        self.assertEqual(job["status"], JOB_DONE, job["error"])
+        return self.daemon.pool.get(port)
+
+    def testProbeSameDevice(self):
+        session = self.probedSession("sim://0")
+        session._probe()
+        self.assertTrue(session.healthy)
+        self.assertEqual(session.metrics["connects"], 1)
+        self.assertEqual(session.metrics["identity_changes"], 0)
+
+    def testProbeReopensOnNewUid(self):
+        session = self.probedSession("sim://0")
+        cache = session.stm.infoCache
+        self.devices["sim://0"].uid = bytes(range(21, 33))
+        session._probe()
+
+        self.assertTrue(session.healthy)
+        self.assertEqual(session.metrics["identity_changes"], 1)
+        self.assertEqual(session.metrics["connects"], 2)
+        uid = int.from_bytes(bytes(range(21, 33)), "little")
+        self.assertEqual(session.identity, (0x0410, uid))
+        self.assertEqual(session.stm.device.uid, uid)
+        self.assertEqual(cache.get("sim://0").uid, uid)
+
+    def testProbeReopensOnNewPid(self):
+        session = self.probedSession("sim://0")
+        self.devices["sim://0"].device = DeviceType(0x0412, 0)
+        session._probe()
+        self.assertEqual(session.metrics["identity_changes"], 1)
+        self.assertEqual(session.stm.device.pid, 0x0412)
+        self.assertEqual(session.identity[0], 0x0412)
+
+    def testFinishedJobsForgotten(self):
+        daemon = ProvisioningDaemon(self.daemon.pool, keepJobs=2, jobTtl=None)
+        params = {"address": 0x08000000, "length": 4}
+        jobs = [daemon.submit("sim://0", JOB_READ, params) for _ in range(4)]
+        for job in jobs:
+            daemon.wait(job.id, DAEMON_TEST_WAIT_S)
+            self.assertEqual(job.status, JOB_DONE, job.error)
+            self.assertIsNone(job.params)
+
+        self.assertIsNone(daemon.getJob(jobs[0].id))
+        self.assertIsNone(daemon.getJob(jobs[1].id))
+        self.assertIs(daemon.getJob(jobs[3].id), jobs[3])
+        self.assertEqual(daemon.getMetrics()["jobs"][JOB_DONE], 2)
+
+    def testFinishedJobsExpire(self):
+        daemon = ProvisioningDaemon(self.daemon.pool, jobTtl=0)
+        job = daemon.submit("sim://0", JOB_READ, {"address": 0x08000000, "length": 4})
+        self.assertTrue(job.done.wait(DAEMON_TEST_WAIT_S))
+        self.assertIsNone(daemon.getJob(job.id))
+
+    def testUnixSocket(self):
+        path = os.path.join(tempfile.mkdtemp(), "daemon.sock")
+        self.daemon.serve(path)
+        status, body = self.request("GET", "/metrics", conn=_UnixHTTPConnection(path))
+        self.assertEqual(status, 200)
+        self.assertIn("jobs", body)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,11 +2,16 @@ from optparse import Option
 import unittest
 from stm_tools.serialflasher.devices import (
     DeviceType,
+    DeviceDescriptor,
     OptionBytes,
     Region,
     FlashOptionBytes,
+    registerDevice,
+    getDeviceDescriptor,
+    unregisterDevice,
 )
 from stm_tools.serialflasher.errors import *
+from stm_tools.serialflasher.constants import *
 from collections import namedtuple
 
 DEV_TEST_XL_DEVICE_ID = 0x0430
@@ -14,6 +19,8 @@ DEV_TEST_VALID_DEVICE_ID = 0x0410
 DEV_TEST_INVALID_DEVICE_ID = 0xF410
 DEV_TEST_VALID_BOOTLOADER_ID = 2.2
 DEV_TEST_VALID_DEVICE_PAGE_SIZE = 1024
+DEV_TEST_XL_PAGE_NUM = 512
+DEV_TEST_NEW_DEVICE_ID = 0x0418
 DEVICETYPE_TEST_EXAMPLE_OPTBYTES = (
     b"\xa5Z\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff"
 )
@@ -58,3 +65,81 @@ class DeviceTypeTestCase(unittest.TestCase):
         dev.updateOptionBytes(DEVICETYPE_TEST_EXAMPLE_OPTBYTES)
         self.assertEqual(dev.opt_bytes.nUser, 0xA5)
         self.assertEqual(dev.opt_bytes.writeProt0, 0xFF)
+
+    def testDeviceXlFlashPageNum(self):
+        xl_dev = DeviceType(DEV_TEST_XL_DEVICE_ID, DEV_TEST_VALID_BOOTLOADER_ID)
+        self.assertEqual(xl_dev.flash_page_num, DEV_TEST_XL_PAGE_NUM)
+        self.assertEqual(len(xl_dev.flash_pages), DEV_TEST_XL_PAGE_NUM)
+        self.assertEqual(xl_dev.flash_memory.size, DEV_TEST_XL_PAGE_NUM * 2048)
+
+    def testDeviceDescriptorShared(self):
+        dev_a = DeviceType(DEV_TEST_VALID_DEVICE_ID, DEV_TEST_VALID_BOOTLOADER_ID)
+        dev_b = DeviceType(DEV_TEST_VALID_DEVICE_ID, DEV_TEST_VALID_BOOTLOADER_ID)
+        self.assertIs(dev_a.descriptor, dev_b.descriptor)
+        self.assertIs(dev_a.flash_pages, dev_b.flash_pages)
+
+    def testDeviceDescriptorImmutable(self):
+        descriptor = getDeviceDescriptor(DEV_TEST_VALID_DEVICE_ID)
+        with self.assertRaises(AttributeError):
+            descriptor.flash_page_num = 1
+        with self.assertRaises(AttributeError):
+            descriptor.ram.start = 0
+
+    def testRegisterDevice(self):
+        self.addCleanup(unregisterDevice, DEV_TEST_NEW_DEVICE_ID)
+        registerDevice(
+            DeviceDescriptor(
+                pid=DEV_TEST_NEW_DEVICE_ID,
+                name="stm32f10xxxConnectivityLine",
+                ram=Region("ram", 0x20001000, 0x2000FFFF),
+                bootloader_ram=Region("bootloader ram", 0x20000000, 0x20000FFF),
+                system_memory=Region("system memory", 0x1FFFB000, 0x1FFFF7FF),
+                flash_page_size=2048,
+                flash_page_num=128,
+                flash_info_blk_size=2360,
+            )
+        )
+        dev = DeviceType(DEV_TEST_NEW_DEVICE_ID, DEV_TEST_VALID_BOOTLOADER_ID)
+        self.assertEqual(dev.flash_page_num, 128)
+        self.assertEqual(dev.getFlashPageAddress(1), 0x08000800)
+
+    def testUnregisterDevice(self):
+        descriptor = getDeviceDescriptor(DEV_TEST_VALID_DEVICE_ID)
+        self.addCleanup(registerDevice, descriptor)
+        self.assertIs(unregisterDevice(DEV_TEST_VALID_DEVICE_ID), descriptor)
+        self.assertIsNone(unregisterDevice(DEV_TEST_VALID_DEVICE_ID))
+        with self.assertRaises(DeviceNotSupportedError):
+            DeviceType(DEV_TEST_VALID_DEVICE_ID, DEV_TEST_VALID_BOOTLOADER_ID)
+
+    def testPlanFlashEraseLegacyBatches(self):
+        dev = DeviceType(DEV_TEST_VALID_DEVICE_ID, DEV_TEST_VALID_BOOTLOADER_ID)
+        dev.capabilities = frozenset([STM_CMD_ERASE_MEM])
+        batches = dev.planFlashErase([3, 1, 2, 2])
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(batches[0].pages, [1, 2, 3])
+
+    def testPlanFlashEraseLegacyWholeDevice(self):
+        dev = DeviceType(DEV_TEST_VALID_DEVICE_ID, DEV_TEST_VALID_BOOTLOADER_ID)
+        batches = dev.planFlashErase(range(dev.flash_page_num))
+        self.assertEqual(batches, [(STM_EXT_ERASE_MASS, None)])
+
+    def testPlanFlashEraseLegacyHighPage(self):
+        xl_dev = DeviceType(DEV_TEST_XL_DEVICE_ID, DEV_TEST_VALID_BOOTLOADER_ID)
+        xl_dev.capabilities = frozenset([STM_CMD_ERASE_MEM])
+        with self.assertRaises(InvalidAddressError):
+            xl_dev.planFlashErase([300])
+
+    def testPlanFlashEraseExtendedBank(self):
+        xl_dev = DeviceType(DEV_TEST_XL_DEVICE_ID, DEV_TEST_VALID_BOOTLOADER_ID)
+        xl_dev.capabilities = frozenset([STM_CMD_EXT_ERASE])
+        batches = xl_dev.planFlashErase(list(range(256, 512)) + [0, 1])
+        self.assertEqual(batches[0], (STM_EXT_ERASE_BANK2, None))
+        self.assertEqual(batches[1], (None, [0, 1]))
+
+    def testPlanFlashEraseExtendedSingleCommand(self):
+        xl_dev = DeviceType(DEV_TEST_XL_DEVICE_ID, DEV_TEST_VALID_BOOTLOADER_ID)
+        xl_dev.capabilities = frozenset([STM_CMD_EXT_ERASE])
+        pages = list(range(0, 512, 2))
+        batches = xl_dev.planFlashErase(pages)
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(batches[0].pages, pages)
@@ -0,0 +1,96 @@
+#! Tests for bootloader discovery, run against simulated bootloaders
+#
+
+import io
+import unittest
+from contextlib import redirect_stdout
+from threading import Event
+from time import monotonic, sleep
+from stm_tools.serialflasher import cli
+from stm_tools.serialflasher.discovery import *
+from stm_tools.serialflasher.simulator import SimulatedBootloader, SimulatedSerial
+
+DISCOVERY_TEST_TIMEOUT_S = 0.1
+
+
+class SilentSerial(SimulatedSerial):
+    """a port with nothing on the other end: reads wait out the timeout"""
+
+    def read(self, size=1):
+        sleep(self.timeout)
+        return b""
+
+
+class DiscoveryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.devices = {
+            "sim://0": SimulatedBootloader(),
+            "sim://1": SimulatedBootloader(pid=0x0430, uid=bytes(12)),
+        }
+
+    def opener(self, port, baud):
+        if port in self.devices:
+            return SimulatedSerial(self.devices[port], port=port, baudrate=baud)
+        if port.startswith("silent://"):
+            return SilentSerial(port=port, baudrate=baud)
+        raise OSError(f"could not open port {port}")
+
+    def discover(self, ports):
+        return discoverDevices(
+            ports, timeout=DISCOVERY_TEST_TIMEOUT_S, opener=self.opener
+        )
+
+    def testProbeResult(self):
+        result = probePort("sim://0", opener=self.opener)
+        self.assertEqual(result.port, "sim://0")
+        self.assertEqual(result.pid, 0x0410)
+        self.assertEqual(result.version, 2.2)
+        self.assertEqual(result.uid, int.from_bytes(bytes(range(1, 13)), "little"))
+        self.assertEqual(result.name, "stm32f10xxxMedDensity")
+
+    def testProbeMissingPort(self):
+        self.assertIsNone(probePort("/dev/none", opener=self.opener))
+
+    def testDiscoverOnlyResponders(self):
+        results = self.discover(["sim://1", "silent://0", "/dev/none", "sim://0"])
+        self.assertEqual([r.port for r in results], ["sim://0", "sim://1"])
+        self.assertEqual(results[1].pid, 0x0430)
+
+    def testSilentPortsProbedConcurrently(self):
+        start = monotonic()
+        results = self.discover([f"silent://{i}" for i in range(32)])
+        elapsed = monotonic() - start
+        self.assertEqual(results, [])
+        # a serial probe would take 32 timeouts
+        self.assertLess(elapsed, DISCOVERY_TEST_TIMEOUT_S * 8)
+
+    def testWatch(self):
+        ports = [["sim://0"], ["sim://0", "sim://1"], ["sim://1"]]
+        stop = Event()
+
+        def lister():
+            if len(ports) == 1:
+                stop.set()
+            return ports.pop(0) if len(ports) > 1 else ports[0]
+
+        events = [
+            (event, item if event == "removed" else item.port)
+            for event, item in watchDevices(
+                0, stop, lister, timeout=DISCOVERY_TEST_TIMEOUT_S, opener=self.opener
+            )
+        ]
+        self.assertEqual(
+            events,
+            [("added", "sim://0"), ("added", "sim://1"), ("removed", "sim://0")],
+        )
+
+    def testCliNoDevices(self):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            self.assertEqual(
+                cli.main(["discover", "/dev/stm-tools-none", "--timeout", "0.01"]), 1
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+#! Tests for resumable memory dumps, run against the simulated bootloader
+#
+
+import os
+import tempfile
+import unittest
+from stm_tools.serialflasher.cache import DeviceInfoCache
+from stm_tools.serialflasher.constants import *
+from stm_tools.serialflasher.dump import *
+from stm_tools.serialflasher.errors import *
+from stm_tools.serialflasher.serialtool import SerialTool
+from stm_tools.serialflasher.simulator import SimulatedBootloader, SimulatedSerial
+from stm_tools.serialflasher.stmdevice import STMInterface
+
+DUMP_TEST_DATA = bytes((i * 13) & 0xFF for i in range(10000))
+
+
+class FailingSerialTool(SerialTool):
+    """counts reads, and fails every read after the first fail_after"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reads = 0
+        self.fail_after = None
+
+    def cmdReadFromMemoryAddress(self, address, length):
+        self.reads += 1
+        if self.fail_after is not None and self.reads > self.fail_after:
+            return False, bytearray()
+        return super().cmdReadFromMemoryAddress(address, length)
+
+
+class DumpFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "dump.bin")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def testCompleteDumpRemovesSidecar(self):
+        with DumpFile(self.path, 0x100, 10000, 4096) as dump:
+            self.assertEqual(dump.missing(), [0, 1, 2])
+            self.assertEqual(dump.blockRange(2), (0x100 + 8192, 10000 - 8192))
+            for index in dump.missing():
+                start = index * 4096
+                dump.store(index, DUMP_TEST_DATA[start : start + 4096])
+            self.assertTrue(dump.complete)
+        self.assertFalse(os.path.exists(sidecarPath(self.path)))
+        self.assertEqual(loadDump(self.path), DUMP_TEST_DATA)
+
+    def testResumesUnfinishedDump(self):
+        with DumpFile(self.path, 0, 10000, 4096) as dump:
+            dump.store(1, DUMP_TEST_DATA[4096:8192])
+        self.assertTrue(os.path.exists(sidecarPath(self.path)))
+        with self.assertRaises(InvalidDumpError):
+            loadDump(self.path)
+
+        with DumpFile(self.path, 0, 10000, 4096) as dump:
+            self.assertEqual(dump.missing(), [0, 2])
+            dump.store(0, DUMP_TEST_DATA[:4096])
+            dump.store(2, DUMP_TEST_DATA[8192:])
+        self.assertEqual(loadDump(self.path), DUMP_TEST_DATA)
+
+    def testDifferentRegionStartsAfresh(self):
+        with DumpFile(self.path, 0, 10000, 4096) as dump:
+            dump.store(1, DUMP_TEST_DATA[4096:8192])
+        with DumpFile(self.path, 0x100, 10000, 4096) as dump:
+            self.assertEqual(dump.missing(), [0, 1, 2])
+        with DumpFile(self.path, 0x100, 10000, 4096, resume=False) as dump:
+            dump.store(1, DUMP_TEST_DATA[4096:8192])
+        with DumpFile(self.path, 0x100, 10000, 4096, resume=False) as dump:
+            self.assertEqual(dump.missing(), [0, 1, 2])
+
+    def testSparseBlocksReadBackErased(self):
+        data = DUMP_TEST_DATA[:4096] + b"\xff" * 4096 + bytes(1808)
+        with DumpFile(self.path, 0, len(data), 4096, sparse=True) as dump:
+            for index in range(3):
+                dump.store(index, data[index * 4096 : (index + 1) * 4096])
+        # the erased block was never written to the file
+        with open(self.path, "rb") as fp:
+            self.assertEqual(fp.read()[4096:8192], bytes(4096))
+        self.assertEqual(loadDump(self.path), data)
+
+        # a finished sparse dump is redone, not resumed
+        with DumpFile(self.path, 0, len(data), 4096, sparse=True) as dump:
+            self.assertEqual(dump.missing(), [0, 1, 2])
+
+    def testDamagedSidecar(self):
+        with DumpFile(self.path, 0, 10000, 4096) as dump:
+            dump.store(0, DUMP_TEST_DATA[:4096])
+        with open(sidecarPath(self.path), "r+b") as fp:
+            fp.write(b"XXXX")
+        with self.assertRaises(InvalidDumpError):
+            loadDump(self.path)
+
+
+class DumpToFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "flash.bin")
+        self.sim = SimulatedSerial(SimulatedBootloader())
+        self.tool = FailingSerialTool(serial=self.sim)
+        self.stm = STMInterface(self.tool, DeviceInfoCache())
+        self.stm.connectToDevice()
+        self.stm.readDeviceInfo()
+        # count only the reads made by the test, not the UID read
+        self.tool.reads = 0
+        self.flash = self.sim.bootloader.flash
+        self.flash[: len(DUMP_TEST_DATA)] = DUMP_TEST_DATA
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def testDumpFlash(self):
+        self.assertTrue(self.stm.dumpToFile("flash", self.path))
+        self.assertEqual(loadDump(self.path), bytes(self.flash))
+        self.assertEqual(self.tool.reads, len(self.flash) // 256)
+
+    def testDumpRam(self):
+        self.assertTrue(self.stm.dumpToFile("ram", self.path))
+        self.assertEqual(os.path.getsize(self.path), 0x20005000 - 0x20000200)
+
+    def testInterruptedDumpResumes(self):
+        self.tool.fail_after = 100
+        self.assertFalse(self.stm.dumpToFile("flash", self.path))
+        self.assertTrue(os.path.exists(sidecarPath(self.path)))
+
+        # 100 reads finished six 4KB blocks, the seventh is read again
+        self.tool.fail_after = None
+        self.tool.reads = 0
+        events = []
+        self.assertTrue(self.stm.dumpToFile("flash", self.path, progress=events.append))
+        self.assertEqual(self.tool.reads, (len(self.flash) - 6 * 4096) // 256)
+        self.assertEqual(events[-1].total, len(self.flash) - 6 * 4096)
+        self.assertEqual(loadDump(self.path), bytes(self.flash))
+        self.assertFalse(os.path.exists(sidecarPath(self.path)))
+
+    def testSparseDump(self):
+        self.assertTrue(self.stm.dumpToFile("flash", self.path, sparse=True))
+        self.assertTrue(os.path.exists(sidecarPath(self.path)))
+        self.assertEqual(loadDump(self.path), bytes(self.flash))
+
+    def testUnknownRegion(self):
+        with self.assertRaises(InvalidAddressError):
+            self.stm.dumpToFile("eeprom", self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
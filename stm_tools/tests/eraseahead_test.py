@@ -0,0 +1,148 @@
+#! Tests for erase-ahead flash programming, run against the simulated bootloader
+#
+
+import unittest
+from stm_tools.serialflasher.cache import DeviceInfoCache
+from stm_tools.serialflasher.constants import *
+from stm_tools.serialflasher.errors import *
+from stm_tools.serialflasher.integrity import WriteDigest
+from stm_tools.serialflasher.progress import CancellationToken
+from stm_tools.serialflasher.serialtool import SerialTool
+from stm_tools.serialflasher.simulator import SimulatedBootloader, SimulatedSerial
+from stm_tools.serialflasher.stmdevice import STMInterface
+
+ERASE_TEST_PAGE = 1024
+ERASE_TEST_DATA = bytes((i * 7) & 0xFF for i in range(10 * 1024))
+
+
+class RecordingSerialTool(SerialTool):
+    """records erase and write commands in the order they are sent"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.log = []
+
+    def cmdEraseFlashMemory(self):
+        self.log.append(("mass", None))
+        return super().cmdEraseFlashMemory()
+
+    def cmdEraseFlashMemoryPages(self, pages):
+        self.log.append(("erase", list(pages)))
+        return super().cmdEraseFlashMemoryPages(pages)
+
+    def cmdExtendedErase(self, pages=None, special=None):
+        self.log.append(("erase", list(pages)) if pages else ("mass", special))
+        return super().cmdExtendedErase(pages=pages, special=special)
+
+    def cmdWriteFramed(self, address_frame, data_frame):
+        address = int.from_bytes(address_frame[:4], "big")
+        self.log.append(("write", address))
+        return super().cmdWriteFramed(address_frame, data_frame)
+
+
+class ProgramFlashTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sim = SimulatedSerial(SimulatedBootloader())
+        self.tool = RecordingSerialTool(serial=self.sim)
+        self.stm = STMInterface(self.tool, DeviceInfoCache())
+        self.stm.connectToDevice()
+        self.stm.readDeviceInfo()
+        self.flash = self.sim.bootloader.flash
+        # stale content everywhere, so unerased pages show up
+        self.flash[:] = bytes([0xA5]) * len(self.flash)
+
+    def testWritesOverStaleFlash(self):
+        address = STM_F10X_FLASH_START + 2 * ERASE_TEST_PAGE
+        self.assertTrue(self.stm.programFlash(address, ERASE_TEST_DATA))
+        start = 2 * ERASE_TEST_PAGE
+        end = start + len(ERASE_TEST_DATA)
+        self.assertEqual(bytes(self.flash[start:end]), ERASE_TEST_DATA)
+        # pages outside the data keep their content
+        self.assertEqual(self.flash[:start], bytes([0xA5]) * start)
+        self.assertEqual(self.flash[end:], bytes([0xA5]) * (len(self.flash) - end))
+        self.assertNotIn("mass", [kind for kind, _ in self.tool.log])
+
+    def testErasesJustAheadOfWrites(self):
+        address = STM_F10X_FLASH_START + ERASE_TEST_PAGE
+        self.stm.programFlash(address, ERASE_TEST_DATA, batchPages=4)
+        erases = [pages for kind, pages in self.tool.log if kind == "erase"]
+        self.assertEqual(erases, [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]])
+
+        # every write follows the erase of its page, and comes before the
+        # next batch is erased
+        erased = set()
+        batch = 0
+        for kind, value in self.tool.log:
+            if kind == "erase":
+                erased.update(value)
+                batch += 1
+                continue
+            page = (value - STM_F10X_FLASH_START) // ERASE_TEST_PAGE
+            self.assertIn(page, erased)
+            self.assertEqual((page - 1) // 4 + 1, batch)
+
+    def testChunkCrossingPagesWaitsForBothErased(self):
+        # chunks start 128 bytes into a page, so every fourth one straddles
+        address = STM_F10X_FLASH_START + 128
+        data = ERASE_TEST_DATA[: 3 * ERASE_TEST_PAGE]
+        self.assertTrue(self.stm.programFlash(address, data, batchPages=1))
+        self.assertEqual(bytes(self.flash[128 : 128 + len(data)]), data)
+        # the chunk at 0x380 ends in page 1, so it waits for page 1's erase
+        log = self.tool.log
+        self.assertLess(
+            log.index(("erase", [1])),
+            log.index(("write", STM_F10X_FLASH_START + 0x380)),
+        )
+        self.assertGreater(
+            log.index(("erase", [2])),
+            log.index(("write", STM_F10X_FLASH_START + 0x380)),
+        )
+
+    def testDigestAndProgress(self):
+        address = STM_F10X_FLASH_START
+        digest = WriteDigest(ERASE_TEST_PAGE, STM_F10X_FLASH_START)
+        events = []
+        self.stm.programFlash(
+            address, ERASE_TEST_DATA, progress=events.append, digest=digest
+        )
+        self.assertEqual(digest.address, address)
+        self.assertEqual(digest.length, len(ERASE_TEST_DATA))
+        phases = {event.phase: event for event in events}
+        self.assertEqual(phases["erase"].done, 10)
+        self.assertEqual(phases["write"].done, len(ERASE_TEST_DATA))
+
+    def testCancel(self):
+        token = CancellationToken()
+        erases = []
+
+        def progress(event):
+            if event.phase == "erase":
+                erases.append(event)
+                token.cancel()
+
+        with self.assertRaises(OperationCancelledError):
+            self.stm.programFlash(
+                STM_F10X_FLASH_START,
+                ERASE_TEST_DATA,
+                progress=progress,
+                cancel=token,
+            )
+        self.assertEqual(len(erases), 1)
+        self.assertEqual(self.flash[ERASE_TEST_PAGE * 4], 0xA5)
+
+    def testRejectsBadArguments(self):
+        with self.assertRaises(InvalidAddressError):
+            self.stm.programFlash(STM_F10X_FLASH_START + 2, ERASE_TEST_DATA)
+        with self.assertRaises(InvalidWriteLengthError):
+            self.stm.programFlash(STM_F10X_FLASH_START, ERASE_TEST_DATA[:6])
+        with self.assertRaises(InvalidWriteLengthError):
+            self.stm.programFlash(
+                STM_F10X_FLASH_START + len(self.flash) - 4, ERASE_TEST_DATA[:8]
+            )
+        with self.assertRaises(ValueError):
+            self.stm.programFlash(STM_F10X_FLASH_START, ERASE_TEST_DATA, batchPages=0)
+        self.assertEqual(self.tool.log, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
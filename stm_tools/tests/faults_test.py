@@ -0,0 +1,102 @@
+#! Tests for the fault injecting serial wrapper, run against the simulated bootloader
+#
+
+import unittest
+from stm_tools.serialflasher.benchmark import measureLinkThroughput
+from stm_tools.serialflasher.constants import *
+from stm_tools.serialflasher.errors import *
+from stm_tools.serialflasher.faults import *
+from stm_tools.serialflasher.serialtool import SerialTool
+from stm_tools.serialflasher.simulator import SimulatedSerial
+
+
+class FaultySerialTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sleeps = []
+        self.sim = SimulatedSerial()
+        self.sim.bootloader.flash[0:256] = bytes(range(256))
+
+    def wrap(self, profile, seed=1):
+        link = FaultySerial(self.sim, profile, seed=seed, sleep=self.sleeps.append)
+        return link, SerialTool(serial=link)
+
+    def testCleanLinkPassesThrough(self):
+        link, tool = self.wrap(LinkProfile())
+        self.assertTrue(tool.reconnect(STM_RESET_DTR, 0.1))
+        self.assertEqual(
+            tool.cmdReadFromMemoryAddress(STM_F10X_FLASH_START, 256),
+            (True, bytes(range(256))),
+        )
+        self.assertEqual(self.sleeps, [])
+        self.assertEqual(link.stats["dropped"] + link.stats["flipped"], 0)
+
+    def testSettingsReachWrappedPort(self):
+        link, tool = self.wrap(LinkProfile())
+        link.timeout = 0.25
+        self.assertEqual(self.sim.timeout, 0.25)
+        self.assertEqual(link.port, self.sim.port)
+
+    def testLatencyAndBandwidth(self):
+        link, _ = self.wrap(LinkProfile(latency=0.001, bandwidth=1000))
+        link.write(bytes(10))
+        self.assertAlmostEqual(self.sleeps[0], 0.011)
+        self.assertAlmostEqual(link.stats["delay_s"], 0.011)
+
+    def testJitterIsSeeded(self):
+        profile = LinkProfile(jitter=0.01)
+        runs = []
+        for _ in range(2):
+            self.sleeps = []
+            link, _ = self.wrap(profile, seed=7)
+            for _ in range(5):
+                link.write(b"\x00")
+            runs.append(self.sleeps)
+        self.assertEqual(runs[0], runs[1])
+        self.assertTrue(all(0 <= s <= 0.01 for s in runs[0]))
+
+    def testSpuriousNack(self):
+        link, tool = self.wrap(LinkProfile(nack_rate=1.0))
+        # the handshake takes a NACK as an answer, commands do not
+        self.assertTrue(tool.reconnect(STM_RESET_DTR, 0.1))
+        self.assertFalse(tool.cmdGetId()[0])
+        self.assertGreater(link.stats["nacks"], 0)
+
+    def testNackOnlyAtAckReads(self):
+        link, _ = self.wrap(LinkProfile(nack_rate=1.0))
+        payload = bytes([STM_CMD_ACK]) * 16
+        self.sim.bootloader.tx.extend(payload + bytes([STM_CMD_ACK]))
+        # ACK values in data are left alone
+        self.assertEqual(link.read(16), payload)
+        self.assertEqual(link.stats["nacks"], 0)
+        rx = link.read_until(bytes([STM_CMD_ACK]), size=1)
+        self.assertEqual(rx, bytes([STM_CMD_NACK]))
+        self.assertEqual(link.stats["nacks"], 1)
+
+    def testDroppedBytesWaitOutTimeout(self):
+        link, tool = self.wrap(LinkProfile(drop_rate=1.0))
+        link.timeout = 0.5
+        with self.assertRaises(NoResponseError):
+            tool.waitForAck()
+        self.assertEqual(self.sleeps, [0.5])
+
+    def testBitFlips(self):
+        link, _ = self.wrap(LinkProfile(bitflip_rate=1.0))
+        self.sim.bootloader.tx.extend(bytes(16))
+        rx = link.read(16)
+        self.assertEqual(len(rx), 16)
+        self.assertTrue(all(bin(b).count("1") == 1 for b in rx))
+        self.assertEqual(link.stats["flipped"], 16)
+
+    def testThroughputUnderFaultsIsReproducible(self):
+        profile = LinkProfile(drop_rate=1e-3, bitflip_rate=1e-3)
+        first = measureLinkThroughput(profile, seed=3, length=4096, timeout=0.01)
+        second = measureLinkThroughput(profile, seed=3, length=4096, timeout=0.01)
+        self.assertGreater(first["retries"], 0)
+        self.assertEqual(first["bytes"] + 256 * first["failed"], 4096)
+        for key in ("bytes", "retries", "failed"):
+            self.assertEqual(first[key], second[key])
+        self.assertEqual(first["stats"]["dropped"], second["stats"]["dropped"])
+
+
+if __name__ == "__main__":
+    unittest.main()
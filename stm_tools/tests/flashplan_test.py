@@ -0,0 +1,91 @@
+#! Tests for compiled flash plans
+#
+
+import os
+import tempfile
+import unittest
+from stm_tools.serialflasher.cache import DeviceInfoCache
+from stm_tools.serialflasher.devices import DeviceType
+from stm_tools.serialflasher.flashplan import *
+from stm_tools.serialflasher.image import FramedImage
+from stm_tools.serialflasher.serialtool import SerialTool
+from stm_tools.serialflasher.simulator import SimulatedBootloader, SimulatedSerial
+from stm_tools.serialflasher.stmdevice import STMInterface
+
+PLAN_TEST_ADDRESS = 0x08000800
+PLAN_TEST_DATA = bytes((i * 7) & 0xFF for i in range(3001))
+
+
+class FlashPlanTestCase(unittest.TestCase):
+    def setUp(self):
+        self.device = DeviceType(0x0410, 2.2)
+        self.image = FramedImage(PLAN_TEST_DATA, PLAN_TEST_ADDRESS)
+        self.plan = FlashPlan(compileFlashPlan(self.image, self.device))
+
+    def testHeader(self):
+        self.assertEqual(self.plan.pid, 0x0410)
+        self.assertEqual(self.plan.address, PLAN_TEST_ADDRESS)
+        self.assertEqual(self.plan.length, 3004)
+        self.assertEqual(self.plan.frame_count, 12)
+        # 3004 bytes from page 2 covers pages 2 - 4
+        self.assertEqual(list(self.plan.erase_pages), [2, 3, 4])
+
+    def testFramesMatchImage(self):
+        for frame, (address_frame, data_frame) in zip(
+            self.image.frames(), self.plan.frames()
+        ):
+            self.assertEqual(bytes(address_frame), frame.address_frame)
+            self.assertEqual(bytes(data_frame), frame.data_frame)
+
+    def testChunks(self):
+        chunks = list(self.plan.chunks())
+        self.assertEqual(chunks[0][:2], (PLAN_TEST_ADDRESS, 256))
+        self.assertEqual(chunks[-1][:2], (PLAN_TEST_ADDRESS + 2816, 188))
+
+    def testInvalidPlan(self):
+        data = compileFlashPlan(self.image, self.device)
+        with self.assertRaises(InvalidFlashPlanError):
+            FlashPlan(b"XXXX" + data[4:])
+        with self.assertRaises(InvalidFlashPlanError):
+            FlashPlan(data[:-1])
+
+    def testLoadFile(self):
+        path = os.path.join(tempfile.mkdtemp(), "image.plan")
+        FlashPlan.Compile(self.image, self.device, path)
+        plan = FlashPlan.Load(path)
+        self.assertEqual(plan.sha256, self.plan.sha256)
+        self.assertEqual(list(plan.chunk_crcs), list(self.plan.chunk_crcs))
+        plan.close()
+
+
+class ExecuteFlashPlanTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sim = SimulatedSerial(SimulatedBootloader())
+        self.stm = STMInterface(
+            SerialTool(serial=self.sim), infoCache=DeviceInfoCache()
+        )
+        self.stm.connectToDevice()
+        self.stm.readDeviceInfo()
+        image = FramedImage(PLAN_TEST_DATA, PLAN_TEST_ADDRESS)
+        self.plan = FlashPlan(compileFlashPlan(image, self.stm.device))
+
+    def testExecute(self):
+        # dirty the flash so the plan's erase is needed
+        self.stm.writeToFlash(PLAN_TEST_ADDRESS, bytearray(16))
+        self.assertTrue(self.stm.executeFlashPlan(self.plan))
+        success, rx = self.stm.readFromFlash(PLAN_TEST_ADDRESS, 3000)
+        self.assertEqual(rx, PLAN_TEST_DATA[:3000])
+
+    def testVerifyFailsWithoutErase(self):
+        self.stm.writeToFlash(PLAN_TEST_ADDRESS, bytearray(16))
+        self.assertFalse(self.stm.executeFlashPlan(self.plan, erase=False))
+
+    def testWrongDevice(self):
+        image = FramedImage(PLAN_TEST_DATA, PLAN_TEST_ADDRESS)
+        plan = FlashPlan(compileFlashPlan(image, DeviceType(0x0414, 2.2)))
+        with self.assertRaises(InvalidFlashPlanError):
+            self.stm.executeFlashPlan(plan)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+#! Tests for pre-framed images and per-device patching
+#
+
+import unittest
+from stm_tools.serialflasher.cache import DeviceInfoCache
+from stm_tools.serialflasher.constants import *
+from stm_tools.serialflasher.errors import *
+from stm_tools.serialflasher.image import *
+from stm_tools.serialflasher.serialtool import SerialTool
+from stm_tools.serialflasher.simulator import SimulatedBootloader, SimulatedSerial
+from stm_tools.serialflasher.stmdevice import STMInterface
+
+IMAGE_TEST_ADDRESS = 0x08000000
+IMAGE_TEST_DATA = bytes(i & 0xFF for i in range(1000))
+
+
+class FramedImageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.image = FramedImage(IMAGE_TEST_DATA, IMAGE_TEST_ADDRESS)
+
+    def testFraming(self):
+        frames = list(self.image.frames())
+        self.assertEqual(len(self.image), 1000)
+        self.assertEqual(len(frames), 4)
+        self.assertEqual(frames[1].address, IMAGE_TEST_ADDRESS + 256)
+        self.assertEqual(frames[1].address_frame, SerialTool.frameAddress(0x08000100))
+        self.assertEqual(
+            frames[3].data_frame, SerialTool.frameWriteData(IMAGE_TEST_DATA[768:])
+        )
+
+    def testPaddedToWord(self):
+        image = FramedImage(b"\x01\x02\x03\x04\x05", IMAGE_TEST_ADDRESS)
+        self.assertEqual(image.data, b"\x01\x02\x03\x04\x05\xff\xff\xff")
+
+    def testUnalignedAddress(self):
+        with self.assertRaises(InvalidAddressError):
+            FramedImage(IMAGE_TEST_DATA, IMAGE_TEST_ADDRESS + 2)
+
+    def testPatchReframesTouchedChunksOnly(self):
+        patched = self.image.patch([Patch(IMAGE_TEST_ADDRESS + 10, b"SN01")])
+        frames = list(patched.frames())
+        self.assertEqual(list(patched.overrides), [0])
+        for base, frame in zip(self.image.chunk_frames[1:], frames[1:]):
+            self.assertIs(base, frame)
+        expected = bytearray(IMAGE_TEST_DATA[:256])
+        expected[10:14] = b"SN01"
+        self.assertEqual(frames[0].data_frame, SerialTool.frameWriteData(expected))
+
+    def testPatchAcrossChunks(self):
+        patched = self.image.patch([Patch(IMAGE_TEST_ADDRESS + 254, b"\xaa" * 4)])
+        self.assertEqual(sorted(patched.overrides), [0, 1])
+        frames = list(patched.frames())
+        # data frames start with N-1
+        self.assertEqual(frames[0].data_frame[-3:-1], b"\xaa\xaa")
+        self.assertEqual(frames[1].data_frame[1:3], b"\xaa\xaa")
+
+    def testPatchOutsideImage(self):
+        with self.assertRaises(InvalidAddressError):
+            self.image.patch([Patch(IMAGE_TEST_ADDRESS + 998, b"\x00" * 4)])
+
+
+class UnreadableUidSerialTool(SerialTool):
+    """refuses reads of the UID once unreadable is set"""
+
+    unreadable = False
+
+    def cmdReadFromMemoryAddress(self, address, length):
+        if self.unreadable and address == STM_F10X_UID_ADDR:
+            return False, bytearray()
+        return super().cmdReadFromMemoryAddress(address, length)
+
+
+class WriteFramedImageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sim = SimulatedSerial(SimulatedBootloader())
+        self.stm = STMInterface(
+            UnreadableUidSerialTool(serial=self.sim), infoCache=DeviceInfoCache()
+        )
+        self.stm.connectToDevice()
+        self.stm.readDeviceInfo()
+        self.image = FramedImage(IMAGE_TEST_DATA, IMAGE_TEST_ADDRESS)
+
+    def uidPatch(self, uid):
+        return [Patch(IMAGE_TEST_ADDRESS + 900, uid.to_bytes(12, "little"))]
+
+    def testWritePatchedImage(self):
+        self.assertTrue(
+            self.stm.writeFramedImage(
+                self.image,
+                [Patch(IMAGE_TEST_ADDRESS + 512, b"SN-0001\x00")],
+                lambda uid: [
+                    Patch(IMAGE_TEST_ADDRESS + 900, uid.to_bytes(12, "little"))
+                ],
+            )
+        )
+        expected = bytearray(IMAGE_TEST_DATA)
+        expected[512:520] = b"SN-0001\x00"
+        expected[900:912] = bytes(range(1, 13))
+        success, rx = self.stm.readFromFlash(IMAGE_TEST_ADDRESS, 1000)
+        self.assertTrue(success)
+        self.assertEqual(rx, expected)
+
+    def testUidPatchReadsConnectedDevice(self):
+        # a UID left over from another board is not trusted
+        self.stm.device.uid = 0x1234
+        self.assertTrue(self.stm.writeFramedImage(self.image, uidPatches=self.uidPatch))
+        success, rx = self.stm.readFromFlash(IMAGE_TEST_ADDRESS + 900, 12)
+        self.assertEqual(rx, bytes(range(1, 13)))
+
+    def testUidPatchUnreadableUid(self):
+        self.stm.serialTool.unreadable = True
+        with self.assertRaises(CommandFailedError):
+            self.stm.writeFramedImage(self.image, uidPatches=self.uidPatch)
+
+    def testImageOutOfRange(self):
+        end = self.stm.device.flash_memory.end
+        with self.assertRaises(InvalidAddressError):
+            self.stm.writeFramedImage(FramedImage(IMAGE_TEST_DATA, end - 256))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+#! Tests for write digests and flash manifests, run against the simulated bootloader
+#
+
+import hashlib
+import unittest
+import zlib
+from stm_tools.serialflasher.cache import DeviceInfoCache
+from stm_tools.serialflasher.constants import *
+from stm_tools.serialflasher.errors import *
+from stm_tools.serialflasher.flashplan import FlashPlan, compileFlashPlan
+from stm_tools.serialflasher.image import FramedImage
+from stm_tools.serialflasher.integrity import *
+from stm_tools.serialflasher.serialtool import SerialTool
+from stm_tools.serialflasher.simulator import SimulatedBootloader, SimulatedSerial
+from stm_tools.serialflasher.stmdevice import STMInterface
+
+INTEGRITY_TEST_ADDRESS = 0x08000800
+INTEGRITY_TEST_DATA = bytes((i * 13) & 0xFF for i in range(3000))
+
+
+class WriteDigestTestCase(unittest.TestCase):
+    def testDigests(self):
+        digest = WriteDigest(1024, STM_F10X_FLASH_START)
+        for offset in range(0, len(INTEGRITY_TEST_DATA), 256):
+            chunk = INTEGRITY_TEST_DATA[offset : offset + 256]
+            digest.update(INTEGRITY_TEST_ADDRESS + offset, chunk)
+
+        self.assertEqual(digest.length, 3000)
+        self.assertEqual(digest.crc32, zlib.crc32(INTEGRITY_TEST_DATA))
+        self.assertEqual(digest.sha256, hashlib.sha256(INTEGRITY_TEST_DATA).digest())
+        pages = digest.pages()
+        self.assertEqual([p.index for p in pages], [2, 3, 4])
+        self.assertEqual([p.length for p in pages], [1024, 1024, 952])
+        self.assertEqual(pages[1].address, INTEGRITY_TEST_ADDRESS + 1024)
+        self.assertEqual(pages[1].crc32, zlib.crc32(INTEGRITY_TEST_DATA[1024:2048]))
+
+    def testOutOfOrderRejected(self):
+        digest = WriteDigest(1024, STM_F10X_FLASH_START)
+        digest.update(INTEGRITY_TEST_ADDRESS, bytes(4))
+        with self.assertRaises(InvalidAddressError):
+            digest.update(INTEGRITY_TEST_ADDRESS + 8, bytes(4))
+
+
+class FlashManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.digest = WriteDigest(1024, STM_F10X_FLASH_START)
+        self.digest.update(INTEGRITY_TEST_ADDRESS, INTEGRITY_TEST_DATA)
+        self.manifest = FlashManifest.FromDigest(self.digest, version=7)
+
+    def testRoundTrip(self):
+        data = self.manifest.toBytes()
+        self.assertEqual(len(data), len(self.manifest))
+        self.assertEqual(len(data) % 4, 0)
+        self.assertEqual(FlashManifest.FromBytes(data + b"\xff" * 8), self.manifest)
+
+    def testCorruptionDetected(self):
+        data = bytearray(self.manifest.toBytes())
+        data[70] ^= 1
+        with self.assertRaises(InvalidManifestError):
+            FlashManifest.FromBytes(data)
+        with self.assertRaises(InvalidManifestError):
+            FlashManifest.FromBytes(b"\xff" * 64)
+
+    def testChangedPages(self):
+        changed = bytearray(INTEGRITY_TEST_DATA)
+        changed[1500] ^= 0xFF
+        digest = WriteDigest(1024, STM_F10X_FLASH_START)
+        digest.update(INTEGRITY_TEST_ADDRESS, changed + bytes(1024))
+        self.assertEqual(self.manifest.changedPages(digest), [3, 4, 5])
+        self.assertEqual(self.manifest.changedPages(self.digest), [])
+
+
+class DeviceIntegrityTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sim = SimulatedSerial(SimulatedBootloader())
+        self.tool = SerialTool(serial=self.sim)
+        self.stm = STMInterface(self.tool, infoCache=DeviceInfoCache())
+        self.stm.connectToDevice()
+        self.stm.readDeviceInfo()
+        self.flash = self.sim.bootloader.flash
+
+    def checkDigest(self, digest, data):
+        self.assertEqual(digest.address, INTEGRITY_TEST_ADDRESS)
+        self.assertEqual(digest.sha256, hashlib.sha256(data).digest())
+
+    def testWriteToFlashDigest(self):
+        digest = WriteDigest.ForDevice(self.stm.device)
+        self.assertTrue(
+            self.stm.writeToFlash(
+                INTEGRITY_TEST_ADDRESS, bytearray(INTEGRITY_TEST_DATA), digest=digest
+            )
+        )
+        self.checkDigest(digest, INTEGRITY_TEST_DATA)
+
+    def testFramedImageAndPlanDigests(self):
+        image = FramedImage(INTEGRITY_TEST_DATA, INTEGRITY_TEST_ADDRESS)
+        digest = WriteDigest.ForDevice(self.stm.device)
+        self.assertTrue(self.stm.writeFramedImage(image, digest=digest))
+        self.checkDigest(digest, image.data)
+
+        plan = FlashPlan(compileFlashPlan(image, self.stm.device))
+        digest = WriteDigest.ForDevice(self.stm.device)
+        self.assertTrue(self.stm.executeFlashPlan(plan, digest=digest))
+        self.checkDigest(digest, image.data)
+        self.assertEqual(digest.sha256, plan.sha256)
+
+    def testWriteAtEndOfFlash(self):
+        end = self.stm.device.flash_memory.end
+        self.assertTrue(self.stm.writeToFlash(end - 8, bytearray(range(8))))
+        self.assertEqual(self.stm.readFromFlash(end - 8, 8)[1], bytes(range(8)))
+        with self.assertRaises(InvalidWriteLengthError):
+            self.stm.writeToFlash(end - 4, bytearray(8))
+
+    def testManifestInFlashTail(self):
+        digest = WriteDigest.ForDevice(self.stm.device)
+        self.stm.writeToFlash(
+            INTEGRITY_TEST_ADDRESS, bytearray(INTEGRITY_TEST_DATA), digest=digest
+        )
+        manifest = FlashManifest.FromDigest(digest, version=3)
+        self.flash[-1024:] = bytes(1024)
+        self.assertTrue(self.stm.writeManifest(manifest))
+
+        address = self.stm.manifestAddress()
+        self.assertEqual(address, self.stm.device.flash_memory.end - 1024)
+        self.assertEqual(self.stm.readManifest(), manifest)
+        # nothing else was left over from before the erase
+        offset = address - STM_F10X_FLASH_START + len(manifest)
+        self.assertEqual(set(self.flash[offset:]), {0xFF})
+
+    def testNoManifest(self):
+        with self.assertRaises(InvalidManifestError):
+            self.stm.readManifest()
+
+    def testManifestRegionChecks(self):
+        digest = WriteDigest.ForDevice(self.stm.device)
+        end = self.stm.device.flash_memory.end
+        digest.update(end - 2048, bytes(1028))
+        with self.assertRaises(InvalidAddressError):
+            self.stm.writeManifest(FlashManifest.FromDigest(digest))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+#! Tests for the cached DeviceMemory views, run against the simulated bootloader
+#
+
+import unittest
+from stm_tools.serialflasher.cache import DeviceInfoCache
+from stm_tools.serialflasher.errors import *
+from stm_tools.serialflasher.memory import *
+from stm_tools.serialflasher.serialtool import SerialTool
+from stm_tools.serialflasher.simulator import SimulatedBootloader, SimulatedSerial
+from stm_tools.serialflasher.stmdevice import STMInterface
+
+
+class CountingSerialTool(SerialTool):
+    """counts read and write memory commands"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reads = 0
+        self.writes = 0
+        self.written = []
+
+    def cmdReadFromMemoryAddress(self, address, length):
+        self.reads += 1
+        return super().cmdReadFromMemoryAddress(address, length)
+
+    def cmdWriteToMemoryAddress(self, address, data):
+        self.writes += 1
+        self.written.append((address, len(data)))
+        return super().cmdWriteToMemoryAddress(address, data)
+
+
+class DeviceMemoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sim = SimulatedSerial(SimulatedBootloader())
+        self.tool = CountingSerialTool(serial=self.sim)
+        self.stm = STMInterface(self.tool, infoCache=DeviceInfoCache())
+        self.stm.connectToDevice()
+        self.stm.readDeviceInfo()
+        # count only the reads made by the test, not the UID read
+        self.tool.reads = 0
+        self.bootloader = self.sim.bootloader
+        self.bootloader.flash[0:512] = bytes(range(256)) * 2
+
+    def testSizes(self):
+        self.assertEqual(len(self.stm.flash), 128 * 1024)
+        self.assertEqual(len(self.stm.ram), 0x20005000 - 0x20000200)
+        self.assertIs(self.stm.flash, self.stm.flash)
+
+    def testSmallReadsShareBlockReads(self):
+        flash = self.stm.flash
+        for offset in range(0, 256, 4):
+            self.assertEqual(
+                flash[offset : offset + 4], bytes(range(offset, offset + 4))
+            )
+        self.assertEqual(flash[300], 300 - 256)
+        self.assertEqual(flash[-1], 0xFF)
+        self.assertEqual(self.tool.reads, 3)
+
+    def testReadAcrossBlocks(self):
+        self.assertEqual(
+            self.stm.flash[0xF0:0x110], bytes(range(0xF0, 0x100)) + bytes(range(0x10))
+        )
+        self.assertEqual(self.tool.reads, 2)
+
+    def testWritesCoalesced(self):
+        with self.stm.ram as ram:
+            for i in range(16):
+                ram[0x40 + i] = i
+            ram[0x45:0x47] = b"\xaa\xbb"
+            self.assertTrue(ram.dirty)
+            self.assertEqual(self.tool.writes, 0)
+        self.assertEqual(self.tool.writes, 1)
+        self.assertEqual(self.tool.reads, 0)
+        expected = bytes(range(5)) + b"\xaa\xbb" + bytes(range(7, 16))
+        self.assertEqual(bytes(self.bootloader.ram[0x240:0x250]), expected)
+
+    def testUnalignedWriteKeepsNeighbours(self):
+        self.bootloader.ram[0x200:0x208] = b"ABCDEFGH"
+        ram = self.stm.ram
+        ram[1:3] = b"xy"
+        ram.flush()
+        self.assertEqual(bytes(self.bootloader.ram[0x200:0x208]), b"AxyDEFGH")
+        # the block was read once to fill in the rest of the word
+        self.assertEqual(self.tool.reads, 1)
+        self.assertEqual(ram[0:8], b"AxyDEFGH")
+        self.assertEqual(self.tool.reads, 1)
+
+    def testFlushesOnlyWrittenRuns(self):
+        ram = self.stm.ram
+        self.assertEqual(ram[0:0x100], bytes(self.bootloader.ram[0x200:0x300]))
+        # changed on the device behind the cache, between the writes
+        self.bootloader.ram[0x240:0x244] = b"RUN!"
+        ram[0x02:0x06] = b"abcd"
+        ram[0x80:0x84] = b"wxyz"
+        ram.flush()
+
+        start = self.stm.ram.start
+        self.assertEqual(self.tool.written, [(start, 8), (start + 0x80, 4)])
+        self.assertEqual(bytes(self.bootloader.ram[0x240:0x244]), b"RUN!")
+        self.assertEqual(bytes(self.bootloader.ram[0x202:0x206]), b"abcd")
+        self.assertEqual(bytes(self.bootloader.ram[0x280:0x284]), b"wxyz")
+        self.assertFalse(ram.dirty)
+
+    def testEraseInvalidatesCache(self):
+        self.assertEqual(self.stm.flash[0], 0)
+        self.stm.eraseFlashPages([0])
+        self.assertEqual(self.stm.flash[0], 0xFF)
+
+    def testLruEviction(self):
+        flash = DeviceMemory(self.stm, "flash", 0x08000000, 128 * 1024, cacheBlocks=2)
+        flash[0x200:0x204] = b"\x01\x02\x03\x04"
+        flash[0]
+        flash[0x100]
+        # the dirty block was flushed when it was evicted
+        self.assertEqual(self.tool.writes, 1)
+        self.assertEqual(bytes(self.bootloader.flash[0x200:0x204]), b"\x01\x02\x03\x04")
+        flash[0]
+        self.assertEqual(self.tool.reads, 2)
+
+    def testBounds(self):
+        with self.assertRaises(IndexError):
+            self.stm.flash[128 * 1024]
+        with self.assertRaises(ValueError):
+            self.stm.ram[0:4] = b"\x00"
+        with self.assertRaises(ValueError):
+            self.stm.flash[0:8:2]
+
+    def testReadinto(self):
+        buffer = bytearray(8)
+        self.assertEqual(self.stm.flash.readinto(8, buffer), 8)
+        self.assertEqual(buffer, bytes(range(8, 16)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -56,3 +56,36 @@ class OptioByteTestCase(unittest.TestCase):
         fob = OptionBytes.FromAttributes(watchdog_type=0)
         fob.watchdogType = 1
         self.assertEqual(fob.watchdogType, 1)
+
+    def testOptionBytesWriteProtectedSectors(self):
+        fob = OptionBytes.FromAttributes()
+        fob.setWriteProtectedSectors([0, 9, 31])
+        self.assertEqual(fob.getWriteProtectedSectors(), [0, 9, 31])
+        self.assertEqual(fob.writeProtect0, 0xFE)
+        self.assertEqual(fob.writeProtect1, 0xFD)
+        self.assertEqual(fob.writeProtect3, 0x7F)
+
+    def testOptionBytesUserBitsPreserved(self):
+        fob = OptionBytes.FromAttributes()
+        fob.user = 0xF8
+        fob.watchdogType = 1
+        self.assertEqual(fob.toBytes()[2] & 0xF8, 0xF8)
+        self.assertEqual(fob.toBytes()[2] & 0b1, 1)
+
+    def testOptionBytesDiffNoChanges(self):
+        fob = OptionBytes.FromBytes(OPTBYTE_TEST_VALID_OPTION_BYTES)
+        target = OptionBytes.FromBytes(OPTBYTE_TEST_VALID_OPTION_BYTES)
+        self.assertEqual(fob.diff(target), {})
+
+    def testOptionBytesDiffChangedFields(self):
+        fob = OptionBytes.FromAttributes(data_byte_0=0x12)
+        target = OptionBytes.FromAttributes(data_byte_0=0x34, write_protect_1=0xFF)
+        changes = fob.diff(target)
+        self.assertEqual(set(changes), {"data_byte_0", "write_protect_1"})
+        self.assertEqual(changes["data_byte_0"], (0x12, 0x34))
+
+    def testOptionBytesDiffReadProtectLevel(self):
+        """any read protect value other than 0xA5 is the same setting"""
+        fob = OptionBytes.FromAttributes(read_protect=0x00)
+        target = OptionBytes.FromAttributes(read_protect=0x12)
+        self.assertEqual(fob.diff(target), {})
@@ -0,0 +1,114 @@
+#! Tests for progress reporting and cancellation, run against the simulated bootloader
+#
+
+import unittest
+from stm_tools.serialflasher.cache import DeviceInfoCache
+from stm_tools.serialflasher.errors import *
+from stm_tools.serialflasher.flashplan import FlashPlan, compileFlashPlan
+from stm_tools.serialflasher.image import FramedImage
+from stm_tools.serialflasher.progress import *
+from stm_tools.serialflasher.serialtool import SerialTool
+from stm_tools.serialflasher.simulator import SimulatedBootloader, SimulatedSerial
+from stm_tools.serialflasher.stmdevice import STMInterface
+
+PROGRESS_TEST_ADDRESS = 0x08000000
+PROGRESS_TEST_DATA = bytearray(range(256)) * 4 + bytearray(64)
+
+
+class ProgressTrackerTestCase(unittest.TestCase):
+    def testEvents(self):
+        events = []
+        tracker = ProgressTracker(PROGRESS_PHASE_WRITE, 512, events.append)
+        tracker.update(256)
+        tracker.update(256)
+        self.assertEqual([e.done for e in events], [256, 512])
+        self.assertEqual(events[-1].fraction, 1.0)
+        self.assertEqual(events[-1].eta, 0)
+        self.assertGreater(events[-1].rate, 0)
+
+    def testCancel(self):
+        token = CancellationToken()
+        tracker = ProgressTracker(PROGRESS_PHASE_READ, 10, token=token)
+        tracker.check()
+        token.cancel()
+        self.assertTrue(token.cancelled)
+        with self.assertRaises(OperationCancelledError):
+            tracker.check()
+        with self.assertRaises(OperationCancelledError):
+            token.check()
+
+
+class OperationProgressTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sim = SimulatedSerial(SimulatedBootloader())
+        self.stm = STMInterface(
+            SerialTool(serial=self.sim), infoCache=DeviceInfoCache()
+        )
+        self.stm.connectToDevice()
+        self.stm.readDeviceInfo()
+
+    def testWriteAndReadProgress(self):
+        events = []
+        self.stm.writeToFlash(
+            PROGRESS_TEST_ADDRESS, PROGRESS_TEST_DATA, progress=events.append
+        )
+        self.assertEqual([e.done for e in events], [256, 512, 768, 1024, 1088])
+        self.assertTrue(all(e.phase == PROGRESS_PHASE_WRITE for e in events))
+        self.assertTrue(all(e.total == 1088 for e in events))
+
+        events.clear()
+        self.stm.readFromFlash(PROGRESS_TEST_ADDRESS, 1088, progress=events.append)
+        self.assertEqual(events[-1].phase, PROGRESS_PHASE_READ)
+        self.assertEqual(events[-1].done, 1088)
+
+    def testCancelLeavesBootloaderReady(self):
+        token = CancellationToken()
+
+        def onProgress(event):
+            if event.done >= 512:
+                token.cancel()
+
+        with self.assertRaises(OperationCancelledError):
+            self.stm.writeToFlash(
+                PROGRESS_TEST_ADDRESS,
+                PROGRESS_TEST_DATA,
+                progress=onProgress,
+                cancel=token,
+            )
+        # stopped on a frame boundary
+        success, rx = self.stm.readFromFlash(PROGRESS_TEST_ADDRESS, 516)
+        self.assertTrue(success)
+        self.assertEqual(rx, PROGRESS_TEST_DATA[:512] + b"\xff" * 4)
+
+    def testPlanPhases(self):
+        image = FramedImage(PROGRESS_TEST_DATA, PROGRESS_TEST_ADDRESS)
+        plan = FlashPlan(compileFlashPlan(image, self.stm.device))
+        events = []
+        self.assertTrue(self.stm.executeFlashPlan(plan, progress=events.append))
+        phases = [e.phase for e in events]
+        self.assertEqual(
+            sorted(set(phases), key=phases.index),
+            [PROGRESS_PHASE_ERASE, PROGRESS_PHASE_WRITE, PROGRESS_PHASE_VERIFY],
+        )
+        self.assertEqual(events[0].total, 2)
+
+    def testBankEraseProgress(self):
+        sim = SimulatedSerial(SimulatedBootloader(pid=0x0430, extended_erase=True))
+        stm = STMInterface(SerialTool(serial=sim), DeviceInfoCache())
+        stm.connectToDevice()
+        stm.readDeviceInfo()
+        events = []
+        # all of bank 1 and two pages of bank 2
+        self.assertTrue(stm.eraseFlashPages(list(range(258)), progress=events.append))
+        self.assertEqual([e.done for e in events], [256, 258])
+        self.assertEqual(events[-1].total, 258)
+
+    def testCancelledBeforeStart(self):
+        token = CancellationToken()
+        token.cancel()
+        with self.assertRaises(OperationCancelledError):
+            self.stm.eraseFlashPages([0, 1], cancel=token)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+#! Tests for the ProtectionMap class
+#
+# Map known write-protect bits onto medium and high
+# density page layouts
+#
+
+import unittest
+from stm_tools.serialflasher.devices import DeviceType, OptionBytes
+from stm_tools.serialflasher.protection import ProtectionMap
+from stm_tools.serialflasher.errors import *
+
+PROT_TEST_MED_DEVICE_ID = 0x0410
+PROT_TEST_HIGH_DEVICE_ID = 0x0414
+PROT_TEST_BOOTLOADER_ID = 2.2
+PROT_TEST_FLASH_START = 0x08000000
+
+
+class ProtectionMapTestCase(unittest.TestCase):
+    def setUp(self):
+        self.med_dev = DeviceType(PROT_TEST_MED_DEVICE_ID, PROT_TEST_BOOTLOADER_ID)
+        self.high_dev = DeviceType(PROT_TEST_HIGH_DEVICE_ID, PROT_TEST_BOOTLOADER_ID)
+
+    def makeOptionBytes(self, sectors: list) -> OptionBytes:
+        fob = OptionBytes.FromAttributes()
+        fob.setWriteProtectedSectors(sectors)
+        return fob
+
+    def testNoProtection(self):
+        pmap = ProtectionMap(self.med_dev, self.makeOptionBytes([]))
+        self.assertEqual(pmap.getProtectedPages(), [])
+        self.assertTrue(pmap.isRangeWritable(PROT_TEST_FLASH_START, 128 * 1024))
+
+    def testMedDensitySectorPages(self):
+        """each sector covers 4 pages of 1kB"""
+        pmap = ProtectionMap(self.med_dev, self.makeOptionBytes([1]))
+        self.assertEqual(pmap.getProtectedPages(), [4, 5, 6, 7])
+
+    def testHighDensityLastSector(self):
+        """the last sector covers the rest of the flash"""
+        pmap = ProtectionMap(self.high_dev, self.makeOptionBytes([31]))
+        self.assertEqual(pmap.getProtectedPages(), list(range(62, 256)))
+
+    def testRangeWritable(self):
+        pmap = ProtectionMap(self.med_dev, self.makeOptionBytes([1]))
+        self.assertTrue(pmap.isRangeWritable(PROT_TEST_FLASH_START, 4096))
+        self.assertFalse(pmap.isRangeWritable(PROT_TEST_FLASH_START, 4097))
+        self.assertTrue(pmap.isRangeWritable(PROT_TEST_FLASH_START + 8192, 4))
+
+    def testRangeOutOfFlash(self):
+        pmap = ProtectionMap(self.med_dev, self.makeOptionBytes([]))
+        with self.assertRaises(InvalidAddressError):
+            pmap.isRangeWritable(PROT_TEST_FLASH_START + 128 * 1024, 4)
+
+    def testProtectedSectorsForRange(self):
+        pmap = ProtectionMap(self.med_dev, self.makeOptionBytes([0, 2, 5]))
+        sectors = pmap.getProtectedSectors(PROT_TEST_FLASH_START + 100, 3 * 4096)
+        self.assertEqual(sectors, [0, 2])
+
+    def testPlanUnprotectOnlyNeededSectors(self):
+        pmap = ProtectionMap(self.med_dev, self.makeOptionBytes([0, 2, 5]))
+        target = pmap.planUnprotect([(PROT_TEST_FLASH_START + 2 * 4096, 16)])
+        self.assertEqual(target.getWriteProtectedSectors(), [0, 5])
+
+    def testPlanUnprotectNothingNeeded(self):
+        pmap = ProtectionMap(self.med_dev, self.makeOptionBytes([5]))
+        self.assertIsNone(pmap.planUnprotect([(PROT_TEST_FLASH_START, 16)]))
@@ -0,0 +1,160 @@
+#! Tests for the port transaction scheduler
+#
+
+import asyncio
+import unittest
+from threading import Thread
+from time import sleep
+from stm_tools.serialflasher.cache import DeviceInfoCache
+from stm_tools.serialflasher.constants import *
+from stm_tools.serialflasher.scheduler import TransactionScheduler
+from stm_tools.serialflasher.serialtool import SerialTool
+from stm_tools.serialflasher.simulator import SimulatedBootloader, SimulatedSerial
+from stm_tools.serialflasher.stmdevice import STMInterface
+
+
+def waitFor(condition, timeout=2.0):
+    for _ in range(int(timeout / 0.001)):
+        if condition():
+            return True
+        sleep(0.001)
+    return False
+
+
+class TransactionSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = TransactionScheduler()
+
+    def testPriorityOrder(self):
+        order = []
+        self.scheduler.acquire()
+        threads = []
+        for name, priority in (
+            ("bulk", 20),
+            ("normal", 10),
+            ("ping", 0),
+            ("normal2", 10),
+        ):
+            thread = Thread(
+                target=self.scheduler.run,
+                args=(order.append, name),
+                kwargs={"priority": priority},
+            )
+            thread.start()
+            threads.append(thread)
+            self.assertTrue(waitFor(lambda: self.scheduler.waiting == len(threads)))
+        self.scheduler.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ["ping", "normal", "normal2", "bulk"])
+
+    def testReentrant(self):
+        with self.scheduler.transaction():
+            with self.scheduler.transaction(STM_PRIORITY_HIGH):
+                pass
+        # fully released
+        thread = Thread(target=self.scheduler.run, args=(lambda: None,))
+        thread.start()
+        thread.join(1.0)
+        self.assertFalse(thread.is_alive())
+
+    def testReleaseByOtherThread(self):
+        self.scheduler.acquire()
+        errors = []
+
+        def release():
+            try:
+                self.scheduler.release()
+            except RuntimeError as e:
+                errors.append(e)
+
+        thread = Thread(target=release)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+        self.scheduler.release()
+
+    def testRunAsync(self):
+        async def main():
+            return await asyncio.gather(
+                self.scheduler.runAsync(lambda x: x * 2, 2),
+                self.scheduler.runAsync(lambda x: x * 3, 3, priority=STM_PRIORITY_HIGH),
+            )
+
+        self.assertEqual(asyncio.run(main()), [4, 9])
+
+
+class YieldingSerial(SimulatedSerial):
+    """gives other threads a chance to run between every write, as a real
+    port blocking on I/O would"""
+
+    def write(self, data):
+        sleep(0.0001)
+        return super().write(data)
+
+
+class ConcurrentSerialToolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sim = YieldingSerial(SimulatedBootloader())
+        self.tool = SerialTool(serial=self.sim)
+        self.stm = STMInterface(self.tool, infoCache=DeviceInfoCache())
+        self.stm.connectToDevice()
+        self.stm.readDeviceInfo()
+
+    def testConnectedPerInstance(self):
+        other = SerialTool(serial=SimulatedSerial())
+        self.assertTrue(self.tool.connected)
+        self.assertFalse(other.connected)
+
+    def testCommandsNotInterleaved(self):
+        errors = []
+        data = bytearray(range(256)) * 8
+
+        def writer():
+            try:
+                for _ in range(5):
+                    self.assertTrue(self.stm.writeToRam(0x20000200, data))
+            except Exception as e:
+                errors.append(e)
+
+        def reader():
+            try:
+                for _ in range(50):
+                    success, rx = self.tool.cmdGetId()
+                    self.assertTrue(success)
+                    self.assertEqual(bytes(rx), b"\x04\x10")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=writer), Thread(target=reader), Thread(target=reader)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def testPingRunsBetweenBulkFrames(self):
+        events = []
+        write_frame = self.tool.cmdWriteToMemoryAddress
+
+        def slowWrite(address, data):
+            events.append("frame")
+            sleep(0.002)
+            return write_frame(address, data)
+
+        self.tool.cmdWriteToMemoryAddress = slowWrite
+        bulk = Thread(
+            target=self.stm.writeToRam, args=(0x20000200, bytearray(256 * 40))
+        )
+        bulk.start()
+        self.assertTrue(waitFor(lambda: len(events) >= 2))
+        with self.tool.transaction(STM_PRIORITY_HIGH):
+            self.assertTrue(self.tool.cmdGetId()[0])
+            events.append("ping")
+        bulk.join()
+        self.assertEqual(events.count("frame"), 40)
+        self.assertLess(events.index("ping"), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -168,6 +168,19 @@ class SerialFlasherTestCase(unittest.TestCase):
         self.assertFalse(self.sf.connected)
         self.assertFalse(self.serial.is_open)
 
+    def testReconnectAfterReset(self):
+        """test that reconnect polls until the bootloader answers a reset
+        and records how long it took
+        """
+        self.sf.connect()
+        self.sf.reset()
+        success = self.sf.reconnect(STM_RESET_DTR)
+        self.assertTrue(success)
+        self.assertEqual(self.sf.getResetTimings()[STM_RESET_DTR].count, 1)
+        self.assertLess(
+            self.sf.getResetTimings()[STM_RESET_DTR].last, STM_RECONNECT_TIMEOUT_S
+        )
+
     def testSetBaudWhilstConnected(self):
         """test that setting baud whilst connected returns false"""
         self.sf.connect()
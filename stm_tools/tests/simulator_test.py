@@ -0,0 +1,87 @@
+#! STMInterface tests run against the simulated bootloader
+#
+
+import unittest
+from struct import pack
+from stm_tools.serialflasher.cache import DeviceInfoCache
+from stm_tools.serialflasher.constants import *
+from stm_tools.serialflasher.errors import *
+from stm_tools.serialflasher.serialtool import SerialTool
+from stm_tools.serialflasher.simulator import SimulatedBootloader, SimulatedSerial
+from stm_tools.serialflasher.stmdevice import STMInterface
+
+SIM_TEST_RAM_START = 0x20000200
+SIM_TEST_RAM_TOP = 0x20005000
+
+
+class RunFromRamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sim = SimulatedSerial(SimulatedBootloader())
+        self.stm = STMInterface(
+            SerialTool(serial=self.sim), infoCache=DeviceInfoCache()
+        )
+        self.stm.connectToDevice()
+        self.stm.readDeviceInfo()
+
+    def testRunFromRam(self):
+        image = pack("<II", SIM_TEST_RAM_TOP, SIM_TEST_RAM_START + 0x101)
+        image += bytes(i & 0xFF for i in range(592))
+        self.assertTrue(self.stm.runFromRam(image))
+        self.assertFalse(self.stm.connected)
+        bootloader = self.sim.bootloader
+        self.assertEqual(bootloader.go_address, SIM_TEST_RAM_START)
+        self.assertEqual(bytes(bootloader.ram[0x200 : 0x200 + 600]), image)
+        # flash was not touched
+        self.assertEqual(bootloader.flash, bytearray([0xFF]) * len(bootloader.flash))
+
+    def testImageAtRamTop(self):
+        image = pack("<II", SIM_TEST_RAM_TOP, SIM_TEST_RAM_TOP - 0xFF) + bytes(248)
+        self.assertTrue(self.stm.runFromRam(image, SIM_TEST_RAM_TOP - 256))
+
+    def testBootloaderRamRejected(self):
+        image = pack("<II", SIM_TEST_RAM_TOP, 0x20000101) + bytes(8)
+        with self.assertRaises(InvalidAddressError):
+            self.stm.runFromRam(image, 0x20000100)
+        self.assertTrue(self.stm.connected)
+
+    def testImageTooLarge(self):
+        image = pack("<II", SIM_TEST_RAM_TOP, SIM_TEST_RAM_START + 1)
+        with self.assertRaises(InvalidAddressError):
+            self.stm.runFromRam(image + bytes(0x5000))
+
+    def testBadVectorTable(self):
+        with self.assertRaises(InvalidAddressError):
+            self.stm.runFromRam(
+                pack("<II", 0x08000000, SIM_TEST_RAM_START + 9) + bytes(8)
+            )
+        with self.assertRaises(InvalidAddressError):
+            # not a Thumb address
+            self.stm.runFromRam(
+                pack("<II", SIM_TEST_RAM_TOP, SIM_TEST_RAM_START + 8) + bytes(8)
+            )
+        with self.assertRaises(InvalidAddressError):
+            # outside the image
+            self.stm.runFromRam(pack("<II", SIM_TEST_RAM_TOP, 0x08000001) + bytes(8))
+        with self.assertRaises(InvalidWriteLengthError):
+            self.stm.runFromRam(bytes(4))
+
+
+class ResetTimingTestCase(unittest.TestCase):
+    def testTimingsStayBounded(self):
+        sim = SimulatedSerial(SimulatedBootloader())
+        tool = SerialTool(serial=sim)
+        self.assertTrue(tool.connect())
+        for _ in range(STM_RESET_TIMING_HISTORY + 4):
+            sim.bootloader.reset()
+            self.assertTrue(tool.reconnect(STM_RESET_DTR))
+
+        timing = tool.getResetTimings()[STM_RESET_DTR]
+        self.assertEqual(timing.count, STM_RESET_TIMING_HISTORY + 4)
+        self.assertEqual(len(timing.recent), STM_RESET_TIMING_HISTORY)
+        self.assertEqual(timing.last, timing.recent[-1])
+        self.assertLessEqual(timing.min, timing.max)
+        self.assertNotIn(STM_RESET_OPTION_BYTES, tool.getResetTimings())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -104,16 +104,30 @@ class STMInterfaceTestCase(unittest.TestCase):
         bootloader_version = self.stm.getDeviceBootloaderVersion()
         self.assertEqual(bootloader_version, DEVICE_VALID_BOOTLOADER_VERSION)
 
-    # def testGetDeviceValidCommands(self):
-    #     """ test we can get the valid device commands as a list """
-    #     self.stm.readDeviceInfo()
-    #     valid_cmds = self.stm.getDeviceValidCommands()
-    #     self.assertListEqual(valid_cmds, DEVICE_VALID_CMDS)
+    def testGetDeviceValidCommands(self):
+        """test we can get the valid device commands as a list"""
+        self.stm.readDeviceInfo()
+        valid_cmds = self.stm.getDeviceValidCommands()
+        self.assertListEqual(valid_cmds, DEVICE_VALID_CMDS)
+
+    def testGetDeviceValidCmdsBeforeRead(self):
+        """test that getting valid commands before read raises exception"""
+        with self.assertRaises(InformationNotRetrieved):
+            self.stm.getDeviceValidCommands()
 
-    # def testGetDeviceValidCmdsBeforeRead(self):
-    #     """ test that getting valid commands before read raises exception """
-    #     with self.assertRaises(InformationNotRetrieved):
-    #         self.stm.getDeviceValidCommands()
+    def testReadDeviceInfoCached(self):
+        """test that device info is served from the cache after the first read"""
+        self.stm.readDeviceInfo(refresh=True)
+        info = self.stm.infoCache.get(DEVICE_SERIAL_PORT)
+        self.assertEqual(info.pid, self.stm.device.pid)
+        self.stm.readDeviceInfo()
+        self.assertEqual(self.stm.device.capabilities, info.capabilities)
+
+    def testReadDeviceUid(self):
+        self.stm.readDeviceInfo()
+        uid = self.stm.readDeviceUid()
+        self.assertNotEqual(uid, 0)
+        self.assertEqual(self.stm.infoCache.getByUid(uid).pid, self.stm.device.pid)
 
     def testGetDeviceBootloaderVersionBeforeRead(self):
         """test that getting bootloader version before read raises exception"""
@@ -216,6 +230,44 @@ class STMInterfaceTestCase(unittest.TestCase):
         """ cleanup for this test """
         self.stm.readUnprotectFlashMemory()
 
+    def testApplyOptionBytesNoChange(self):
+        """test applying the current option bytes reports no changes"""
+        self.stm.readDeviceInfo()
+        current = self.stm.getOptionBytes(refresh=True)
+        success, changes = self.stm.applyOptionBytes(current)
+        self.assertEqual(success, True)
+        self.assertEqual(changes, {})
+        self.assertEqual(self.stm.connected, True)
+
+    def testApplyOptionBytesDataByte(self):
+        self.stm.readDeviceInfo()
+        target = OptionBytes.FromBytes(bytes(self.stm.getOptionBytes().rawBytes))
+        target.dataByte0 = target.dataByte0 ^ 0xFF
+        success, changes = self.stm.applyOptionBytes(target)
+        self.assertEqual(success, True)
+        self.assertEqual(list(changes), ["data_byte_0"])
+        self.assertEqual(self.stm.getOptionBytes().dataByte0, target.dataByte0)
+
+    def testApplyProtectionSingleReset(self):
+        """test write protection is applied with a single option-byte write,
+        and that re-applying the same state costs no reset
+        """
+        self.stm.readDeviceInfo()
+        success = self.stm.applyProtection(writeProtectedSectors=[0, 1])
+        self.assertEqual(success, True)
+        self.assertEqual(self.stm.device.opt_bytes.getWriteProtectedSectors(), [0, 1])
+
+        resets = self.stm.serialTool.getResetTimings()[STM_RESET_OPTION_BYTES].count
+        success = self.stm.applyProtection(writeProtectedSectors=[0, 1])
+        self.assertEqual(success, True)
+        self.assertEqual(
+            self.stm.serialTool.getResetTimings()[STM_RESET_OPTION_BYTES].count,
+            resets,
+        )
+
+        """ cleanup for this test """
+        self.stm.applyProtection(writeProtectedSectors=[])
+
     def testLongWriteToFlash(self):
         """test we can write a 516 len bytes to
         flash memory, testing the multiple write
@@ -229,6 +281,16 @@ class STMInterfaceTestCase(unittest.TestCase):
 
         self.assertEqual(success, True)
 
+    def testEraseFlashPages(self):
+        self.stm.readDeviceInfo()
+        self.stm.writeToFlash(
+            self.stm.device.flash_memory.start, bytearray([STM_DEVICE_TEST_CHAR] * 4)
+        )
+        success = self.stm.eraseFlashPages([0])
+        self.assertEqual(success, True)
+        success, rx = self.stm.readFromFlash(self.stm.device.flash_memory.start, 4)
+        self.assertEqual(rx, bytearray([0xFF] * 4))
+
     def testApplicationWriteToFlash(self):
         self.stm.readDeviceInfo()
         success = self.stm.writeApplicationFileToFlash(STM_TEST_BINARY_PATH)
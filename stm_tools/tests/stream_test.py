@@ -0,0 +1,130 @@
+#! Tests for the streaming read and write API, run against the simulated bootloader
+#
+
+import hashlib
+import unittest
+from stm_tools.serialflasher.cache import DeviceInfoCache
+from stm_tools.serialflasher.constants import *
+from stm_tools.serialflasher.errors import *
+from stm_tools.serialflasher.integrity import WriteDigest
+from stm_tools.serialflasher.serialtool import SerialTool
+from stm_tools.serialflasher.simulator import SimulatedBootloader, SimulatedSerial
+from stm_tools.serialflasher.stmdevice import STMInterface
+
+STREAM_TEST_DATA = bytes((i * 29) & 0xFF for i in range(5000))
+STREAM_TEST_RAM = 0x20001000
+
+
+class CountingSerialTool(SerialTool):
+    """counts read and write memory commands and the bytes they carry"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reads = 0
+        self.written = 0
+
+    def cmdReadFromMemoryAddress(self, address, length):
+        self.reads += 1
+        return super().cmdReadFromMemoryAddress(address, length)
+
+    def cmdWriteFramed(self, address_frame, data_frame):
+        self.written += data_frame[0] + 1
+        return super().cmdWriteFramed(address_frame, data_frame)
+
+
+class StreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sim = SimulatedSerial(SimulatedBootloader())
+        self.tool = CountingSerialTool(serial=self.sim)
+        self.stm = STMInterface(self.tool, DeviceInfoCache())
+        self.stm.connectToDevice()
+        self.stm.readDeviceInfo()
+        # count only the reads made by the test, not the UID read
+        self.tool.reads = 0
+        self.flash = self.sim.bootloader.flash
+
+    def testIterReadIsLazy(self):
+        self.flash[: len(STREAM_TEST_DATA)] = STREAM_TEST_DATA
+        blocks = self.stm.iterRead(STM_F10X_FLASH_START, len(STREAM_TEST_DATA), 1024)
+        self.assertEqual(self.tool.reads, 0)
+        first = next(blocks)
+        self.assertIsInstance(first, memoryview)
+        self.assertEqual(first, STREAM_TEST_DATA[:1024])
+        self.assertEqual(self.tool.reads, 4)
+
+        rest = b"".join(bytes(block) for block in blocks)
+        self.assertEqual(rest, STREAM_TEST_DATA[1024:])
+        self.assertEqual(self.tool.reads, -(-len(STREAM_TEST_DATA) // 256))
+
+    def testIterReadIntoHash(self):
+        sha = hashlib.sha256()
+        for block in self.stm.iterRead(STM_F10X_FLASH_START, 64 * 1024, 4096):
+            sha.update(block)
+        self.assertEqual(sha.digest(), hashlib.sha256(self.flash[: 64 * 1024]).digest())
+
+    def testIterReadChecksEagerly(self):
+        with self.assertRaises(InvalidAddressError):
+            self.stm.iterRead(0x30000000, 16)
+        with self.assertRaises(InvalidReadLengthError):
+            self.stm.iterRead(STM_F10X_FLASH_START + len(self.flash) - 8, 16)
+        with self.assertRaises(ValueError):
+            self.stm.iterRead(STM_F10X_FLASH_START, 16, 0)
+
+    def testWriteStreamPullsLazily(self):
+        pulled = []
+
+        def producer():
+            for offset in range(0, len(STREAM_TEST_DATA), 100):
+                pulled.append((offset, self.tool.written))
+                yield STREAM_TEST_DATA[offset : offset + 100]
+
+        digest = WriteDigest(1024, STM_F10X_FLASH_START)
+        self.assertTrue(
+            self.stm.writeStream(STM_F10X_FLASH_START, producer(), digest=digest)
+        )
+        self.assertEqual(bytes(self.flash[: len(STREAM_TEST_DATA)]), STREAM_TEST_DATA)
+        self.assertEqual(digest.length, len(STREAM_TEST_DATA))
+        # never more than a frame's worth pulled ahead of the link
+        for offset, written in pulled:
+            self.assertLessEqual(offset - written, 256)
+
+    def testWriteStreamLargeAndUnevenChunks(self):
+        chunks = [
+            STREAM_TEST_DATA[:3],
+            STREAM_TEST_DATA[3:1000],
+            STREAM_TEST_DATA[1000:],
+        ]
+        events = []
+        self.stm.writeStream(
+            STM_F10X_FLASH_START,
+            iter(chunks),
+            len(STREAM_TEST_DATA),
+            progress=events.append,
+        )
+        self.assertEqual(bytes(self.flash[: len(STREAM_TEST_DATA)]), STREAM_TEST_DATA)
+        self.assertEqual(events[-1].done, len(STREAM_TEST_DATA))
+
+    def testWriteStreamPadsFlash(self):
+        self.stm.writeStream(STM_F10X_FLASH_START, [b"\x01\x02\x03"])
+        self.assertEqual(self.flash[:8], b"\x01\x02\x03\xff\xff\xff\xff\xff")
+
+    def testWriteStreamToRam(self):
+        self.assertTrue(self.stm.writeStream(STREAM_TEST_RAM, [STREAM_TEST_DATA[:512]]))
+        read = b"".join(bytes(b) for b in self.stm.iterRead(STREAM_TEST_RAM, 512))
+        self.assertEqual(read, STREAM_TEST_DATA[:512])
+        with self.assertRaises(InvalidWriteLengthError):
+            self.stm.writeStream(STREAM_TEST_RAM, [b"\x01\x02"])
+
+    def testWriteStreamBounds(self):
+        end = STM_F10X_FLASH_START + len(self.flash)
+        with self.assertRaises(InvalidAddressError):
+            self.stm.writeStream(STM_F10X_FLASH_START + 2, [b"abcd"])
+        with self.assertRaises(InvalidWriteLengthError):
+            self.stm.writeStream(end - 256, [], length=512)
+        with self.assertRaises(InvalidWriteLengthError):
+            self.stm.writeStream(end - 256, [bytes(512)])
+        self.assertEqual(self.tool.written, 256)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+#! Tests for the transports, run against a local bridge or pty to the simulated bootloader
+#
+
+import os
+import socket
+import tempfile
+import unittest
+from serial.serialutil import SerialException
+from stm_tools.serialflasher.benchmark import compareTransports
+from stm_tools.serialflasher.cache import DeviceInfoCache
+from stm_tools.serialflasher.constants import *
+from stm_tools.serialflasher.serialtool import SerialTool
+from stm_tools.serialflasher.simulator import SimulatedBridge, SimulatedPty
+from stm_tools.serialflasher.stmdevice import STMInterface
+from stm_tools.serialflasher.transport import *
+
+
+class TcpTransportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bridge = SimulatedBridge()
+        self.bridge.serial.bootloader.flash[0:256] = bytes(range(256))
+
+    def tearDown(self):
+        self.bridge.close()
+
+    def testOpenTransportByUrl(self):
+        transport = openTransport(self.bridge.url, timeout=0.5)
+        self.assertIsInstance(transport, TcpTransport)
+        self.assertEqual(transport.port, self.bridge.url)
+        self.assertEqual(
+            transport._socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY), 1
+        )
+        transport.close()
+        self.assertFalse(transport.is_open)
+
+    def testBadUrl(self):
+        with self.assertRaises(SerialException):
+            openTransport("tcp://localhost")
+
+    def testSerialToolOverBridge(self):
+        tool = SerialTool(self.bridge.url, 57600)
+        tool.setSerialReadWriteTimeout(0.5)
+        stm = STMInterface(tool, infoCache=DeviceInfoCache())
+        self.assertTrue(stm.connectToDevice())
+        stm.readDeviceInfo()
+        self.assertEqual(stm.device.pid, 0x0410)
+        success, rx = stm.readFromFlash(STM_F10X_FLASH_START, 256)
+        self.assertTrue(success)
+        self.assertEqual(bytes(rx), bytes(range(256)))
+        self.assertTrue(stm.writeToRam(0x20001000, bytes(range(64))))
+        tool.disconnect()
+
+    def testReadTimesOut(self):
+        transport = TcpTransport("127.0.0.1", int(self.bridge.url.rsplit(":", 1)[1]))
+        transport.timeout = 0.05
+        self.assertEqual(transport.read(1), b"")
+        self.assertEqual(transport.read_until(b"\x79", size=1), b"")
+        transport.close()
+
+
+class Rfc2217TransportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bridge = SimulatedBridge(rfc2217=True)
+
+    def tearDown(self):
+        self.bridge.close()
+
+    def testSerialToolOverBridge(self):
+        tool = SerialTool(self.bridge.url, 57600)
+        tool.setSerialReadWriteTimeout(0.5)
+        self.assertTrue(tool.connect())
+        success, rx = tool.cmdGetId()
+        self.assertTrue(success)
+        self.assertEqual(self.bridge.serial.parity, "E")
+        tool.disconnect()
+
+    def testDtrResetsThroughBridge(self):
+        tool = SerialTool(self.bridge.url, 57600)
+        resets = self.bridge.serial.bootloader.resets
+        tool.serial.setDTR(True)
+        tool.serial.setDTR(False)
+        # control line changes are not acknowledged, wait for one round trip
+        tool.setSerialReadWriteTimeout(0.5)
+        self.assertTrue(tool.reconnect(STM_RESET_DTR, 1.0))
+        self.assertEqual(self.bridge.serial.bootloader.resets, resets + 1)
+        tool.disconnect()
+
+
+@unittest.skipUnless(hasattr(os, "openpty"), "needs pseudo terminals")
+class FdTransportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pty = SimulatedPty()
+        self.pty.serial.bootloader.flash[0:256] = bytes(range(256))
+        self.sysfs = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.pty.close()
+        self.sysfs.cleanup()
+
+    def testSerialToolOverTty(self):
+        tool = SerialTool(f"tty://{self.pty.port}", 57600)
+        self.assertIsInstance(tool.serial, FdTransport)
+        stm = STMInterface(tool, infoCache=DeviceInfoCache())
+        self.assertTrue(stm.connectToDevice())
+        stm.readDeviceInfo()
+        success, rx = stm.readFromFlash(STM_F10X_FLASH_START, 1024)
+        self.assertTrue(success)
+        self.assertEqual(bytes(rx[:256]), bytes(range(256)))
+        tool.disconnect()
+        self.assertFalse(tool.serial.is_open)
+
+    def testReadTimesOut(self):
+        transport = FdTransport(self.pty.port, timeout=0.05)
+        self.assertEqual(transport.read(4), b"")
+        self.assertEqual(transport.in_waiting, 0)
+        transport.close()
+
+    def testLatencyTimerRestored(self):
+        name = os.path.basename(os.path.realpath(self.pty.port))
+        os.mkdir(os.path.join(self.sysfs.name, name))
+        path = os.path.join(self.sysfs.name, name, "latency_timer")
+        with open(path, "w") as fp:
+            fp.write("16\n")
+
+        transport = FdTransport(self.pty.port, sysfsRoot=self.sysfs.name)
+        self.assertEqual(transport.latency_timer, TRANSPORT_LATENCY_TIMER_MS)
+        with open(path) as fp:
+            self.assertEqual(fp.read(), str(TRANSPORT_LATENCY_TIMER_MS))
+        transport.close()
+        with open(path) as fp:
+            self.assertEqual(fp.read(), "16")
+
+    def testNoLatencyTimer(self):
+        transport = FdTransport(self.pty.port, sysfsRoot=self.sysfs.name)
+        self.assertIsNone(transport.latency_timer)
+        transport.close()
+
+    def testCompareTransports(self):
+        results = compareTransports(count=5)
+        self.assertEqual(sorted(results), ["fd", "pyserial"])
+        for timings in results.values():
+            self.assertGreater(timings["get_id_us"], 0)
+            self.assertGreater(timings["read_256_us"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+#! Tests for readback verification, run against the simulated bootloader
+#
+
+import unittest
+from stm_tools.serialflasher import verify
+from stm_tools.serialflasher.cache import DeviceInfoCache
+from stm_tools.serialflasher.constants import *
+from stm_tools.serialflasher.serialtool import SerialTool
+from stm_tools.serialflasher.simulator import SimulatedBootloader, SimulatedSerial
+from stm_tools.serialflasher.stmdevice import STMInterface
+from stm_tools.serialflasher.verify import *
+
+VERIFY_TEST_ADDRESS = 0x08000800
+VERIFY_TEST_DATA = bytes((i * 11) & 0xFF for i in range(5000))
+
+
+class FindMismatchesTestCase(unittest.TestCase):
+    def check(self):
+        actual = bytearray(VERIFY_TEST_DATA)
+        self.assertEqual(findMismatches(VERIFY_TEST_DATA, actual, 0x100), [])
+        actual[10] ^= 1
+        actual[11] ^= 0x80
+        actual[300:310] = bytes(10)
+        self.assertEqual(
+            findMismatches(VERIFY_TEST_DATA, actual, 0x100),
+            [(0x100 + 10, 2), (0x100 + 300, 10)],
+        )
+        # a short readback differs from where it stops
+        self.assertEqual(
+            findMismatches(VERIFY_TEST_DATA, VERIFY_TEST_DATA[:4000]), [(4000, 1000)]
+        )
+
+    def testWordWide(self):
+        saved, verify.numpy = verify.numpy, None
+        try:
+            self.check()
+        finally:
+            verify.numpy = saved
+
+    @unittest.skipIf(verify.numpy is None, "NumPy is not installed")
+    def testNumpy(self):
+        self.check()
+
+    def testRunsJoinAcrossBlocks(self):
+        collector = MismatchCollector()
+        self.assertFalse(collector.compare(0, b"\x00\x01", b"\x00\x00"))
+        self.assertFalse(collector.compare(2, b"\x02\x03", b"\x00\x03"))
+        self.assertTrue(collector.compare(4, b"\x04", b"\x04"))
+        self.assertEqual(collector.mismatches(), [(1, 2)])
+
+
+class VerifyFlashTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sim = SimulatedSerial(SimulatedBootloader())
+        self.stm = STMInterface(SerialTool(serial=self.sim), DeviceInfoCache())
+        self.stm.connectToDevice()
+        self.stm.readDeviceInfo()
+        self.flash = self.sim.bootloader.flash
+        offset = VERIFY_TEST_ADDRESS - STM_F10X_FLASH_START
+        # the page before the data shares nothing with it, the data's last
+        # page has other content after it
+        self.flash[offset : offset + 5000] = VERIFY_TEST_DATA
+        self.flash[offset + 5000 : offset + 5120] = bytes(range(120))
+        self.offset = offset
+
+    def testMatch(self):
+        report = self.stm.verifyFlash(VERIFY_TEST_ADDRESS, VERIFY_TEST_DATA)
+        self.assertTrue(report.ok)
+        self.assertEqual(report.pages, [])
+
+    def testMismatchesMappedToPages(self):
+        for i in range(1020, 1030):
+            self.flash[self.offset + i] ^= 0xFF
+        self.flash[self.offset + 4500] ^= 0x01
+        report = self.stm.verifyFlash(VERIFY_TEST_ADDRESS, VERIFY_TEST_DATA)
+        self.assertFalse(report.ok)
+        self.assertEqual(
+            report.mismatches,
+            [
+                Mismatch(VERIFY_TEST_ADDRESS + 1020, 10, (2, 3)),
+                Mismatch(VERIFY_TEST_ADDRESS + 4500, 1, (6,)),
+            ],
+        )
+        self.assertEqual(report.pages, [2, 3, 6])
+        self.assertEqual(report.repaired, [])
+
+    def testRepair(self):
+        self.flash[self.offset + 4500] ^= 0x01
+        report = self.stm.verifyFlash(
+            VERIFY_TEST_ADDRESS, VERIFY_TEST_DATA, repair=True
+        )
+        self.assertTrue(report.ok)
+        self.assertEqual(report.repaired, [6])
+        offset = self.offset
+        self.assertEqual(bytes(self.flash[offset : offset + 5000]), VERIFY_TEST_DATA)
+        # bytes of the repaired page outside the data survive
+        self.assertEqual(
+            bytes(self.flash[offset + 5000 : offset + 5120]), bytes(range(120))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()